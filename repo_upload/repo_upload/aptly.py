@@ -0,0 +1,420 @@
+"""
+Helpers for communicating with the Aptly API server
+
+The server manager attaches to an API server left running by an earlier
+run for the same configuration (when servers are kept running; other
+runs stop any such server, as they replace its database), or starts
+a new one listening on an
+ephemeral port (or a Unix socket), waiting for it to become ready with
+backoff probing and draining its output in the background
+"""
+
+import collections
+import contextlib
+import json
+import os
+import signal
+import socket
+import subprocess
+import threading
+import time
+import uuid
+
+import requests
+import requests.adapters
+import urllib3.connection
+import urllib3.connectionpool
+
+
+class UnixSocketConnection(urllib3.connection.HTTPConnection):
+    """
+    HTTP connection made over a Unix socket
+    """
+
+    def __init__(self, socket_path, *args, **kwargs):
+        self.socket_path = socket_path
+        super().__init__('localhost', *args, **kwargs)
+
+    def _new_conn(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(self.socket_path)
+
+        return sock
+
+
+class UnixSocketConnectionPool(urllib3.connectionpool.HTTPConnectionPool):
+    """
+    Connection pool handing out connections over a Unix socket
+    """
+
+    def __init__(self, socket_path, **kwargs):
+        self.socket_path = socket_path
+        super().__init__('localhost', **kwargs)
+
+    def _new_conn(self):
+        return UnixSocketConnection(self.socket_path)
+
+
+class UnixSocketAdapter(requests.adapters.HTTPAdapter):
+    """
+    Transport adapter sending all requests to a Unix socket
+    """
+
+    def __init__(self, socket_path, **kwargs):
+        self.socket_path = socket_path
+        self.unix_pool = UnixSocketConnectionPool(socket_path)
+        super().__init__(**kwargs)
+
+    def get_connection(self, url, proxies=None):
+        return self.unix_pool
+
+    def get_connection_with_tls_context(self, request, verify, proxies=None,
+                                        cert=None):
+        return self.unix_pool
+
+    def close(self):
+        self.unix_pool.close()
+        super().close()
+
+
+class AptlyServer:
+    """
+    Manages the lifetime of an Aptly API server for a given
+    configuration file
+    """
+
+    def __init__(self, config_file, listen=None, url=None, timeout=30,
+                 keep_running=False):
+        """
+        Set up management of the server; an explicit url attaches to
+        a server managed elsewhere, otherwise listen may be a 'host:port'
+        or 'unix:PATH' address to use instead of an ephemeral port
+        """
+
+        self.config_file = config_file
+        self.state_file = f'{config_file}.server.json'
+        self.log_file = f'{config_file}.server.log'
+        self.listen = listen
+        self.url = url
+        self.timeout = timeout
+        self.keep_running = keep_running
+        self.proc = None
+        self.log_tail = collections.deque(maxlen=20)
+        self.session = requests.Session()
+
+        if url is not None:
+            self.connect(url)
+
+    def connect(self, address):
+        """
+        Point the session at the given server address, which is either
+        a URL or a 'unix:PATH' socket address
+        """
+
+        if address.startswith('unix:'):
+            socket_path = address[len('unix:'):].replace('//', '', 1)
+            self.url = 'http://aptly'
+            self.session.mount(self.url, UnixSocketAdapter(socket_path))
+        else:
+            self.url = address
+
+    def is_ready(self):
+        """
+        Check if the server is answering API requests
+        """
+
+        try:
+            req = self.session.get(f'{self.url}/api/version', timeout=5)
+        except requests.exceptions.ConnectionError:
+            return False
+
+        return req.status_code == 200
+
+    def is_server_process(self, pid):
+        """
+        Check that a process is an Aptly API server using this server's
+        configuration file
+        """
+
+        try:
+            with open(f'/proc/{pid}/cmdline', 'rb') as fh:
+                args = fh.read().decode(errors='replace').split('\0')
+        except OSError:
+            return False
+
+        return (os.path.basename(args[0]) == 'aptly' and
+                args[1:3] == ['api', 'serve'] and
+                f'-config={self.config_file}' in args)
+
+    def kept_state(self):
+        """
+        Return the recorded state of a server left running by an earlier
+        run, or None if there's none; the recorded process may since
+        have exited and its pid been reused (say after a crash or a
+        reboot), in which case the stale state is removed
+        """
+
+        try:
+            with open(self.state_file) as fh:
+                state = json.load(fh)
+
+            pid = state['pid']
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+        if not self.is_server_process(pid):
+            print(f'Removing stale Aptly API server state {self.state_file}')
+
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(self.state_file)
+
+            return None
+
+        return state
+
+    def attach(self):
+        """
+        Attach to a server left running by an earlier run, if it's
+        still alive and answering
+        """
+
+        state = self.kept_state()
+
+        if state is None or 'address' not in state:
+            return False
+
+        self.connect(state['address'])
+
+        if not self.is_ready():
+            return False
+
+        print(f'Attached to Aptly API server at {state["address"]}')
+
+        return True
+
+    def stop_kept(self):
+        """
+        Stop a server left running by an earlier run, which mustn't
+        be attached to when its database is about to be replaced
+        """
+
+        state = self.kept_state()
+
+        if state is None:
+            return
+
+        pid = state['pid']
+        print(f'Stopping Aptly API server left running (pid {pid})...')
+
+        try:
+            os.kill(pid, signal.SIGTERM)
+
+            # The server isn't a child of this process, so can't be
+            # waited for directly
+            deadline = time.monotonic() + self.timeout
+
+            while time.monotonic() < deadline:
+                os.kill(pid, 0)
+                time.sleep(.1)
+
+            os.kill(pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self.state_file)
+
+    @staticmethod
+    def ephemeral_address():
+        """
+        Find a free local port for the server to listen on
+        """
+
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+
+            return f'127.0.0.1:{sock.getsockname()[1]}'
+
+    def drain_output(self):
+        """
+        Copy the server's output to its log file, keeping the last
+        few lines for error reporting; this stops the server ever
+        blocking on a full pipe
+        """
+
+        with open(self.log_file, 'ab') as log:
+            for line in self.proc.stdout:
+                log.write(line)
+                log.flush()
+                self.log_tail.append(line.decode(errors='replace').rstrip())
+
+    def wait_until_ready(self):
+        """
+        Probe the server with exponential backoff until it answers,
+        it exits or the timeout is reached
+        """
+
+        deadline = time.monotonic() + self.timeout
+        delay = .02
+
+        while not self.is_ready():
+            if self.proc.poll() is not None:
+                raise RuntimeError(
+                    f'Aptly API server exited with status '
+                    f'{self.proc.returncode}:\n' + '\n'.join(self.log_tail)
+                )
+
+            if time.monotonic() >= deadline:
+                self.proc.terminate()
+                raise RuntimeError(
+                    f'Aptly API server not ready after {self.timeout} '
+                    f'seconds:\n' + '\n'.join(self.log_tail)
+                )
+
+            time.sleep(delay)
+            delay = min(delay * 2, 1)
+
+    def start(self):
+        """
+        Attach to a server kept running, or start a new one and wait
+        for it to become ready
+        """
+
+        if self.url is not None:
+            if not self.is_ready():
+                raise RuntimeError(f'Aptly API server at {self.url} '
+                                   f'is not responding')
+            return
+
+        if self.keep_running:
+            if self.attach():
+                return
+        else:
+            self.stop_kept()
+
+        address = self.listen or self.ephemeral_address()
+
+        if address.startswith('unix:'):
+            socket_path = address[len('unix:'):].replace('//', '', 1)
+
+            if os.path.exists(socket_path):
+                os.remove(socket_path)
+
+            listen = f'unix://{socket_path}'
+        else:
+            listen = address
+            address = f'http://{address}'
+
+        print(f'Starting Aptly API server on {listen}...')
+        self.proc = subprocess.Popen(
+            ['aptly', 'api', 'serve', f'-config={self.config_file}',
+             f'-listen={listen}'],
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT
+        )
+        threading.Thread(target=self.drain_output, daemon=True).start()
+        self.connect(address)
+        self.wait_until_ready()
+
+        with open(self.state_file, 'w') as fh:
+            json.dump({'pid': self.proc.pid, 'address': address}, fh)
+
+    def stop(self):
+        """
+        Stop the server if it was started by this run, unless it should
+        be left running for later runs to attach to
+        """
+
+        self.session.close()
+
+        if self.proc is None or self.keep_running:
+            return
+
+        self.proc.terminate()
+
+        try:
+            self.proc.wait(timeout=self.timeout)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+
+        # The state file is only written once the server is ready
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self.state_file)
+
+
+class MultipartStream:
+    """
+    A multipart/form-data request body made up of several files, which
+    are streamed from disk rather than read into memory; the length is
+    known up front so the request is sent with a Content-Length
+    """
+
+    chunk_size = 2 ** 20
+
+    def __init__(self, files, field='file'):
+        """
+        Build the body for a list of (filename, path) pairs
+        """
+
+        boundary = uuid.uuid4().hex
+        self.content_type = f'multipart/form-data; boundary={boundary}'
+        self.parts = list()
+
+        for filename, path in files:
+            self.parts.append(
+                f'--{boundary}\r\n'
+                f'Content-Disposition: form-data; name="{field}"; '
+                f'filename="{filename}"\r\n'
+                f'Content-Type: application/octet-stream\r\n\r\n'.encode()
+            )
+            self.parts.append(str(path))
+            self.parts.append(b'\r\n')
+
+        self.parts.append(f'--{boundary}--\r\n'.encode())
+        self.length = sum(
+            len(part) if isinstance(part, bytes) else os.path.getsize(part)
+            for part in self.parts
+        )
+        self.chunks = None
+        self.current = b''
+        self.offset = 0
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        for part in self.parts:
+            if isinstance(part, bytes):
+                yield part
+                continue
+
+            with open(part, 'rb') as fh:
+                for chunk in iter(lambda: fh.read(self.chunk_size), b''):
+                    yield chunk
+
+    def read(self, size=-1):
+        """
+        File-like access to the body, as used by the HTTP client
+        """
+
+        if self.chunks is None:
+            self.chunks = iter(self)
+
+        data = bytearray()
+
+        while size < 0 or len(data) < size:
+            if self.offset >= len(self.current):
+                self.current = next(self.chunks, b'')
+                self.offset = 0
+
+                if not self.current:
+                    break
+
+            end = len(self.current)
+
+            if size >= 0:
+                end = min(end, self.offset + size - len(data))
+
+            data += self.current[self.offset:end]
+            self.offset = end
+
+        return bytes(data)
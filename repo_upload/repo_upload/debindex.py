@@ -0,0 +1,522 @@
+"""
+Builds APT repository indexes directly from Debian packages
+
+Reads the control data from each package in the pool, and writes
+the Packages indexes (plain, gzipped and xz compressed), optionally the
+Contents index, and the signed Release, InRelease and Release.gpg files
+for each distribution, in the same layout aptly publishes; control data
+and file lists are cached with the package's identity, so rebuilding
+indexes never reads package contents again.  Index files can also be
+published under their hash (Acquire-By-Hash), so clients never fetch
+an index that doesn't match the Release file they have
+"""
+
+import gzip
+import hashlib
+import io
+import lzma
+import os
+import shutil
+import subprocess
+import tarfile
+import threading
+import time
+
+from collections import OrderedDict
+
+
+AR_MAGIC = b'!<arch>\n'
+AR_HEADER_SIZE = 60
+
+# Checksum fields in the Release file, with their hashlib algorithm
+RELEASE_CHECKSUMS = (('MD5Sum', 'md5'), ('SHA1', 'sha1'),
+                     ('SHA256', 'sha256'), ('SHA512', 'sha512'))
+
+# Superseded by-hash files are kept this long (in seconds), for clients
+# still holding an older Release file
+BY_HASH_RETENTION = 7 * 86400
+
+
+def find_ar_member(fh, filename, kind):
+    """
+    Position an open Debian package at the start of its control or
+    data archive (as given by kind), returning the archive's name
+    and size
+    """
+
+    if fh.read(len(AR_MAGIC)) != AR_MAGIC:
+        raise ValueError(f'{filename} is not a Debian package')
+
+    while True:
+        header = fh.read(AR_HEADER_SIZE)
+
+        if len(header) < AR_HEADER_SIZE:
+            raise ValueError(f'No {kind} archive in {filename}')
+
+        name = header[:16].decode().strip().rstrip('/')
+        size = int(header[48:58])
+
+        if name.startswith(f'{kind}.tar'):
+            return name, size
+
+        # Members are aligned to an even offset
+        fh.seek(size + size % 2, os.SEEK_CUR)
+
+
+def zstd_command(filename):
+    """
+    Return the command decompressing Zstandard data (which tarfile
+    can't read itself) from stdin to stdout
+    """
+
+    if shutil.which('zstd') is None:
+        raise RuntimeError(f'Unable to read {filename}: the zstd tool '
+                           f'is needed for Zstandard compressed archives')
+
+    return ['zstd', '-d', '-c', '-q']
+
+
+def feed_pipe(src, pipe, size):
+    """
+    Copy size bytes from an open file into a pipe, then close it;
+    the reading end may be closed early, once it's read enough
+    """
+
+    try:
+        while size > 0:
+            chunk = src.read(min(size, 2 ** 20))
+
+            if not chunk:
+                break
+
+            pipe.write(chunk)
+            size -= len(chunk)
+    except BrokenPipeError:
+        pass
+    finally:
+        try:
+            pipe.close()
+        except BrokenPipeError:
+            pass
+
+
+def read_control(filename):
+    """
+    Return the fields from the control file of a Debian package,
+    which is found in the control archive inside the package's
+    ar archive
+    """
+
+    with open(filename, 'rb') as fh:
+        name, size = find_ar_member(fh, filename, 'control')
+        control_tar = fh.read(size)
+
+    if name.endswith('.zst'):
+        proc = subprocess.run(zstd_command(filename), input=control_tar,
+                              stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+        if proc.returncode:
+            raise RuntimeError(f'Unable to decompress {name} in {filename}: '
+                               f'{proc.stderr.decode().strip()}')
+
+        control_tar = proc.stdout
+
+    with tarfile.open(fileobj=io.BytesIO(control_tar), mode='r:*') as tar:
+        for member in tar.getmembers():
+            if member.name in ('control', './control'):
+                return parse_control(tar.extractfile(member).read().decode())
+
+    raise ValueError(f'No control file in {filename}')
+
+
+def tar_paths(stream):
+    """
+    Return the sorted paths of the files (but not directories) in
+    a tar archive read as a stream
+    """
+
+    paths = list()
+
+    with tarfile.open(fileobj=stream, mode='r|*') as tar:
+        for member in tar:
+            if not member.isdir():
+                paths.append(os.path.normpath(member.name).lstrip('/'))
+
+    return sorted(paths)
+
+
+def read_contents(filename):
+    """
+    Return the paths of the files installed by a Debian package, read
+    from the data archive (streamed, as it holds the whole payload);
+    Zstandard compressed archives are streamed through the zstd tool
+    """
+
+    with open(filename, 'rb') as fh:
+        name, size = find_ar_member(fh, filename, 'data')
+
+        if not name.endswith('.zst'):
+            return tar_paths(fh)
+
+        proc = subprocess.Popen(zstd_command(filename),
+                                stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        feeder = threading.Thread(target=feed_pipe,
+                                  args=(fh, proc.stdin, size))
+        feeder.start()
+
+        try:
+            paths = tar_paths(proc.stdout)
+
+            # Padding may follow the end of the archive, which is read
+            # so zstd isn't cut off and can exit cleanly
+            while proc.stdout.read(2 ** 20):
+                pass
+        finally:
+            proc.stdout.close()
+            feeder.join()
+            proc.wait()
+
+    if proc.returncode:
+        raise RuntimeError(f'Unable to decompress {name} in {filename}')
+
+    return paths
+
+
+def parse_control(text):
+    """
+    Parse a control stanza into its fields, keeping their order;
+    continuation lines are kept as part of the field's value
+    """
+
+    fields = OrderedDict()
+    field = None
+
+    for line in text.splitlines():
+        if not line.strip():
+            continue
+
+        if line[0] in ' \t' and field is not None:
+            fields[field] += f'\n{line}'
+        else:
+            field, _, value = line.partition(':')
+            fields[field] = value.strip()
+
+    return fields
+
+
+def format_stanza(fields):
+    """
+    Return the text of a control stanza with the given fields; values
+    starting with a newline (such as checksum lists) start on the line
+    after the field name
+    """
+
+    lines = list()
+
+    for field, value in fields.items():
+        separator = '' if value.startswith('\n') else ' '
+        lines.append(f'{field}:{separator}{value}\n')
+
+    return ''.join(lines)
+
+
+class DebIndexBuilder:
+    """
+    Lays out packages in a repository's pool and generates the signed
+    indexes for its distributions
+    """
+
+    architecture = 'amd64'
+
+    def __init__(self, repo_dir, hash_cache, gpg, key, contents=True,
+                 by_hash=True):
+        """
+        Set up for building indexes in the given repository directory,
+        signing them with the given key; contents and by_hash control
+        whether Contents indexes and by-hash copies are published
+        """
+
+        self.repo_dir = repo_dir
+        self.hash_cache = hash_cache
+        self.gpg = gpg
+        self.key = key
+        self.contents = contents
+        self.by_hash = by_hash
+
+    def control(self, pkg):
+        """
+        Return the (cached) control fields for a package
+        """
+
+        return OrderedDict(
+            self.hash_cache.get_metadata(pkg, 'deb-control', read_control)
+        )
+
+    def pool_path(self, distro, pkg, pkg_name):
+        """
+        Return the location in the pool of a distribution for
+        a package file, to be named pkg_name
+        """
+
+        control = self.control(pkg)
+        source = control.get('Source', control['Package']).split()[0]
+        prefix = source[:4] if source.startswith('lib') else source[0]
+
+        return (self.repo_dir / 'pool' / distro / 'main' / prefix / source /
+                pkg_name)
+
+    def component_dir(self, distro):
+        """
+        Return the directory holding a distribution's package indexes
+        """
+
+        return (self.repo_dir / 'dists' / distro / distro / 'main' /
+                f'binary-{self.architecture}')
+
+    def packages_index(self, distro):
+        """
+        Return the Packages index for all the packages in
+        a distribution's pool
+        """
+
+        stanzas = list()
+
+        for pkg in sorted((self.repo_dir / 'pool' / distro).rglob('*.deb')):
+            fields = self.control(pkg)
+            digests = self.hash_cache.get_digests(pkg, ('md5', 'sha1',
+                                                        'sha256'))
+            fields['Filename'] = pkg.relative_to(self.repo_dir).as_posix()
+            fields['Size'] = str(os.path.getsize(pkg))
+            fields['MD5sum'] = digests['md5']
+            fields['SHA1'] = digests['sha1']
+            fields['SHA256'] = digests['sha256']
+            stanzas.append(format_stanza(fields))
+
+        return '\n'.join(stanzas).encode()
+
+    def contents_index(self, distro):
+        """
+        Return the (gzipped) Contents index for all the packages in
+        a distribution's pool, mapping each installed file to the
+        packages providing it
+        """
+
+        locations = dict()
+
+        for pkg in sorted((self.repo_dir / 'pool' / distro).rglob('*.deb')):
+            control = self.control(pkg)
+            location = control['Package']
+
+            if control.get('Section'):
+                location = f'{control["Section"]}/{location}'
+
+            for path in self.hash_cache.get_metadata(pkg, 'deb-contents',
+                                                     read_contents):
+                locations.setdefault(path, set()).add(location)
+
+        contents = ''.join(
+            f'{path:<55} {",".join(sorted(packages))}\n'
+            for path, packages in sorted(locations.items())
+        )
+
+        return gzip.compress(contents.encode(), mtime=0)
+
+    @staticmethod
+    def write_file(filename, data):
+        """
+        Atomically write out an index file
+        """
+
+        with open(f'{filename}.tmp', 'wb') as fh:
+            fh.write(data)
+
+        os.replace(f'{filename}.tmp', filename)
+
+    def write_indexes(self, dist_dir, index_files):
+        """
+        Write out index files, given by their path relative to the
+        distribution directory, along with their by-hash copies; apt
+        fetches these by the strongest checksum in the Release file,
+        so there's a copy for every checksum listed
+        """
+
+        for relative_path, data in index_files.items():
+            filename = dist_dir / relative_path
+            os.makedirs(filename.parent, exist_ok=True)
+            self.write_file(filename, data)
+
+            if not self.by_hash:
+                continue
+
+            for field, algorithm in RELEASE_CHECKSUMS:
+                by_hash_dir = filename.parent / 'by-hash' / field
+                by_hash_file = \
+                    by_hash_dir / hashlib.new(algorithm, data).hexdigest()
+                os.makedirs(by_hash_dir, exist_ok=True)
+
+                if by_hash_file.exists():
+                    os.utime(by_hash_file)
+                else:
+                    self.write_file(by_hash_file, data)
+
+    @staticmethod
+    def prune_by_hash(dist_dir, index_files):
+        """
+        Remove the by-hash copies of superseded indexes once they're
+        past the retention period, keeping those of the current indexes
+        """
+
+        current = {hashlib.new(algorithm, data).hexdigest()
+                   for data in index_files.values()
+                   for _, algorithm in RELEASE_CHECKSUMS}
+        expiry = time.time() - BY_HASH_RETENTION
+
+        for by_hash_file in dist_dir.glob('**/by-hash/*/*'):
+            if by_hash_file.name not in current and \
+                    by_hash_file.stat().st_mtime < expiry:
+                by_hash_file.unlink()
+
+    @staticmethod
+    def checksum_lines(algorithm, index_files):
+        """
+        Return the Release file's checksum list for the index files
+        with the given hash algorithm
+        """
+
+        return ''.join(
+            f'\n {hashlib.new(algorithm, data).hexdigest()} '
+            f'{len(data):>16} {relative_path}'
+            for relative_path, data in index_files.items()
+        )
+
+    def sign_release(self, release_file):
+        """
+        Create the InRelease (clearsigned) and Release.gpg (detached)
+        signatures for a Release file
+        """
+
+        for signed_file, detach in (('InRelease', False),
+                                    ('Release.gpg', True)):
+            output = release_file.parent / signed_file
+
+            with open(release_file, 'rb') as fh:
+                signed_data = self.gpg.sign_file(
+                    fh, keyid=self.key, detach=detach, clearsign=not detach,
+                    output=str(output)
+                )
+
+            if signed_data.status != 'signature created':
+                raise RuntimeError(f'Unable to sign {release_file}')
+
+    def build(self, distro, release_fields, force=False):
+        """
+        Generate the indexes for a distribution; if the packages in
+        its pool are unchanged since the indexes were last built, the
+        existing (signed) files are kept unless forced.  Returns whether
+        the indexes were rebuilt
+        """
+
+        component_dir = self.component_dir(distro)
+        dist_dir = self.repo_dir / 'dists' / distro
+        packages = self.packages_index(distro)
+
+        try:
+            with open(component_dir / 'Packages', 'rb') as fh:
+                unchanged = fh.read() == packages
+        except FileNotFoundError:
+            unchanged = False
+
+        # Indexes for a changed configuration need to be built too
+        expected = [dist_dir / 'InRelease']
+
+        if self.contents:
+            expected.append(dist_dir / distro / 'main' /
+                            f'Contents-{self.architecture}.gz')
+
+        if self.by_hash:
+            expected.append(component_dir / 'by-hash')
+
+        if unchanged and not force and all(path.exists()
+                                           for path in expected):
+            print(f'    Debian repository {distro} is unchanged')
+            return False
+
+        print(f'    Writing indexes for Debian repository {distro}...')
+        os.makedirs(component_dir, exist_ok=True)
+
+        component = f'{distro}/main'
+        component_release = format_stanza(OrderedDict([
+            ('Origin', release_fields.get('Origin', '')),
+            ('Label', release_fields.get('Origin', '')),
+            ('Archive', distro),
+            ('Architecture', self.architecture),
+            ('Component', component),
+        ])).encode()
+        binary_dir = component_dir.relative_to(dist_dir).as_posix()
+        index_files = OrderedDict([
+            (f'{binary_dir}/Packages', packages),
+            (f'{binary_dir}/Packages.gz', gzip.compress(packages, mtime=0)),
+            (f'{binary_dir}/Packages.xz', lzma.compress(packages)),
+            (f'{binary_dir}/Release', component_release),
+        ])
+
+        if self.contents:
+            index_files[f'{component}/Contents-{self.architecture}.gz'] = \
+                self.contents_index(distro)
+
+        self.write_indexes(dist_dir, index_files)
+        self.prune_by_hash(dist_dir, index_files)
+
+        release = OrderedDict([
+            ('Origin', release_fields.get('Origin', '')),
+            ('Label', release_fields.get('Origin', '')),
+            ('Suite', release_fields.get('Suite', distro)),
+            ('Codename', release_fields.get('Codename', distro)),
+            ('Version', release_fields.get('Version', '')),
+            ('Date', time.strftime('%a, %d %b %Y %H:%M:%S UTC',
+                                   time.gmtime())),
+            ('Architectures', self.architecture),
+            ('Components', component),
+            ('Description', release_fields.get('Description', '')),
+        ])
+
+        if self.by_hash:
+            release['Acquire-By-Hash'] = 'yes'
+
+        for field, algorithm in RELEASE_CHECKSUMS:
+            release[field] = self.checksum_lines(algorithm, index_files)
+
+        release_file = dist_dir / 'Release'
+        self.write_file(release_file, format_stanza(release).encode())
+        self.sign_release(release_file)
+
+        return True
+
+    def add_indexes(self, dist_dir, index_files):
+        """
+        Add index files to an already published distribution (such as
+        the xz compressed indexes aptly doesn't produce), listing them
+        in its Release file (replacing any entries already there for
+        the same paths), which is then signed again
+        """
+
+        release_file = dist_dir / 'Release'
+
+        with open(release_file) as fh:
+            release = parse_control(fh.read())
+
+        self.write_indexes(dist_dir, index_files)
+
+        for field, algorithm in RELEASE_CHECKSUMS:
+            if field not in release:
+                continue
+
+            kept = ''.join(f'\n{line}'
+                           for line in release[field].splitlines()
+                           if line.strip() and
+                           line.split()[-1] not in index_files)
+            release[field] = \
+                kept + self.checksum_lines(algorithm, index_files)
+
+        self.write_file(release_file, format_stanza(release).encode())
+        self.sign_release(release_file)
@@ -0,0 +1,366 @@
+"""
+Resumable, segmented HTTP downloads, computing digests in transit
+
+Files are downloaded into a '.part' file next to their destination,
+with the progress of each segment recorded in a small JSON state file
+so an interrupted transfer can carry on where it stopped.  Large files
+on servers supporting range requests are fetched as several segments
+in parallel.  A download is only moved into place once its length and
+(when the server publishes one) its checksum have been verified; if
+the server ignores range requests, or the result fails verification,
+the file is downloaded once more from scratch as a single stream
+
+The MD5, SHA1 and SHA256 of each file are computed while the data is
+streamed to disk whenever it arrives in order, so callers can record
+them rather than reading the file again
+"""
+
+import concurrent.futures
+import hashlib
+import json
+import os
+import threading
+
+import requests
+import requests.adapters
+
+from repo_upload.hashcache import DIGESTS
+
+
+MB = 2 ** 20
+
+
+class RangeIgnoredError(RuntimeError):
+    """
+    The server answered a range request with something other than
+    the requested range
+    """
+
+
+class VerificationError(RuntimeError):
+    """
+    A completed download doesn't have the expected length or checksum
+    """
+
+
+class HashingWriter:
+    """
+    Wraps a file object, computing the digests of all data written
+    through it; it's deliberately not seekable so writers (like the
+    S3 transfer manager) deliver the data in order
+    """
+
+    def __init__(self, fh):
+        """
+        Wrap the given file object
+        """
+
+        self.fh = fh
+        self.hashes = {algorithm: hashlib.new(algorithm)
+                       for algorithm in DIGESTS}
+
+    def write(self, data):
+        """
+        Update the digests and write the data out
+        """
+
+        for hash_obj in self.hashes.values():
+            hash_obj.update(data)
+
+        return self.fh.write(data)
+
+    @staticmethod
+    def seekable():
+        """
+        Data must be written sequentially
+        """
+
+        return False
+
+    def digests(self):
+        """
+        Return the digests of the data written so far
+        """
+
+        return {algorithm: hash_obj.hexdigest()
+                for algorithm, hash_obj in self.hashes.items()}
+
+
+def file_digests(filename):
+    """
+    Generate all the supported digests for a file in a single pass
+    """
+
+    writer = HashingWriter(open(os.devnull, 'wb'))
+
+    with open(filename, 'rb') as fh, writer.fh:
+        for chunk in iter(lambda: fh.read(MB), b''):
+            writer.write(chunk)
+
+    return writer.digests()
+
+
+class HttpDownloader:
+    """
+    Downloads files over a pooled HTTP session
+    """
+
+    chunk_size = MB
+    state_interval = 16 * MB
+    checksum_suffixes = ['sha256', 'md5']
+
+    def __init__(self, workers=4, segments=4, segment_threshold=64 * MB):
+        """
+        Create the session, sizing its connection pool to allow every
+        segment of every concurrent download its own connection
+        """
+
+        self.segments = max(segments, 1)
+        self.segment_threshold = segment_threshold
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=workers, pool_maxsize=workers * self.segments
+        )
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def probe(self, url):
+        """
+        Return the status, length, validator and range support for
+        a remote file
+        """
+
+        req = self.session.head(url, allow_redirects=True)
+        length = req.headers.get('Content-Length')
+        validator = req.headers.get('ETag', req.headers.get('Last-Modified'))
+        ranges = req.headers.get('Accept-Ranges') == 'bytes'
+
+        return (req.status_code, int(length) if length else None, validator,
+                ranges)
+
+    def expected_checksum(self, url):
+        """
+        Look for a checksum file published alongside the remote file,
+        returning the algorithm and digest, or None if there isn't one
+        """
+
+        for algorithm in self.checksum_suffixes:
+            req = self.session.get(f'{url}.{algorithm}')
+
+            if req.status_code == 200 and req.text.split():
+                return algorithm, req.text.split()[0].lower()
+
+        return None
+
+    def plan_segments(self, length, ranges):
+        """
+        Split the file into segments of [start, end, bytes done]; only
+        a single segment is used for small files, files of unknown
+        length or when the server doesn't support range requests
+        """
+
+        if length is None or not ranges or length < self.segment_threshold:
+            return [[0, length, 0]]
+
+        size = -(-length // self.segments)
+
+        return [[start, min(start + size, length), 0]
+                for start in range(0, length, size)]
+
+    @staticmethod
+    def load_state(state_file, length, validator):
+        """
+        Read the saved segment progress, provided the partial download
+        belongs to the same version of the remote file
+        """
+
+        try:
+            with open(state_file) as fh:
+                state = json.load(fh)
+        except (OSError, ValueError):
+            return None
+
+        if state['length'] != length or state['validator'] != validator:
+            return None
+
+        return state
+
+    @staticmethod
+    def save_state(state_file, state):
+        """
+        Atomically write out the segment progress
+        """
+
+        with open(f'{state_file}.tmp', 'w') as fh:
+            json.dump(state, fh)
+
+        os.replace(f'{state_file}.tmp', state_file)
+
+    def fetch_segment(self, url, part_file, segment, ranges, progress,
+                      writer_class=None):
+        """
+        Download the remaining bytes of a single segment, writing
+        them into place in the partial file and periodically saving
+        the progress made; returns the writer used, allowing the
+        caller to collect any digests it computed
+        """
+
+        start, end, done = segment
+        headers = dict()
+
+        if ranges and (done or end is not None):
+            last = '' if end is None else end - 1
+            headers['Range'] = f'bytes={start + done}-{last}'
+
+        if end is not None and start + done >= end:
+            return None
+
+        with self.session.get(url, headers=headers, stream=True) as req:
+            # A full response to a range request would be written at
+            # the segment's offset, corrupting the file
+            if 'Range' in headers and req.status_code != 206:
+                raise RangeIgnoredError(
+                    f'Status {req.status_code} for range request of {url}'
+                )
+
+            if req.status_code not in (200, 206):
+                raise RuntimeError(
+                    f'Unexpected status {req.status_code} fetching {url}'
+                )
+
+            # Progress is only recorded once the data has been flushed,
+            # so a resumed download never skips bytes not yet written
+            with open(part_file, 'r+b') as fh:
+                fh.seek(start + done)
+                writer = fh if writer_class is None else writer_class(fh)
+                unsaved = 0
+
+                for chunk in req.iter_content(self.chunk_size):
+                    writer.write(chunk)
+                    unsaved += len(chunk)
+
+                    if unsaved >= self.state_interval:
+                        fh.flush()
+                        segment[2] += unsaved
+                        progress()
+                        unsaved = 0
+
+            segment[2] += unsaved
+
+        progress()
+
+        return writer
+
+    def download(self, url, dest):
+        """
+        Download a file to the given destination, resuming any earlier
+        partial download; returns the digests of the file, or None if
+        the remote file doesn't exist, and raises a RuntimeError if the
+        result can't be verified even once downloaded again
+        """
+
+        status, length, validator, ranges = self.probe(url)
+
+        if status != 200:
+            return None
+
+        try:
+            return self.fetch(url, dest, length, validator, ranges)
+        except RangeIgnoredError as exc:
+            print(f'    {exc}, downloading {dest} as a single stream...')
+        except VerificationError as exc:
+            print(f'    {exc}, downloading {dest} again...')
+
+        return self.fetch(url, dest, length, validator, False)
+
+    def fetch(self, url, dest, length, validator, ranges):
+        """
+        Download a file known to exist, in segments if ranges are
+        supported, resuming any earlier partial download; returns the
+        digests of the file
+        """
+
+        part_file = f'{dest}.part'
+        state_file = f'{dest}.part.json'
+        state = None
+
+        # Without range support a partial download can't be resumed
+        if ranges and os.path.exists(part_file):
+            state = self.load_state(state_file, length, validator)
+
+        if state is None:
+            state = {
+                'length': length,
+                'validator': validator,
+                'segments': self.plan_segments(length, ranges),
+            }
+
+            with open(part_file, 'wb') as fh:
+                if length is not None:
+                    fh.truncate(length)
+        else:
+            print(f'    Resuming partial download of {dest}...')
+
+        lock = threading.Lock()
+
+        def progress():
+            with lock:
+                self.save_state(state_file, state)
+
+        progress()
+
+        # Digests can only be computed in transit when the whole file
+        # arrives as one in-order stream
+        segments = state['segments']
+        in_order = len(segments) == 1 and segments[0][2] == 0
+
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=len(segments)) as executor:
+            futures = [
+                executor.submit(self.fetch_segment, url, part_file, segment,
+                                ranges, progress,
+                                HashingWriter if in_order else None)
+                for segment in segments
+            ]
+            writers = [future.result() for future in futures]
+
+        digests = writers[0].digests() if in_order else None
+        digests = self.verify(url, part_file, state_file, length, digests)
+        os.replace(part_file, dest)
+        os.remove(state_file)
+
+        return digests
+
+    def verify(self, url, part_file, state_file, length, digests=None):
+        """
+        Check the length and checksum of a completed download; on
+        a mismatch the partial download is discarded so the next
+        attempt starts afresh.  The digests of the file are returned,
+        being computed here if they weren't already during transfer
+        """
+
+        checksum = self.expected_checksum(url)
+        error = None
+
+        if length is not None and os.path.getsize(part_file) != length:
+            error = (f'expected {length} bytes, got '
+                     f'{os.path.getsize(part_file)}')
+        else:
+            if digests is None:
+                digests = file_digests(part_file)
+
+            if checksum is not None:
+                algorithm, expected = checksum
+
+                if digests[algorithm] != expected:
+                    error = (f'{algorithm} mismatch ({digests[algorithm]} '
+                             f'!= {expected})')
+
+        if error is not None:
+            for filename in (part_file, state_file):
+                os.remove(filename)
+
+            raise VerificationError(f'Download of {url} failed '
+                                    f'verification: {error}')
+
+        return digests
@@ -0,0 +1,217 @@
+"""
+Persistent cache of file digests
+
+Digests are stored in a SQLite database keyed on the file's path and
+identity (size, modification time and inode), so unchanged files never
+need to be read again; any change to the file changes its identity and
+causes the digest to be recomputed.  SQLite's locking allows the cache
+to be shared between concurrent runs (repository types and editions)
+
+Digests computed elsewhere (for instance while downloading a file) can
+be recorded directly, and a file found under a new path with the same
+identity (a hard link or a rename) reuses the digests already known
+
+Other data derived from a file's content (such as its parsed package
+headers) can be cached the same way, stored as JSON
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+
+
+DIGESTS = ('md5', 'sha1', 'sha256')
+
+
+class HashCache:
+    """
+    Maintains file digests for any of the hashlib algorithms,
+    computing only those not already known for a file
+    """
+
+    def __init__(self, db_file):
+        """
+        Open (creating if needed) the cache database
+        """
+
+        os.makedirs(os.path.dirname(db_file), exist_ok=True)
+
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(str(db_file), timeout=60,
+                                  isolation_level=None,
+                                  check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS digests ('
+            '  path TEXT, algorithm TEXT, size INTEGER, mtime_ns INTEGER,'
+            '  inode INTEGER, digest TEXT,'
+            '  PRIMARY KEY (path, algorithm))'
+        )
+        self.db.execute(
+            'CREATE INDEX IF NOT EXISTS digests_identity '
+            'ON digests (inode, size, mtime_ns)'
+        )
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS metadata ('
+            '  path TEXT, kind TEXT, size INTEGER, mtime_ns INTEGER,'
+            '  inode INTEGER, data TEXT,'
+            '  PRIMARY KEY (path, kind))'
+        )
+        self.db.execute(
+            'CREATE INDEX IF NOT EXISTS metadata_identity '
+            'ON metadata (inode, size, mtime_ns)'
+        )
+
+    @staticmethod
+    def identity(filename):
+        """
+        Return the values identifying the current content of a file
+        """
+
+        stat = os.stat(filename)
+
+        return stat.st_size, stat.st_mtime_ns, stat.st_ino
+
+    def lookup(self, path, identity):
+        """
+        Return all the known digests for a file with the given identity
+        """
+
+        with self.lock:
+            rows = self.db.execute(
+                'SELECT algorithm, digest FROM digests WHERE path = ? '
+                'AND size = ? AND mtime_ns = ? AND inode = ?',
+                (path, *identity)
+            ).fetchall()
+
+            if rows:
+                return dict(rows)
+
+            # Not known under this path, but may be under another one
+            rows = self.db.execute(
+                'SELECT algorithm, digest FROM digests WHERE size = ? '
+                'AND mtime_ns = ? AND inode = ?', identity
+            ).fetchall()
+
+        digests = dict(rows)
+
+        if digests:
+            self.store(path, identity, digests)
+
+        return digests
+
+    def store(self, path, identity, digests):
+        """
+        Save the digests for a file with the given identity
+        """
+
+        with self.lock:
+            self.db.executemany(
+                'INSERT OR REPLACE INTO digests VALUES (?, ?, ?, ?, ?, ?)',
+                [(path, algorithm, *identity, digest)
+                 for algorithm, digest in digests.items()]
+            )
+
+    def get_digests(self, filename, algorithms=('md5',)):
+        """
+        Return a dictionary of the requested digests for a file; any
+        digests which aren't cached are computed in a single pass over
+        the file and stored, provided the file didn't change meanwhile
+        """
+
+        path = os.path.abspath(filename)
+        identity = self.identity(path)
+        digests = self.lookup(path, identity)
+        missing = [algo for algo in algorithms if algo not in digests]
+
+        if missing:
+            hashes = {algo: hashlib.new(algo) for algo in missing}
+
+            with open(path, 'rb') as fh:
+                for chunk in iter(lambda: fh.read(2 ** 20), b''):
+                    for hash_obj in hashes.values():
+                        hash_obj.update(chunk)
+
+            computed = {algo: hash_obj.hexdigest()
+                        for algo, hash_obj in hashes.items()}
+
+            if self.identity(path) == identity:
+                self.store(path, identity, computed)
+
+            digests.update(computed)
+
+        return {algo: digests[algo] for algo in algorithms}
+
+    def record(self, filename, digests):
+        """
+        Save digests computed elsewhere for a file's current content
+        """
+
+        path = os.path.abspath(filename)
+        self.store(path, self.identity(path), digests)
+
+    def record_copy(self, src, dst):
+        """
+        Save for a copy of a file any digests known for the original
+        """
+
+        src = os.path.abspath(src)
+        digests = self.lookup(src, self.identity(src))
+
+        if digests:
+            self.record(dst, digests)
+
+    def get_md5(self, filename):
+        """
+        Return the MD5 for a given file
+        """
+
+        return self.get_digests(filename)['md5']
+
+    def get_metadata(self, filename, kind, loader):
+        """
+        Return data of a given kind derived from a file's content; if
+        it isn't cached for the file's current identity, it's generated
+        by calling loader with the filename (the result must be JSON
+        serializable) and stored
+        """
+
+        path = os.path.abspath(filename)
+        identity = self.identity(path)
+
+        with self.lock:
+            row = self.db.execute(
+                'SELECT data FROM metadata WHERE kind = ? AND path = ? '
+                'AND size = ? AND mtime_ns = ? AND inode = ?',
+                (kind, path, *identity)
+            ).fetchone()
+
+            # Not known under this path, but may be under another one
+            if row is None:
+                row = self.db.execute(
+                    'SELECT data FROM metadata WHERE kind = ? AND size = ? '
+                    'AND mtime_ns = ? AND inode = ?', (kind, *identity)
+                ).fetchone()
+                found = False
+            else:
+                found = True
+
+        if row is not None:
+            data = json.loads(row[0])
+        else:
+            data = loader(path)
+
+            if self.identity(path) != identity:
+                return data
+
+        if not found:
+            with self.lock:
+                self.db.execute(
+                    'INSERT OR REPLACE INTO metadata '
+                    'VALUES (?, ?, ?, ?, ?, ?)',
+                    (path, kind, *identity, json.dumps(data))
+                )
+
+        return data
@@ -0,0 +1,202 @@
+"""
+Remote inventory of the objects stored under a prefix in S3
+
+Rather than issuing a HEAD request for every file being synchronized,
+the whole destination prefix is listed once and combined with a small
+sidecar index object which maps each path to the MD5 of its content
+(and the headers last applied to it), allowing the local tree to be
+compared against S3 entirely in memory
+
+The ETag of an object uploaded in a single part is only its MD5 when
+it's encrypted with S3 managed keys (or not at all), so for a bucket
+encrypted with KMS keys by default the MD5 is read from the object's
+metadata instead.  Objects encrypted otherwise by other tools (with
+customer provided keys, or KMS keys given per object) aren't detected
+from the listing, and are uploaded again until they're indexed
+"""
+
+import json
+import threading
+
+import botocore.exceptions
+
+
+# Default bucket encryption for which ETags aren't MD5s
+KMS_ALGORITHMS = {'aws:kms', 'aws:kms:dsse'}
+
+
+class RemoteInventory:
+    """
+    Maintains the known objects and their MD5 sums for one prefix
+    in an S3 bucket, along with the sidecar index backing it
+    """
+
+    def __init__(self, s3_client, bucket, prefix, index_key):
+        """
+        Set up the inventory for the given prefix; the index object
+        is stored separately at index_key
+        """
+
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.prefix = prefix.rstrip('/') + '/'
+        self.index_key = index_key
+        self.etags = dict()
+        self.index = dict()
+        self.dirty = False
+        self.etags_are_md5 = True
+        self.lock = threading.Lock()
+
+    def list_objects(self):
+        """
+        Generator returning the key and ETag of every object under
+        the prefix, using paginated listing requests
+        """
+
+        paginator = self.s3_client.get_paginator('list_objects_v2')
+
+        for page in paginator.paginate(Bucket=self.bucket,
+                                       Prefix=self.prefix):
+            for obj in page.get('Contents', []):
+                yield obj['Key'], obj['ETag'].strip('"')
+
+    def check_encryption(self):
+        """
+        Determine if the ETags of objects uploaded in a single part are
+        their MD5, from the bucket's default encryption; if that can't
+        be read, they aren't trusted
+        """
+
+        try:
+            conf = self.s3_client.get_bucket_encryption(Bucket=self.bucket)
+        except botocore.exceptions.ClientError as exc:
+            code = exc.response.get('Error', {}).get('Code')
+
+            return code == 'ServerSideEncryptionConfigurationNotFoundError'
+
+        return not any(
+            rule.get('ApplyServerSideEncryptionByDefault', {})
+            .get('SSEAlgorithm') in KMS_ALGORITHMS
+            for rule in conf['ServerSideEncryptionConfiguration']['Rules']
+        )
+
+    def load(self):
+        """
+        List the prefix and read in the sidecar index, if one exists
+        """
+
+        print(f'Listing s3://{self.bucket}/{self.prefix}...')
+        self.etags = dict(self.list_objects())
+        self.etags_are_md5 = self.check_encryption()
+
+        if not self.etags_are_md5:
+            print(f'  ETags in {self.bucket} may not be MD5s, using '
+                  f'object metadata for unindexed objects')
+
+        try:
+            obj = self.s3_client.get_object(Bucket=self.bucket,
+                                            Key=self.index_key)
+        except botocore.exceptions.ClientError:
+            print(f'  No index found at {self.index_key}, starting afresh')
+            self.index = dict()
+        else:
+            self.index = json.loads(obj['Body'].read())['files']
+
+        print(f'  Found {len(self.etags)} objects, '
+              f'{len(self.index)} indexed')
+
+        return self
+
+    def md5(self, key):
+        """
+        Return the MD5 of the object at the given key, or None if it
+        doesn't exist (or its content is unknown)
+
+        Index entries are only trusted while the object's ETag still
+        matches the one recorded with them; objects uploaded in one
+        part (and not encrypted with KMS keys) have their MD5 as the
+        ETag, otherwise a single HEAD request is used as a last resort
+        and the result indexed
+        """
+
+        etag = self.etags.get(key)
+
+        if etag is None:
+            return None
+
+        rel_path = key[len(self.prefix):]
+        entry = self.index.get(rel_path)
+
+        if entry is not None and entry[1] == etag:
+            return entry[0]
+
+        if '-' not in etag and self.etags_are_md5:
+            md5 = etag
+        else:
+            try:
+                obj = self.s3_client.head_object(Bucket=self.bucket, Key=key)
+            except botocore.exceptions.ClientError:
+                return None
+
+            md5 = obj['Metadata'].get('md5')
+
+        if md5 is not None:
+            with self.lock:
+                self.index[rel_path] = [md5, etag]
+                self.dirty = True
+
+        return md5
+
+    def headers(self, key):
+        """
+        Return the headers last applied to the object at the given key,
+        or None if they aren't known
+        """
+
+        entry = self.index.get(key[len(self.prefix):])
+
+        if entry is None or len(entry) < 3 or \
+                entry[1] != self.etags.get(key):
+            return None
+
+        return entry[2]
+
+    def record(self, key, md5, headers=None):
+        """
+        Note the MD5 (and the headers applied) of a newly uploaded
+        object; its ETag is filled in when the index is saved
+        """
+
+        entry = [md5, None] if headers is None else [md5, None, headers]
+
+        with self.lock:
+            self.index[key[len(self.prefix):]] = entry
+            self.dirty = True
+
+    def save(self):
+        """
+        Write the index back to S3 if anything changed; the prefix is
+        listed again to pick up the ETags of newly uploaded objects,
+        and entries for objects which no longer exist are dropped
+        """
+
+        if not self.dirty:
+            return
+
+        self.etags = dict(self.list_objects())
+        files = dict()
+
+        for rel_path, (md5, etag, *headers) in self.index.items():
+            curr_etag = self.etags.get(self.prefix + rel_path)
+
+            if curr_etag is not None and etag in (None, curr_etag):
+                files[rel_path] = [md5, curr_etag] + headers
+
+        self.index = files
+        self.s3_client.put_object(
+            Bucket=self.bucket, Key=self.index_key,
+            Body=json.dumps({'version': 1, 'files': files},
+                            separators=(',', ':'), sort_keys=True),
+            ContentType='application/json'
+        )
+        self.dirty = False
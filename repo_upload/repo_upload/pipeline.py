@@ -0,0 +1,93 @@
+"""
+Uploads package files to S3 while the repositories are still being built
+
+Files are queued for upload as soon as they are placed into a local
+repository, so the transfers overlap the rest of the import and the
+publishing of the repository; the final upload of the repository then
+only needs to send what the pipeline hasn't already, along with the
+indexes, which always go last.  If the run fails, uploads not yet
+started are cancelled
+"""
+
+import concurrent.futures
+import os
+import threading
+
+
+class UploadPipeline:
+    """
+    Background uploads for the files in one local directory tree,
+    sharing the remote inventory with the final upload of the tree
+    """
+
+    def __init__(self, repo, base_dir, rel_base_dir):
+        """
+        Start uploading files from base_dir to rel_base_dir (under the
+        repository's S3 base path) as they're submitted
+        """
+
+        self.repo = repo
+        self.base_dir = str(base_dir)
+        self.rel_base_dir = rel_base_dir
+        self.inventory = repo.load_inventory(rel_base_dir)
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=repo.upload_workers
+        )
+        self.lock = threading.Lock()
+        self.futures = dict()
+
+    def matches(self, base_dir, rel_base_dir):
+        """
+        Determine if the pipeline is for the given directory tree
+        """
+
+        return (str(base_dir), rel_base_dir) == \
+            (self.base_dir, self.rel_base_dir)
+
+    def submit(self, local_path):
+        """
+        Queue a file for upload, if it's within the pipeline's tree
+        """
+
+        relative_path = os.path.relpath(local_path, self.base_dir)
+
+        if relative_path.startswith(os.pardir):
+            return
+
+        s3_path = os.path.join(self.repo.s3_package_base, self.rel_base_dir,
+                               relative_path)
+
+        with self.lock:
+            self.futures[s3_path] = self.executor.submit(
+                self.repo.s3_sync_file, str(local_path), s3_path,
+                self.inventory
+            )
+
+    def finish(self):
+        """
+        Wait for all queued uploads to complete, returning the inventory
+        and the outcome for each file
+        """
+
+        self.executor.shutdown(wait=True)
+        results = dict()
+
+        for s3_path, future in self.futures.items():
+            try:
+                results[s3_path] = future.result()
+            except Exception as exc:
+                results[s3_path] = f'failed: {exc}'
+
+        return self.inventory, results
+
+    def cancel(self):
+        """
+        Stop the pipeline as the run is failing: queued uploads are
+        cancelled and those already running are waited for
+        """
+
+        with self.lock:
+            for future in self.futures.values():
+                future.cancel()
+
+        self.executor.shutdown(wait=True)
@@ -0,0 +1,358 @@
+"""
+Content-addressed cache for package files
+
+Packages are stored once under the SHA256 of their content, with an
+index mapping each package name (and the edition, version and OS
+version it belongs to) to its content.  The cache can be shared by
+all repository types and editions, and is kept within a disk budget
+by evicting the least recently used content
+
+Content derived from a cached package (such as a signed copy) can be
+stored as well, indexed by the content it was derived from, and the
+location of any S3 object known to hold given content is recorded so
+it can be copied within S3 instead of being uploaded again
+
+Cached content is placed into repositories as a hard link or, failing
+that, a copy-on-write clone where the filesystem allows it, so only
+content crossing filesystems is actually copied
+"""
+
+import fcntl
+import os
+import shutil
+import sqlite3
+import threading
+import time
+
+from pathlib import Path
+
+from repo_upload.hashcache import DIGESTS
+
+
+GB = 2 ** 30
+
+# ioctl request cloning a whole file (as done by 'cp --reflink')
+FICLONE = 0x40049409
+
+
+def clone_file(src, dst):
+    """
+    Create dst as a copy-on-write clone of src, which only works
+    on filesystems supporting reflinks (such as Btrfs and XFS)
+    """
+
+    with open(src, 'rb') as src_fh, open(dst, 'wb') as dst_fh:
+        fcntl.ioctl(dst_fh.fileno(), FICLONE, src_fh.fileno())
+
+
+def place_file(src, dst, link=True):
+    """
+    Put a copy of src at dst, replacing any file already there,
+    returning the method used: a hard link (unless link is false,
+    when the copy must be independent of the original), a reflink
+    or, if neither is possible, a full copy.  The file is replaced
+    atomically, so any existing file sharing its content with a
+    cached package is never written to
+    """
+
+    # Already linked (by an earlier run, say); renaming a link over
+    # another to the same file would do nothing anyway
+    if link and os.path.exists(dst) and os.path.samefile(src, dst):
+        return 'linked'
+
+    tmp_file = f'{dst}.tmp'
+
+    if os.path.lexists(tmp_file):
+        os.remove(tmp_file)
+
+    method = None
+
+    if link:
+        try:
+            os.link(src, tmp_file)
+            method = 'linked'
+        except OSError:
+            pass
+
+    if method is None:
+        try:
+            clone_file(src, tmp_file)
+            method = 'cloned'
+        except OSError:
+            shutil.copyfile(src, tmp_file)
+            method = 'copied'
+
+    os.replace(tmp_file, dst)
+
+    return method
+
+
+class PackageCache:
+    """
+    Manages the package files stored in the cache along with
+    the index describing them
+    """
+
+    # Content used this recently may belong to a concurrent run,
+    # so is never evicted
+    grace_period = 3600
+
+    def __init__(self, root, max_size, hash_cache):
+        """
+        Open (creating if needed) the cache at the given location;
+        max_size is the disk budget in bytes
+        """
+
+        self.root = Path(root)
+        self.blob_dir = self.root / 'blobs'
+        self.staging_dir = self.root / 'staging'
+        self.max_size = max_size
+        self.hash_cache = hash_cache
+        self.pinned = set()
+
+        for cache_dir in (self.blob_dir, self.staging_dir):
+            os.makedirs(cache_dir, exist_ok=True)
+
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(str(self.root / 'index.db'), timeout=60,
+                                  isolation_level=None,
+                                  check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS blobs ('
+            '  digest TEXT PRIMARY KEY, size INTEGER, last_used REAL)'
+        )
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS packages ('
+            '  pkg_name TEXT PRIMARY KEY, edition TEXT, version TEXT,'
+            '  os_version TEXT, digest TEXT)'
+        )
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS derived ('
+            '  source TEXT, kind TEXT, digest TEXT,'
+            '  PRIMARY KEY (source, kind))'
+        )
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS s3_objects ('
+            '  md5 TEXT, bucket TEXT, key TEXT,'
+            '  PRIMARY KEY (md5, bucket))'
+        )
+
+    def blob_path(self, digest):
+        """
+        Return the location of the content with the given digest
+        """
+
+        return self.blob_dir / digest[:2] / digest
+
+    def staging_path(self, pkg_name):
+        """
+        Return the location a package should be downloaded to before
+        being added to the cache
+        """
+
+        return self.staging_dir / pkg_name
+
+    def touch(self, digest):
+        """
+        Mark content as in use by this run
+        """
+
+        self.pinned.add(digest)
+        self.db.execute('UPDATE blobs SET last_used = ? WHERE digest = ?',
+                        (time.time(), digest))
+
+    def lookup(self, pkg_name):
+        """
+        Return the path to the cached content for a package, or None
+        if it isn't in the cache
+        """
+
+        with self.lock:
+            row = self.db.execute(
+                'SELECT digest FROM packages WHERE pkg_name = ?', (pkg_name,)
+            ).fetchone()
+
+            if row is None:
+                return None
+
+            blob = self.blob_path(row[0])
+
+            if not blob.exists():
+                self.db.execute('DELETE FROM packages WHERE pkg_name = ?',
+                                (pkg_name,))
+                return None
+
+            self.touch(row[0])
+
+        return blob
+
+    def store_blob(self, filename, digests=None):
+        """
+        Move a file into the content store, returning its digest; the
+        stored content is made read-only as it may be shared.  Digests
+        already computed for the file are recorded for the stored
+        content, otherwise they are generated here
+        """
+
+        if digests is None:
+            digests = self.hash_cache.get_digests(filename, DIGESTS)
+
+        digest = digests['sha256']
+        blob = self.blob_path(digest)
+        os.makedirs(blob.parent, exist_ok=True)
+
+        with self.lock:
+            if blob.exists():
+                os.remove(filename)
+            else:
+                os.chmod(filename, 0o444)
+                os.replace(filename, blob)
+                self.hash_cache.record(blob, digests)
+
+            self.db.execute(
+                'INSERT OR IGNORE INTO blobs VALUES (?, ?, ?)',
+                (digest, blob.stat().st_size, time.time())
+            )
+            self.touch(digest)
+
+        return digest
+
+    def add(self, pkg_name, edition, version, os_version, filename,
+            digests=None):
+        """
+        Add a downloaded package to the cache, returning the path
+        to its cached content
+        """
+
+        digest = self.store_blob(filename, digests)
+
+        with self.lock:
+            self.db.execute(
+                'INSERT OR REPLACE INTO packages VALUES (?, ?, ?, ?, ?)',
+                (pkg_name, edition, version, os_version, digest)
+            )
+
+        self.evict()
+
+        return self.blob_path(digest)
+
+    def lookup_derived(self, source, kind):
+        """
+        Return the path to content of a given kind derived from the
+        content with the source digest, or None if there is none
+        """
+
+        with self.lock:
+            row = self.db.execute(
+                'SELECT digest FROM derived WHERE source = ? AND kind = ?',
+                (source, kind)
+            ).fetchone()
+
+            if row is None or not self.blob_path(row[0]).exists():
+                return None
+
+            self.touch(row[0])
+
+        return self.blob_path(row[0])
+
+    def add_derived(self, source, kind, filename, digests=None):
+        """
+        Add content of a given kind derived from the content with the
+        source digest, returning the path to the cached content
+        """
+
+        digest = self.store_blob(filename, digests)
+
+        with self.lock:
+            self.db.execute(
+                'INSERT OR REPLACE INTO derived VALUES (?, ?, ?)',
+                (source, kind, digest)
+            )
+
+        self.evict()
+
+        return self.blob_path(digest)
+
+    def add_s3_object(self, md5, bucket, key):
+        """
+        Record an S3 object as holding the content with the given MD5;
+        any content recorded for the same object earlier is forgotten,
+        as it has been overwritten
+        """
+
+        with self.lock:
+            self.db.execute(
+                'DELETE FROM s3_objects WHERE bucket = ? AND key = ?',
+                (bucket, key)
+            )
+            self.db.execute(
+                'INSERT OR REPLACE INTO s3_objects VALUES (?, ?, ?)',
+                (md5, bucket, key)
+            )
+
+    def lookup_s3_object(self, md5, bucket):
+        """
+        Return the key of an object in the bucket last known to hold
+        the content with the given MD5, or None if there is none
+        """
+
+        with self.lock:
+            row = self.db.execute(
+                'SELECT key FROM s3_objects WHERE md5 = ? AND bucket = ?',
+                (md5, bucket)
+            ).fetchone()
+
+        return None if row is None else row[0]
+
+    def remove_s3_object(self, md5, bucket):
+        """
+        Forget the object recorded for the content with the given MD5
+        """
+
+        with self.lock:
+            self.db.execute(
+                'DELETE FROM s3_objects WHERE md5 = ? AND bucket = ?',
+                (md5, bucket)
+            )
+
+    def evict(self):
+        """
+        Remove the least recently used content until the cache fits
+        within its budget, never touching content in use
+        """
+
+        with self.lock:
+            total = self.db.execute(
+                'SELECT COALESCE(SUM(size), 0) FROM blobs'
+            ).fetchone()[0]
+
+            if total <= self.max_size:
+                return
+
+            candidates = self.db.execute(
+                'SELECT digest, size FROM blobs WHERE last_used < ? '
+                'ORDER BY last_used', (time.time() - self.grace_period,)
+            ).fetchall()
+
+            for digest, size in candidates:
+                if total <= self.max_size:
+                    break
+
+                if digest in self.pinned:
+                    continue
+
+                print(f'Evicting {digest} ({size} bytes) from package cache')
+
+                try:
+                    os.remove(self.blob_path(digest))
+                except FileNotFoundError:
+                    pass
+
+                self.db.execute('DELETE FROM packages WHERE digest = ?',
+                                (digest,))
+                self.db.execute('DELETE FROM derived WHERE digest = ?',
+                                (digest,))
+                self.db.execute('DELETE FROM blobs WHERE digest = ?',
+                                (digest,))
+                total -= size
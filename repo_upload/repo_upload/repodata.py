@@ -0,0 +1,852 @@
+"""
+Generates Yum repository metadata from RPM package headers
+
+Writes the primary, filelists and other metadata (gzipped) along with
+repomd.xml, in the same form as createrepo, in a single streaming pass
+over the packages using their (cached) headers, so package payloads
+are never read
+
+The sqlite databases yum would otherwise build from the XML on every
+client can be generated in the same pass (in createrepo's schema), and
+zchunk compressed copies of the XML written with the zck tool, letting
+dnf download only the parts of the metadata which changed; the
+prestodelta metadata lists any deltarpms between packages
+
+Generated metadata is cached keyed on the set of packages it describes,
+so an unchanged repository, or another one with the same packages,
+reuses it rather than generating it again
+"""
+
+import bz2
+import gzip
+import hashlib
+import itertools
+import json
+import os
+import re
+import shutil
+import sqlite3
+import stat
+import subprocess
+import time
+
+from collections import namedtuple
+from xml.sax.saxutils import escape, quoteattr
+
+from repo_upload import rpmheader as rh
+
+
+Package = namedtuple('Package', ['href', 'path', 'sha256'])
+Delta = namedtuple('Delta', ['href', 'path', 'sha256', 'sequence', 'old',
+                             'new'])
+
+METADATA_TYPES = (
+    ('primary', 'metadata', 'http://linux.duke.edu/metadata/common'),
+    ('filelists', 'filelists', 'http://linux.duke.edu/metadata/filelists'),
+    ('other', 'otherdata', 'http://linux.duke.edu/metadata/other'),
+)
+RPM_NS = 'http://linux.duke.edu/metadata/rpm'
+
+# Dependency flags, as defined by rpm
+SENSE_LESS = 2
+SENSE_GREATER = 4
+SENSE_EQUAL = 8
+SENSE_PREREQ = 64
+SENSE_SCRIPT_PRE = 512
+SENSE_SCRIPT_POST = 1024
+COMPARISONS = {
+    SENSE_LESS: 'LT', SENSE_GREATER: 'GT', SENSE_EQUAL: 'EQ',
+    SENSE_LESS | SENSE_EQUAL: 'LE', SENSE_GREATER | SENSE_EQUAL: 'GE',
+}
+FILE_GHOST = 64
+
+# Files listed in the primary metadata as well as in the filelists
+PRIMARY_FILE_PREFIXES = ('/etc/', '/usr/lib/sendmail')
+
+# Version of createrepo's database schema, as recorded in repomd.xml
+DATABASE_VERSION = 10
+
+DEPENDENCY_TABLES = ('requires', 'provides', 'conflicts', 'obsoletes')
+DATABASE_SCHEMAS = {
+    'primary': """
+        CREATE TABLE db_info (dbversion INTEGER, checksum TEXT);
+        CREATE TABLE packages (
+            pkgKey INTEGER PRIMARY KEY, pkgId TEXT, name TEXT, arch TEXT,
+            version TEXT, epoch TEXT, release TEXT, summary TEXT,
+            description TEXT, url TEXT, time_file INTEGER,
+            time_build INTEGER, rpm_license TEXT, rpm_vendor TEXT,
+            rpm_group TEXT, rpm_buildhost TEXT, rpm_sourcerpm TEXT,
+            rpm_header_start INTEGER, rpm_header_end INTEGER,
+            rpm_packager TEXT, size_package INTEGER,
+            size_installed INTEGER, size_archive INTEGER,
+            location_href TEXT, location_base TEXT, checksum_type TEXT);
+        CREATE TABLE files (name TEXT, type TEXT, pkgKey INTEGER);
+        CREATE TABLE requires (
+            name TEXT, flags TEXT, epoch TEXT, version TEXT, release TEXT,
+            pkgKey INTEGER, pre BOOLEAN DEFAULT FALSE);
+        CREATE TABLE provides (
+            name TEXT, flags TEXT, epoch TEXT, version TEXT, release TEXT,
+            pkgKey INTEGER);
+        CREATE TABLE conflicts (
+            name TEXT, flags TEXT, epoch TEXT, version TEXT, release TEXT,
+            pkgKey INTEGER);
+        CREATE TABLE obsoletes (
+            name TEXT, flags TEXT, epoch TEXT, version TEXT, release TEXT,
+            pkgKey INTEGER);
+        CREATE INDEX packagename ON packages (name);
+        CREATE INDEX packageId ON packages (pkgId);
+        CREATE INDEX filenames ON files (name);
+        CREATE INDEX pkgfiles ON files (pkgKey);
+        CREATE INDEX pkgrequires ON requires (pkgKey);
+        CREATE INDEX requiresname ON requires (name);
+        CREATE INDEX pkgprovides ON provides (pkgKey);
+        CREATE INDEX providesname ON provides (name);
+        CREATE INDEX pkgconflicts ON conflicts (pkgKey);
+        CREATE INDEX pkgobsoletes ON obsoletes (pkgKey);
+        CREATE TRIGGER removals AFTER DELETE ON packages
+        BEGIN
+            DELETE FROM files WHERE pkgKey = old.pkgKey;
+            DELETE FROM requires WHERE pkgKey = old.pkgKey;
+            DELETE FROM provides WHERE pkgKey = old.pkgKey;
+            DELETE FROM conflicts WHERE pkgKey = old.pkgKey;
+            DELETE FROM obsoletes WHERE pkgKey = old.pkgKey;
+        END;
+    """,
+    'filelists': """
+        CREATE TABLE db_info (dbversion INTEGER, checksum TEXT);
+        CREATE TABLE packages (pkgKey INTEGER PRIMARY KEY, pkgId TEXT);
+        CREATE TABLE filelist (
+            pkgKey INTEGER, dirname TEXT, filenames TEXT, filetypes TEXT);
+        CREATE INDEX keyfile ON filelist (pkgKey);
+        CREATE INDEX pkgId ON packages (pkgId);
+        CREATE INDEX dirnames ON filelist (dirname);
+        CREATE TRIGGER remove_filelist AFTER DELETE ON packages
+        BEGIN
+            DELETE FROM filelist WHERE pkgKey = old.pkgKey;
+        END;
+    """,
+    'other': """
+        CREATE TABLE db_info (dbversion INTEGER, checksum TEXT);
+        CREATE TABLE packages (pkgKey INTEGER PRIMARY KEY, pkgId TEXT);
+        CREATE TABLE changelog (
+            pkgKey INTEGER, author TEXT, date INTEGER, changelog TEXT);
+        CREATE INDEX keychange ON changelog (pkgKey);
+        CREATE INDEX pkgId ON packages (pkgId);
+        CREATE TRIGGER remove_changelogs AFTER DELETE ON packages
+        BEGIN
+            DELETE FROM changelog WHERE pkgKey = old.pkgKey;
+        END;
+    """,
+}
+
+# File types, as given in the filelists database
+FILE_TYPE_CODES = {None: 'f', 'dir': 'd', 'ghost': 'g'}
+
+
+def file_checksum(filename):
+    """
+    Return the SHA256 checksum of a file
+    """
+
+    sha256 = hashlib.sha256()
+
+    with open(filename, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(2 ** 20), b''):
+            sha256.update(chunk)
+
+    return sha256.hexdigest()
+
+
+class MetadataWriter:
+    """
+    Writes a gzipped metadata file, tracking the checksum and size
+    of its uncompressed content as it's written
+    """
+
+    def __init__(self, filename):
+        """
+        Open the file for writing
+        """
+
+        self.filename = filename
+        self.fh = gzip.open(filename, 'wb')
+        self.open_sha256 = hashlib.sha256()
+        self.open_size = 0
+
+    def write(self, text):
+        """
+        Write some XML to the file
+        """
+
+        data = text.encode()
+        self.fh.write(data)
+        self.open_sha256.update(data)
+        self.open_size += len(data)
+
+    def close(self):
+        """
+        Close the file, returning the details of it needed in repomd.xml
+        """
+
+        self.fh.close()
+
+        return {
+            'checksum': file_checksum(self.filename),
+            'open-checksum': self.open_sha256.hexdigest(),
+            'size': os.path.getsize(self.filename),
+            'open-size': self.open_size,
+        }
+
+
+class DatabaseWriter:
+    """
+    Writes one of the sqlite databases for the metadata, which is
+    bzip2 compressed once complete
+    """
+
+    def __init__(self, filename, md_type):
+        """
+        Create the database, with the schema for the type of metadata
+        """
+
+        self.filename = filename
+        self.db = sqlite3.connect(str(filename))
+        self.db.executescript(DATABASE_SCHEMAS[md_type])
+
+    def insert(self, table, rows):
+        """
+        Insert rows into a table, returning the key of the last row
+        """
+
+        cursor = None
+
+        for row in rows:
+            cursor = self.db.execute(
+                f'INSERT INTO {table} VALUES ({", ".join("?" * len(row))})',
+                row
+            )
+
+        return cursor.lastrowid if cursor is not None else None
+
+    def close(self, xml_checksum):
+        """
+        Record the checksum of the matching XML metadata, then compress
+        the database, returning the details of it needed in repomd.xml
+        """
+
+        self.db.execute('INSERT INTO db_info VALUES (?, ?)',
+                        (DATABASE_VERSION, xml_checksum))
+        self.db.commit()
+        self.db.close()
+
+        compressed = f'{self.filename}.bz2'
+
+        with open(self.filename, 'rb') as src, \
+                bz2.open(compressed, 'wb') as dst:
+            shutil.copyfileobj(src, dst, 2 ** 20)
+
+        record = {
+            'checksum': file_checksum(compressed),
+            'open-checksum': file_checksum(self.filename),
+            'size': os.path.getsize(compressed),
+            'open-size': os.path.getsize(self.filename),
+            'database_version': DATABASE_VERSION,
+        }
+        os.remove(self.filename)
+
+        return record
+
+
+def text(header, tag):
+    """
+    Return a string header value (which may be an internationalized
+    string, of which the first is used), or an empty string
+    """
+
+    value = header.header.get(tag, '')
+
+    if isinstance(value, list):
+        value = value[0] if value else ''
+
+    return value
+
+
+def array(header, tag):
+    """
+    Return an array header value, or an empty list
+    """
+
+    value = header.header.get(tag, [])
+
+    return value if isinstance(value, list) else [value]
+
+
+def version_attrs(epoch, version, release):
+    """
+    Return the version attributes used throughout the metadata
+    """
+
+    return (f'epoch="{epoch}" ver={quoteattr(version)} '
+            f'rel={quoteattr(release)}')
+
+
+def dependencies(header, name_tag, flags_tag, version_tag,
+                 requires=False):
+    """
+    Return the dependencies of a type as (name, flags, epoch, version,
+    release, pre) tuples, flags being the comparison (None for an
+    unversioned dependency) and pre whether it's needed by scriptlets
+    """
+
+    deps = list()
+    seen = set()
+
+    for name, flags, evr in zip(array(header, name_tag),
+                                array(header, flags_tag),
+                                array(header, version_tag)):
+        if name.startswith('rpmlib(') or (name, flags, evr) in seen:
+            continue
+
+        seen.add((name, flags, evr))
+        comparison = COMPARISONS.get(flags & 0xe)
+        epoch = version = release = None
+
+        if comparison is not None and evr:
+            epoch, _, version = evr.rpartition(':')
+            epoch = epoch or '0'
+            version, _, release = version.partition('-')
+        else:
+            comparison = None
+
+        pre = requires and bool(
+            flags & (SENSE_PREREQ | SENSE_SCRIPT_PRE | SENSE_SCRIPT_POST)
+        )
+        deps.append((name, comparison, epoch, version, release or None,
+                     pre))
+
+    return deps
+
+
+def dependency_entries(deps):
+    """
+    Return the rpm:entry elements for dependencies
+    """
+
+    entries = list()
+
+    for name, comparison, epoch, version, release, pre in deps:
+        attrs = f'name={quoteattr(name)}'
+
+        if comparison is not None:
+            attrs += f' flags="{comparison}" epoch="{epoch}" ' \
+                     f'ver={quoteattr(version)}'
+
+            if release:
+                attrs += f' rel={quoteattr(release)}'
+
+        if pre:
+            attrs += ' pre="1"'
+
+        entries.append(f'      <rpm:entry {attrs}/>\n')
+
+    return entries
+
+
+def package_dependencies(header):
+    """
+    Return all the dependencies of a package, by type
+    """
+
+    return {
+        'provides': dependencies(header, rh.TAG_PROVIDENAME,
+                                 rh.TAG_PROVIDEFLAGS, rh.TAG_PROVIDEVERSION),
+        'requires': dependencies(header, rh.TAG_REQUIRENAME,
+                                 rh.TAG_REQUIREFLAGS, rh.TAG_REQUIREVERSION,
+                                 requires=True),
+        'conflicts': dependencies(header, rh.TAG_CONFLICTNAME,
+                                  rh.TAG_CONFLICTFLAGS,
+                                  rh.TAG_CONFLICTVERSION),
+        'obsoletes': dependencies(header, rh.TAG_OBSOLETENAME,
+                                  rh.TAG_OBSOLETEFLAGS,
+                                  rh.TAG_OBSOLETEVERSION),
+    }
+
+
+def file_list(header):
+    """
+    Return the files in a package as (path, type) pairs, the type
+    being 'dir', 'ghost' or None for regular files
+    """
+
+    if rh.TAG_OLDFILENAMES in header.header:
+        paths = array(header, rh.TAG_OLDFILENAMES)
+    else:
+        dirnames = array(header, rh.TAG_DIRNAMES)
+        paths = [dirnames[idx] + basename for idx, basename in
+                 zip(array(header, rh.TAG_DIRINDEXES),
+                     array(header, rh.TAG_BASENAMES))]
+
+    modes = array(header, rh.TAG_FILEMODES)
+    flags = array(header, rh.TAG_FILEFLAGS)
+    files = list()
+
+    for idx, path in enumerate(paths):
+        file_type = None
+
+        if idx < len(flags) and flags[idx] & FILE_GHOST:
+            file_type = 'ghost'
+        elif idx < len(modes) and stat.S_ISDIR(modes[idx]):
+            file_type = 'dir'
+
+        files.append((path, file_type))
+
+    return files
+
+
+def file_elements(files, indent):
+    """
+    Return the file elements for the given files
+    """
+
+    elements = list()
+
+    for path, file_type in files:
+        type_attr = f' type="{file_type}"' if file_type else ''
+        elements.append(f'{indent}<file{type_attr}>{escape(path)}</file>\n')
+
+    return elements
+
+
+def primary_files(files):
+    """
+    Return the files also listed in the primary metadata
+    """
+
+    return [(path, file_type) for path, file_type in files
+            if path.startswith(PRIMARY_FILE_PREFIXES) or 'bin/' in path]
+
+
+def package_xml(pkg, header, mtime, size):
+    """
+    Return the primary, filelists and other metadata for a package
+    """
+
+    name, epoch, version, release, arch = header.nevra()
+    installed = header.get(rh.TAG_LONGSIZE, header.get(rh.TAG_SIZE, 0))
+    version = version_attrs(epoch or 0, version, release)
+    files = file_list(header)
+    pkg_attrs = f'pkgid="{pkg.sha256}" name={quoteattr(name)} ' \
+                f'arch={quoteattr(arch)}'
+
+    primary = [
+        '<package type="rpm">\n',
+        f'  <name>{escape(name)}</name>\n',
+        f'  <arch>{escape(arch)}</arch>\n',
+        f'  <version {version}/>\n',
+        f'  <checksum type="sha256" pkgid="YES">{pkg.sha256}</checksum>\n',
+        f'  <summary>{escape(text(header, rh.TAG_SUMMARY))}</summary>\n',
+        f'  <description>{escape(text(header, rh.TAG_DESCRIPTION))}'
+        f'</description>\n',
+        f'  <packager>{escape(text(header, rh.TAG_PACKAGER))}</packager>\n',
+        f'  <url>{escape(text(header, rh.TAG_URL))}</url>\n',
+        f'  <time file="{mtime}" '
+        f'build="{header.get(rh.TAG_BUILDTIME, 0)}"/>\n',
+        f'  <size package="{size}" '
+        f'installed="{installed}" '
+        f'archive="{header.get(rh.TAG_ARCHIVESIZE, 0)}"/>\n',
+        f'  <location href={quoteattr(pkg.href)}/>\n',
+        '  <format>\n',
+    ]
+
+    for tag, element in ((rh.TAG_LICENSE, 'license'),
+                         (rh.TAG_VENDOR, 'vendor'),
+                         (rh.TAG_GROUP, 'group'),
+                         (rh.TAG_BUILDHOST, 'buildhost'),
+                         (rh.TAG_SOURCERPM, 'sourcerpm')):
+        primary.append(f'    <rpm:{element}>{escape(text(header, tag))}'
+                       f'</rpm:{element}>\n')
+
+    primary.append(f'    <rpm:header-range start="{header.header_start}" '
+                   f'end="{header.header_end}"/>\n')
+
+    for element, deps in package_dependencies(header).items():
+        if deps:
+            primary.append(f'    <rpm:{element}>\n')
+            primary.extend(dependency_entries(deps))
+            primary.append(f'    </rpm:{element}>\n')
+
+    primary.extend(file_elements(primary_files(files), '    '))
+    primary.append('  </format>\n</package>\n')
+
+    filelists = [f'<package {pkg_attrs}>\n', f'  <version {version}/>\n']
+    filelists.extend(file_elements(files, '  '))
+    filelists.append('</package>\n')
+
+    other = [f'<package {pkg_attrs}>\n', f'  <version {version}/>\n']
+    changelog = list(zip(array(header, rh.TAG_CHANGELOGNAME),
+                         array(header, rh.TAG_CHANGELOGTIME),
+                         array(header, rh.TAG_CHANGELOGTEXT)))
+
+    # Changelogs are stored newest first, but listed oldest first
+    for author, date, entry in reversed(changelog):
+        other.append(f'  <changelog author={quoteattr(author)} '
+                     f'date="{date}">{escape(entry)}</changelog>\n')
+
+    other.append('</package>\n')
+
+    return {'primary': ''.join(primary), 'filelists': ''.join(filelists),
+            'other': ''.join(other)}
+
+
+def insert_package(databases, pkg, header, mtime, size):
+    """
+    Add a package to the primary, filelists and other databases
+    """
+
+    name, epoch, version, release, arch = header.nevra()
+    files = file_list(header)
+
+    pkg_key = databases['primary'].insert('packages', [(
+        None, pkg.sha256, name, arch, version, str(epoch or 0), release,
+        text(header, rh.TAG_SUMMARY), text(header, rh.TAG_DESCRIPTION),
+        text(header, rh.TAG_URL), mtime, header.get(rh.TAG_BUILDTIME, 0),
+        text(header, rh.TAG_LICENSE), text(header, rh.TAG_VENDOR),
+        text(header, rh.TAG_GROUP), text(header, rh.TAG_BUILDHOST),
+        text(header, rh.TAG_SOURCERPM), header.header_start,
+        header.header_end, text(header, rh.TAG_PACKAGER), size,
+        header.get(rh.TAG_LONGSIZE, header.get(rh.TAG_SIZE, 0)),
+        header.get(rh.TAG_ARCHIVESIZE, 0), pkg.href, None, 'sha256',
+    )])
+    databases['primary'].insert(
+        'files', [(path, file_type or 'file', pkg_key)
+                  for path, file_type in primary_files(files)]
+    )
+
+    for table, deps in package_dependencies(header).items():
+        databases['primary'].insert(
+            table, [(name, comparison, epoch, version, release, pkg_key) +
+                    (('TRUE' if pre else 'FALSE',)
+                     if table == 'requires' else ())
+                    for name, comparison, epoch, version, release, pre
+                    in deps]
+        )
+
+    # Files are grouped by directory in the filelists database
+    directories = dict()
+
+    for path, file_type in files:
+        dirname, basename = os.path.split(path)
+        directories.setdefault(dirname, []).append(
+            (basename, FILE_TYPE_CODES[file_type])
+        )
+
+    pkg_key = databases['filelists'].insert('packages',
+                                            [(None, pkg.sha256)])
+    databases['filelists'].insert(
+        'filelist', [(pkg_key, dirname, '/'.join(name for name, _ in entries),
+                      ''.join(code for _, code in entries))
+                     for dirname, entries in directories.items()]
+    )
+
+    pkg_key = databases['other'].insert('packages', [(None, pkg.sha256)])
+    databases['other'].insert(
+        'changelog', [(pkg_key, author, date, entry)
+                      for author, date, entry in zip(
+                          array(header, rh.TAG_CHANGELOGNAME),
+                          array(header, rh.TAG_CHANGELOGTIME),
+                          array(header, rh.TAG_CHANGELOGTEXT))]
+    )
+
+
+def prestodelta_xml(new_header, deltas):
+    """
+    Return the prestodelta metadata for a package, given the deltas
+    to it with the headers of the packages they're from
+    """
+
+    name, epoch, version, release, arch = new_header.nevra()
+    lines = [f'  <newpackage name={quoteattr(name)} epoch="{epoch or 0}" '
+             f'version={quoteattr(version)} release={quoteattr(release)} '
+             f'arch={quoteattr(arch)}>\n']
+
+    for old_header, delta in deltas:
+        _, old_epoch, old_version, old_release, _ = old_header.nevra()
+        lines.extend([
+            f'    <delta oldepoch="{old_epoch or 0}" '
+            f'oldversion={quoteattr(old_version)} '
+            f'oldrelease={quoteattr(old_release)}>\n',
+            f'      <filename>{escape(delta.href)}</filename>\n',
+            f'      <sequence>{escape(delta.sequence)}</sequence>\n',
+            f'      <size>{os.path.getsize(delta.path)}</size>\n',
+            f'      <checksum type="sha256">{delta.sha256}</checksum>\n',
+            '    </delta>\n',
+        ])
+
+    lines.append('  </newpackage>\n')
+
+    return ''.join(lines)
+
+
+def zchunk_compress(source, out_dir, md_type):
+    """
+    Write a zchunk compressed copy of a gzipped metadata file, with
+    a chunk for each package so clients only download the packages'
+    metadata which changed, returning the details of it needed in
+    repomd.xml
+    """
+
+    plain_file = out_dir / f'{md_type}.xml'
+    zck_file = out_dir / f'{md_type}.xml.zck'
+
+    with gzip.open(source, 'rb') as src, open(plain_file, 'wb') as dst:
+        shutil.copyfileobj(src, dst, 2 ** 20)
+
+    proc = subprocess.run(
+        ['zck', '--split', '<package ', '-o', str(zck_file),
+         str(plain_file)],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE
+    )
+
+    if proc.returncode:
+        raise RuntimeError(f'Unable to compress {md_type} metadata with '
+                           f'zchunk: {proc.stderr.decode().strip()}')
+
+    proc = subprocess.run(
+        ['zck_read_header', str(zck_file)],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE
+    )
+    header = dict(re.findall(r'^Header (size|checksum): (\S+)$',
+                             proc.stdout.decode(), re.MULTILINE))
+
+    if proc.returncode or len(header) != 2:
+        raise RuntimeError(f'Unable to read zchunk header of {zck_file}')
+
+    record = {
+        'checksum': file_checksum(zck_file),
+        'open-checksum': file_checksum(plain_file),
+        'header-checksum': header['checksum'],
+        'size': os.path.getsize(zck_file),
+        'open-size': os.path.getsize(plain_file),
+        'header-size': int(header['size']),
+    }
+    os.remove(plain_file)
+
+    return record
+
+
+def write_repomd(filename, revision, records):
+    """
+    Write repomd.xml describing the given metadata files
+    """
+
+    with open(filename, 'w') as fh:
+        fh.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                 f'<repomd xmlns="http://linux.duke.edu/metadata/repo" '
+                 f'xmlns:rpm="{RPM_NS}">\n'
+                 f'  <revision>{revision}</revision>\n')
+
+        for md_type, record in records.items():
+            fh.write(f'  <data type="{md_type}">\n')
+
+            for field in ('checksum', 'open-checksum', 'header-checksum'):
+                if field in record:
+                    fh.write(f'    <{field} type="sha256">{record[field]}'
+                             f'</{field}>\n')
+
+            fh.write(f'    <location href="{record["href"]}"/>\n'
+                     f'    <timestamp>{record["timestamp"]}</timestamp>\n')
+
+            for field in ('size', 'open-size', 'header-size',
+                          'database_version'):
+                if field in record:
+                    fh.write(f'    <{field}>{record[field]}</{field}>\n')
+
+            fh.write('  </data>\n')
+
+        fh.write('</repomd>\n')
+
+
+class RepodataGenerator:
+    """
+    Generates the metadata for Yum repositories, keeping generated
+    metadata in a cache for reuse
+    """
+
+    # Cached metadata unused for this long is removed
+    max_age = 30 * 24 * 3600
+
+    def __init__(self, cache_dir, read_header, sqlite=False,
+                 zchunk=False):
+        """
+        Set up the cache; read_header returns the RpmHeader for
+        a package file, while sqlite and zchunk control whether the
+        databases and zchunk compressed metadata are generated too
+        """
+
+        self.cache_dir = cache_dir
+        self.read_header = read_header
+        self.sqlite = sqlite
+        self.zchunk = zchunk
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def cache_key(self, packages, deltas=()):
+        """
+        Return the key identifying the metadata for a set of packages
+        (and deltas), as generated with the current options
+        """
+
+        manifest = json.dumps([
+            sorted((pkg.href, pkg.sha256) for pkg in packages),
+            sorted((delta.href, delta.sha256, delta.sequence)
+                   for delta in deltas),
+            self.sqlite, self.zchunk,
+        ])
+
+        return hashlib.sha256(manifest.encode()).hexdigest()
+
+    def write_metadata(self, out_dir, packages, deltas=()):
+        """
+        Write the metadata files for the packages in a single pass,
+        along with the prestodelta metadata for any deltas, returning
+        the records for repomd.xml
+        """
+
+        writers = dict()
+        records = dict()
+
+        for md_type, root, namespace in METADATA_TYPES:
+            writer = MetadataWriter(out_dir / f'{md_type}.xml.gz')
+            extra_ns = f' xmlns:rpm="{RPM_NS}"' \
+                if md_type == 'primary' else ''
+            writer.write(f'<?xml version="1.0" encoding="UTF-8"?>\n'
+                         f'<{root} xmlns="{namespace}"{extra_ns} '
+                         f'packages="{len(packages)}">\n')
+            writers[md_type] = writer
+
+        databases = dict()
+
+        if self.sqlite:
+            for md_type, _, _ in METADATA_TYPES:
+                databases[md_type] = DatabaseWriter(
+                    out_dir / f'{md_type}.sqlite', md_type
+                )
+
+        for pkg in sorted(packages, key=lambda pkg: pkg.href):
+            pkg_stat = os.stat(pkg.path)
+            header = self.read_header(pkg.path)
+            mtime = int(pkg_stat.st_mtime)
+            xml = package_xml(pkg, header, mtime, pkg_stat.st_size)
+
+            for md_type, writer in writers.items():
+                writer.write(xml[md_type])
+
+            if databases:
+                insert_package(databases, pkg, header, mtime,
+                               pkg_stat.st_size)
+
+        timestamp = int(time.time())
+
+        for md_type, root, _ in METADATA_TYPES:
+            writers[md_type].write(f'</{root}>\n')
+            self.add_file(out_dir, records, md_type, f'{md_type}.xml.gz',
+                          writers[md_type].close(), timestamp)
+
+        for md_type, database in databases.items():
+            record = database.close(records[md_type]['checksum'])
+            self.add_file(out_dir, records, f'{md_type}_db',
+                          f'{md_type}.sqlite.bz2', record, timestamp)
+
+        if self.zchunk:
+            for md_type, _, _ in METADATA_TYPES:
+                record = zchunk_compress(
+                    out_dir / records[md_type]['href'].split('/')[-1],
+                    out_dir, md_type
+                )
+                self.add_file(out_dir, records, f'{md_type}_zck',
+                              f'{md_type}.xml.zck', record, timestamp)
+
+        if deltas:
+            writer = MetadataWriter(out_dir / 'prestodelta.xml.gz')
+            writer.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                         '<prestodelta>\n')
+
+            for new, new_deltas in itertools.groupby(
+                    sorted(deltas, key=lambda delta: (delta.new, delta.href)),
+                    key=lambda delta: delta.new):
+                writer.write(prestodelta_xml(
+                    self.read_header(new),
+                    [(self.read_header(delta.old), delta)
+                     for delta in new_deltas]
+                ))
+
+            writer.write('</prestodelta>\n')
+            self.add_file(out_dir, records, 'prestodelta',
+                          'prestodelta.xml.gz', writer.close(), timestamp)
+
+        return records
+
+    @staticmethod
+    def add_file(out_dir, records, data_type, filename, record, timestamp):
+        """
+        Name a generated metadata file after its checksum, adding its
+        record for repomd.xml
+        """
+
+        checksum_name = f'{record["checksum"]}-{filename}'
+        os.replace(out_dir / filename, out_dir / checksum_name)
+        record['href'] = f'repodata/{checksum_name}'
+        record['timestamp'] = timestamp
+        records[data_type] = record
+
+    def generate(self, repo_dir, packages, deltas=()):
+        """
+        Write the metadata for the given packages (and deltas) into the
+        repodata directory of a repository, reusing cached metadata if
+        it was already generated for the same packages
+        """
+
+        key = self.cache_key(packages, deltas)
+        cached_dir = self.cache_dir / key
+
+        if (cached_dir / 'repomd.xml').exists():
+            print(f'    Reusing metadata for {len(packages)} packages')
+            os.utime(cached_dir)
+        else:
+            print(f'    Generating metadata for {len(packages)} packages')
+            work_dir = self.cache_dir / f'{key}.tmp'
+            shutil.rmtree(work_dir, ignore_errors=True)
+            os.makedirs(work_dir)
+
+            records = self.write_metadata(work_dir, packages, deltas)
+            write_repomd(work_dir / 'repomd.xml', int(time.time()), records)
+
+            shutil.rmtree(cached_dir, ignore_errors=True)
+            os.replace(work_dir, cached_dir)
+
+        # Replace the repository's metadata, removing stale files
+        repodata_dir = repo_dir / 'repodata'
+        os.makedirs(repodata_dir, exist_ok=True)
+        cached_files = set(os.listdir(cached_dir))
+
+        for filename in os.listdir(repodata_dir):
+            if filename not in cached_files:
+                os.remove(repodata_dir / filename)
+
+        for filename in cached_files:
+            shutil.copyfile(cached_dir / filename,
+                            repodata_dir / f'.{filename}.tmp')
+            os.replace(repodata_dir / f'.{filename}.tmp',
+                       repodata_dir / filename)
+
+        self.prune()
+
+    def prune(self):
+        """
+        Remove cached metadata which hasn't been used recently
+        """
+
+        cutoff = time.time() - self.max_age
+
+        for entry in os.scandir(self.cache_dir):
+            if entry.is_dir() and entry.stat().st_mtime < cutoff:
+                shutil.rmtree(entry.path, ignore_errors=True)
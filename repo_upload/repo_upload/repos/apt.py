@@ -3,24 +3,25 @@ Handles the APT package repository process
 
 Uses aptly to create and publish the repositories, along with its
 API server that helps to avoid needing to call out to external
-commands for the various steps
+commands for the various steps; alternatively the native backend
+places packages into the pool and builds the indexes itself
 """
 
+import concurrent.futures
 import contextlib
+import hashlib
 import json
+import lzma
 import os
 import shutil
-import signal
 import string
-import subprocess
 import time
 
 from collections import OrderedDict
 from pkg_resources import resource_filename
-from pathlib import Path
-
-import requests
 
+from repo_upload.aptly import AptlyServer, MultipartStream
+from repo_upload.debindex import DebIndexBuilder, parse_control
 from repo_upload.repos.base import RepositoryBase
 
 
@@ -29,66 +30,74 @@ class AptRepository(RepositoryBase):
     Manages creating and uploading APT package repositories
     """
 
-    def __init__(self, args, common_info):
+    # States of asynchronous aptly tasks
+    TASK_SUCCEEDED = 2
+    TASK_FAILED = 3
+
+    def __init__(self, args, common_info, shared=None):
         """
         Load in APT-specific data from JSON file and initialize various
         common parameters and generate the Aptly configuration file
         """
 
-        super().__init__(args, common_info)
+        super().__init__(args, common_info, shared)
 
         data = self.load_config('apt.json')
 
         self.os_versions = data['os_versions']
         self.distro_info = data['distro_info']
         self.repo_dir = self.local_repo_root / self.edition / 'deb'
+        self.upload_dir = 'packages'
+        self.aptly_conf = self.repo_dir.parent / 'aptly.conf'
+        self.publish_workers = \
+            common_info.getint('publish_workers', fallback=4)
+        self.publish_state = self.load_publish_state()
+        self.native = common_info.get('apt_backend', 'aptly') == 'native'
+        self.contents = common_info.getboolean('apt_contents', fallback=True)
+        self.by_hash = common_info.getboolean('apt_by_hash', fallback=True)
+        self.index_builder = DebIndexBuilder(
+            self.repo_dir, self.hash_cache, self.gpg, self.key,
+            contents=self.contents, by_hash=self.by_hash
+        )
 
         self.create_aptly_conf()
-        self.aptly_api = None
 
-    @staticmethod
-    def handler(_signum, _frame):
-        """Timeout handler for Aptly API server"""
-
-        print('Unable to start Aptly API server in specified time')
+        # A server left running is only reusable when its database
+        # is kept between runs
+        self.aptly = AptlyServer(
+            self.aptly_conf, listen=common_info.get('aptly_listen'),
+            url=common_info.get('aptly_url'),
+            timeout=common_info.getint('aptly_timeout', fallback=30),
+            keep_running=self.incremental and common_info.getboolean(
+                'aptly_keep_running', fallback=False
+            )
+        )
 
-    def start_aptly_api_server(self):
+    def aptly_request(self, method, path, **kwargs):
         """
-        Start the Aptly API server; used to communicate to Aptly via
-        HTTP requests
+        Make a request to the Aptly API server over the persistent
+        session, counting it in the run statistics
         """
 
-        self.aptly_api = subprocess.Popen(
-            ['aptly', 'api', 'serve'],
-            stdout=subprocess.PIPE, stderr=subprocess.PIPE
-        )
+        self.stats.add_request('aptly')
 
-        # Give the server time to start; if 10 seconds is reached, abort
-        signal.signal(signal.SIGALRM, self.handler)
-        signal.alarm(10)
-
-        while True:
-            try:
-                req = requests.get('http://localhost:8080/api/version')
-            except requests.exceptions.ConnectionError:
-                # Server not started yet, wait a moment then try again
-                time.sleep(.5)
-                continue
+        return self.aptly.session.request(method, f'{self.aptly.url}{path}',
+                                          **kwargs)
 
-            # Once server is up, continue on
-            if req.status_code == 200:
-                break
+    def start_aptly_api_server(self):
+        """
+        Start (or attach to) the Aptly API server; used to communicate
+        to Aptly via HTTP requests
+        """
 
-        # Server now up, safe to continue
-        signal.alarm(0)
+        self.aptly.start()
 
     def stop_aptly_api_server(self):
         """
         Stop the Aptly API server
         """
 
-        if self.aptly_api is not None:
-            self.aptly_api.terminate()
+        self.aptly.stop()
 
     @contextlib.contextmanager
     def handle_repo_server(self):
@@ -98,6 +107,10 @@ class AptRepository(RepositoryBase):
         the application
         """
 
+        if self.native:
+            yield
+            return
+
         try:
             self.start_aptly_api_server()
             yield
@@ -107,7 +120,8 @@ class AptRepository(RepositoryBase):
     def create_aptly_conf(self):
         """
         Create the Aptly configuration file; used to control how
-        Aptly handles and locates the local repositories
+        Aptly handles and locates the local repositories.  Each edition
+        has its own file, beside its local repository
         """
 
         conf = OrderedDict({
@@ -127,14 +141,14 @@ class AptRepository(RepositoryBase):
             "skipLegacyPool": True,
             "ppaDistributorID": "ubuntu",
             "ppaCodename": "",
-            "skipContentsPublishing": False,
+            "skipContentsPublishing": not self.contents,
             "FileSystemPublishEndpoints": {},
             "S3PublishEndpoints": {},
             "SwiftPublishEndpoints": {}
         })
-        conf_file = Path.home() / '.aptly.conf'
+        os.makedirs(self.aptly_conf.parent, exist_ok=True)
 
-        with open(conf_file, 'w') as fh:
+        with open(self.aptly_conf, 'w') as fh:
             json.dump(conf, fh, indent=2, separators=(',', ': '))
 
     def write_source_file(self, os_version, edition):
@@ -195,6 +209,25 @@ class AptRepository(RepositoryBase):
             f'Ready to seed Debian repositories at {self.local_repo_root}'
         )
 
+    def distribution_stanza(self, distro):
+        """
+        Return the description of a distribution, as used for its
+        Release file
+        """
+
+        tmpl_file = os.path.join(
+            resource_filename('repo_upload', 'conf'), 'distributions.tmpl'
+        )
+        dist_tmpl = string.Template(open(tmpl_file).read())
+        data = {
+            'distro': distro,
+            'edition_name': self.edition_name,
+            'key': self.key,
+            'version': self.os_versions[distro]['version'],
+        }
+
+        return dist_tmpl.substitute(data)
+
     def seed_local_repos(self):
         """
         Create the local repositories to allow packages to be imported
@@ -204,6 +237,20 @@ class AptRepository(RepositoryBase):
         print(f'Creating local {self.edition} Debian repositories '
               f'at {self.repo_dir}...')
 
+        # The native backend needs no repositories created, though as
+        # its indexes are built from the pool, a full run starts from
+        # an empty one
+        if self.native:
+            if not self.incremental:
+                for repo_dir in [self.repo_dir / 'dists',
+                                 self.repo_dir / 'pool']:
+                    shutil.rmtree(repo_dir, ignore_errors=True)
+
+            os.makedirs(self.repo_dir / 'pool', exist_ok=True)
+            print(f'Debian repositories ready for import at '
+                  f'{self.local_repo_root}')
+            return
+
         conf_dir = self.repo_dir / 'conf'
         os.makedirs(conf_dir, exist_ok=True)
         distro_file = conf_dir / 'distributions'
@@ -218,18 +265,18 @@ class AptRepository(RepositoryBase):
                      f'Format#A.22Release.22_files\n# for more information\n')
 
             for distro in self.os_versions:
-                tmpl_file = os.path.join(
-                    resource_filename('repo_upload', 'conf'),
-                    'distributions.tmpl'
-                )
-                dist_tmpl = string.Template(open(tmpl_file).read())
-                data = {
-                    'distro': distro,
-                    'edition_name': self.edition_name,
-                    'key': self.key,
-                    'version': self.os_versions[distro]['version'],
-                }
-                fh.write(dist_tmpl.substitute(data))
+                fh.write(self.distribution_stanza(distro))
+
+                # Repositories kept from a previous incremental run
+                # are reused as they are; any others start out empty,
+                # so nothing recorded as published for them holds
+                if self.incremental:
+                    req = self.aptly_request('GET', f'/api/repos/{distro}')
+
+                    if req.status_code == 200:
+                        continue
+
+                self.publish_state.forget(distro)
 
                 payload = {
                     'Name': distro,
@@ -238,8 +285,8 @@ class AptRepository(RepositoryBase):
                 }
                 headers = {'Content-Type': 'application/json'}
 
-                req = requests.post(
-                    'http://localhost:8080/api/repos', headers=headers,
+                req = self.aptly_request(
+                    'POST', '/api/repos', headers=headers,
                     data=json.dumps(payload)
                 )
 
@@ -260,6 +307,25 @@ class AptRepository(RepositoryBase):
         return (f'{self.s3_package_base}/{self.edition}/deb/'
                 f'pool/{os_version}/main/c/couchbase-server')
 
+    def get_pkg_name(self, version, os_version):
+        """
+        Determine the Debian package filename for a given release
+        version and OS version
+        """
+
+        return (f'couchbase-server-{self.edition}_{version}-'
+                f'{self.os_versions[os_version]["full"]}_amd64.deb')
+
+    def package_present(self, pkg_name, os_version):
+        """
+        Determine if a package is in the pool the repository for
+        a distribution is published with
+        """
+
+        pool_dir = self.get_publish_dir() / 'pool' / os_version
+
+        return any(pool_dir.rglob(pkg_name))
+
     def import_packages(self):
         """
         Import all available versions of the packages for each
@@ -267,60 +333,278 @@ class AptRepository(RepositoryBase):
         a given OS version
         """
 
-        if not self.pkg_dir.exists():
-            os.makedirs(self.pkg_dir)
-
         print(f'Importing into local {self.edition} repository '
               f'at {self.repo_dir}')
 
-        for release in self.supported_releases.get_releases():
-            version, in_dev = release
+        batches = OrderedDict(
+            (distro, list()) for distro in self.os_versions
+        )
+
+        for pkg_name, release, distro in self.acquired_packages():
+            batches[distro].append((pkg_name, release))
 
-            # If aren't doing a staging run and we have
-            # a development version, skip it
-            if not self.staging and in_dev:
+        for distro, packages in batches.items():
+            if not packages:
                 continue
 
-            for distro in self.os_versions:
-                pkg_name = (f'couchbase-server-{self.edition}_{version}-'
-                            f'{self.os_versions[distro]["full"]}_amd64.deb')
+            if self.native:
+                self.place_distro_packages(distro, packages)
+            else:
+                self.import_distro_packages(distro, packages)
 
-                if self.fetch_package(pkg_name, release, distro):
-                    print(
-                        f'Uploading file {pkg_name} to aptly upload area...'
-                    )
-                    files = {'file': open(self.pkg_dir / pkg_name, 'rb')}
-                    req = requests.post(
-                        f'http://localhost:8080/api/files/{self.pkg_dir}',
-                        files=files
-                    )
+    def place_distro_packages(self, distro, packages):
+        """
+        Place the packages for a distribution into its pool, for the
+        native backend; development builds replace any earlier copy
+        """
 
-                    if req.status_code != 200:
-                        raise RuntimeError(
-                            f'Failed to upload file {pkg_name} to aptly '
-                            f'upload area'
-                        )
-
-                    print(f'Adding file {pkg_name} to Debian repository '
-                          f'{distro}')
-                    req = requests.post(
-                        f'http://localhost:8080/api/repos/{distro}/'
-                        f'file/{self.pkg_dir}/{pkg_name}'
-                    )
+        print(f'Adding {len(packages)} files to Debian repository {distro}')
+
+        for pkg_name, release in packages:
+            pkg = self.package_path(pkg_name)
+            pool_file = self.index_builder.pool_path(distro, pkg, pkg_name)
+            os.makedirs(pool_file.parent, exist_ok=True)
+            self.place_package(pkg, pool_file)
+            self.mark_published(release, distro)
+
+    def import_distro_packages(self, distro, packages):
+        """
+        Upload all the packages for a distribution to the aptly upload
+        area in a single request, then add the whole upload directory
+        to the distribution's repository in one call
+        """
+
+        upload_dir = f'{self.upload_dir}-{distro}'
+        params = dict()
+
+        # Development builds may have changed since they were last
+        # imported into a kept repository
+        if self.incremental and any(in_dev for _, (_, in_dev) in packages):
+            params['forceReplace'] = 1
+
+        print(f'Uploading {len(packages)} files to aptly upload area '
+              f'{upload_dir}...')
+        body = MultipartStream(
+            [(pkg_name, self.package_path(pkg_name))
+             for pkg_name, _ in packages]
+        )
+        req = self.aptly_request(
+            'POST', f'/api/files/{upload_dir}', data=body,
+            headers={'Content-Type': body.content_type}
+        )
+
+        if req.status_code != 200:
+            raise RuntimeError(
+                f'Failed to upload files to aptly upload area {upload_dir}'
+            )
+
+        print(f'Adding {len(packages)} files to Debian repository {distro}')
+        req = self.aptly_request(
+            'POST', f'/api/repos/{distro}/file/{upload_dir}', params=params
+        )
+
+        # An error response may not be the expected JSON at all, and
+        # its text is what's needed to see what went wrong
+        try:
+            failed = req.status_code != 200 or \
+                bool(req.json().get('FailedFiles'))
+        except (ValueError, AttributeError):
+            failed = True
+
+        if failed:
+            raise RuntimeError(
+                f'Failed to add files to Debian repository {distro}: '
+                f'{req.text}'
+            )
+
+        for _, release in packages:
+            self.mark_published(release, distro)
+
+    def get_published(self):
+        """
+        Return the distributions already published by aptly
+        """
+
+        req = self.aptly_request('GET', '/api/publish')
+
+        if req.status_code != 200:
+            raise RuntimeError('Unable to list published Debian repositories')
+
+        return {pub['Distribution'] for pub in req.json()}
+
+    def wait_for_task(self, task):
+        """
+        Poll an asynchronous aptly task until it completes, raising
+        a RuntimeError with the task's output if it failed
+        """
+
+        delay = .1
+
+        while task['State'] not in (self.TASK_SUCCEEDED, self.TASK_FAILED):
+            time.sleep(delay)
+            delay = min(delay * 2, 2)
+            req = self.aptly_request('GET', f'/api/tasks/{task["ID"]}')
+
+            if req.status_code != 200:
+                raise RuntimeError(f'Unable to check aptly task {task["ID"]}')
+
+            task = req.json()
 
-                    if req.status_code != 200:
-                        raise RuntimeError(
-                            f'Failed to add file {pkg_name} to Debian '
-                            f'repository {distro}'
-                        )
+        if task['State'] == self.TASK_FAILED:
+            req = self.aptly_request('GET',
+                                     f'/api/tasks/{task["ID"]}/output')
+            raise RuntimeError(f'{task["Name"]} failed: {req.text}')
+
+        self.aptly_request('DELETE', f'/api/tasks/{task["ID"]}')
+
+    def publish_distro(self, distro, update):
+        """
+        Publish the local repository for a distribution, or update an
+        existing publication of it, using aptly's asynchronous task
+        API; older aptly versions simply complete the request directly
+        """
+
+        headers = {'Content-Type': 'application/json'}
+        params = {'_async': 'true'}
+        options = {
+            'SkipContents': not self.contents,
+            'AcquireByHash': self.by_hash,
+        }
+
+        if update:
+            print(f'    Updating published Debian repository {distro}...')
+
+            # The '.' publishing prefix is escaped as ':.' by aptly
+            req = self.aptly_request(
+                'PUT', f'/api/publish/:./{distro}', params=params,
+                headers=headers, data=json.dumps(options)
+            )
+        else:
+            payload = {
+                'SourceKind': 'local',
+                'Sources': [{'Component': f'{distro}/main', 'Name': distro}],
+                'Architectures': ['amd64'],
+                'Distribution': distro,
+                **options,
+            }
+
+            print(f'    Publishing local Debian repository {distro}...')
+
+            req = self.aptly_request(
+                'POST', '/api/publish', params=params,
+                headers=headers, data=json.dumps(payload)
+            )
+
+        if req.status_code == 202:
+            self.wait_for_task(req.json())
+        elif req.status_code not in (200, 201):
+            raise RuntimeError(f'Request failed with status '
+                               f'{req.status_code}: {req.text}')
+
+        self.add_xz_indexes(distro)
+
+        print(f'    Published local Debian repository {distro}')
+
+    def add_xz_indexes(self, distro):
+        """
+        Add xz compressed Packages indexes to a distribution published
+        by aptly, which only compresses them with gzip and bzip2; they
+        are much smaller for clients to download
+        """
+
+        dist_dir = self.repo_dir / 'public' / 'dists' / distro
+        index_files = OrderedDict()
+
+        with open(dist_dir / 'Release') as fh:
+            release = parse_control(fh.read())
+
+        # Every Packages index listed gets an xz index, unless one
+        # matching it is already listed (say from an earlier run)
+        listed = dict()
+
+        for line in release.get('SHA256', '').splitlines():
+            if line.strip():
+                digest, _, relative_path = line.split()
+                listed[relative_path] = digest
+
+        for relative_path in sorted(listed):
+            if os.path.basename(relative_path) != 'Packages':
+                continue
+
+            with open(dist_dir / relative_path, 'rb') as fh:
+                data = lzma.compress(fh.read())
+
+            xz_path = f'{relative_path}.xz'
+
+            if listed.get(xz_path) != hashlib.sha256(data).hexdigest() or \
+                    not (dist_dir / xz_path).exists():
+                index_files[xz_path] = data
+
+        if index_files:
+            self.index_builder.add_indexes(dist_dir, index_files)
+
+    def publish_distros(self, publish):
+        """
+        Publish all the distributions concurrently (up to the configured
+        limit) with the given function, reporting any failures together
+        once all of them have been attempted
+        """
+
+        errors = dict()
+
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.publish_workers) as executor:
+            futures = {
+                executor.submit(publish, distro): distro
+                for distro in self.os_versions
+            }
+
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    future.result()
+                except Exception as exc:
+                    errors[futures[future]] = exc
+
+        if errors:
+            for distro, exc in sorted(errors.items()):
+                print(f'    Failed to publish {distro}: {exc}')
+
+            raise RuntimeError(
+                f'Unable to publish local Debian repositories '
+                f'{", ".join(sorted(errors))}'
+            )
+
+    def build_distro_indexes(self, distro):
+        """
+        Build the signed indexes for a distribution with the native
+        backend
+        """
+
+        self.index_builder.build(
+            distro, parse_control(self.distribution_stanza(distro))
+        )
 
     def finalize_local_repos(self):
         """
         Publish the local repositories and moved the new published
         directories into the top level of the repository area, clearing
         out unneeded directories in preparation for the upload to S3
+
+        For incremental runs the aptly database is kept, distributions
+        published by an earlier run are updated in place and the files
+        are uploaded straight from aptly's public directory
+
+        The native backend builds the indexes in place instead
         """
 
+        if self.native:
+            print(f'Building indexes for local Debian repositories at '
+                  f'{self.repo_dir}...')
+            self.publish_distros(self.build_distro_indexes)
+            print(f'Published local Debian repositories ready at '
+                  f'{self.repo_dir}')
+            return
+
         public_repo_dir = self.repo_dir / 'public'
         public_repo_dists_dir = public_repo_dir / 'dists'
         public_repo_pool_dir = public_repo_dir / 'pool'
@@ -332,26 +616,15 @@ class AptRepository(RepositoryBase):
         print(f'Publishing into local Debian repositories at '
               f'{public_repo_dir}...')
 
-        for distro in self.os_versions:
-            payload = {
-                'SourceKind': 'local',
-                'Sources': [{'Component': f'{distro}/main', 'Name': distro}],
-                'Architectures': ['amd64'],
-                'Distribution': distro,
-            }
-            headers = {'Content-Type': 'application/json'}
-
-            print(f'    Publishing local Debian repository {distro}...')
-
-            req = requests.post(
-                f'http://localhost:8080/api/publish',
-                headers=headers, data=json.dumps(payload)
-            )
+        published = self.get_published() if self.incremental else set()
+        self.publish_distros(
+            lambda distro: self.publish_distro(distro, distro in published)
+        )
 
-            if req.status_code != 201:
-                raise RuntimeError(
-                    f'Unable to publish local Debian repository {distro}'
-                )
+        if self.incremental:
+            print(f'Published local Debian repositories ready at '
+                  f'{public_repo_dir}')
+            return
 
         print(f'Moving published Debian repositories into local repository '
               f'area at {self.repo_dir}...')
@@ -365,13 +638,37 @@ class AptRepository(RepositoryBase):
 
         print(f'Published local Debian repositories ready at {self.repo_dir}')
 
+    def get_publish_dir(self):
+        """
+        Return the directory holding the published repositories;
+        incremental runs leave them in aptly's public directory
+        """
+
+        if self.incremental and not self.native:
+            return self.repo_dir / 'public'
+
+        return self.repo_dir
+
+    def pipeline_target(self):
+        """
+        Only the native backend places packages itself, into the pool
+        the repositories are uploaded from; aptly's pool is moved once
+        published, so can't be uploaded early
+        """
+
+        if not self.native:
+            return None
+
+        return self.get_publish_dir(), os.path.join(self.edition, 'deb')
+
     def upload_local_repos(self):
         """
         Upload the necessary directories from the local repositories
         into their desired locations on S3
         """
 
-        self.s3_upload(self.repo_dir, os.path.join(self.edition, 'deb'))
+        self.s3_upload(self.get_publish_dir(),
+                       os.path.join(self.edition, 'deb'))
 
         # NOTE: Both community and enterprise sources.list files are
         # copied; maybe not necessary?
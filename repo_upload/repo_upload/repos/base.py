@@ -6,10 +6,13 @@ correctly, along with defining the general flow of the program here
 """
 
 import abc
-import hashlib
+import concurrent.futures
+import contextlib
+import fnmatch
 import json
 import os
 import shutil
+import threading
 
 from collections import namedtuple
 from datetime import datetime
@@ -17,9 +20,28 @@ from pathlib import Path
 from pkg_resources import resource_filename
 
 import boto3
+import boto3.s3.transfer
+import botocore.config
 import botocore.exceptions
 import gnupg
-import requests
+
+from repo_upload.download import HashingWriter, HttpDownloader
+from repo_upload.hashcache import HashCache
+from repo_upload.inventory import RemoteInventory
+from repo_upload.pipeline import UploadPipeline
+from repo_upload.pkgcache import GB, PackageCache, place_file
+from repo_upload.state import PublishState
+from repo_upload.stats import RunStats
+from repo_upload.throttle import S3Throttle, error_code, is_not_found
+
+
+MB = 2 ** 20
+
+# Index files naming (and signing) all the others in a repository, so
+# uploaded last of all
+TOP_INDEX_FILES = ('Release', 'Release.gpg', 'InRelease', 'repomd.xml',
+                   'repomd.xml.asc')
+INDEX_DIRS = ('dists', 'repodata')
 
 
 class Releases:
@@ -54,16 +76,98 @@ class Releases:
             yield release.version, release.in_dev
 
 
+class SharedResources:
+    """
+    Resources which can be shared by all the repositories handled
+    in a run: the local caches, the S3 and release server clients,
+    the GPG handle and the run statistics
+    """
+
+    def __init__(self, common_info):
+        """
+        Create the shared resources from the common configuration
+        """
+
+        self.download_workers = \
+            common_info.getint('download_workers', fallback=4)
+        self.upload_workers = common_info.getint('upload_workers', fallback=8)
+        self.s3_max_requests = common_info.getint(
+            's3_max_requests',
+            fallback=self.upload_workers + self.download_workers
+        )
+        part_concurrency = \
+            common_info.getint('upload_part_concurrency', fallback=10)
+
+        # Throttling is handled by the S3 throttle below, so boto3 only
+        # retries a few times (for errors within multipart transfers).
+        # Each transfer in flight may have all of its parts in flight,
+        # so the connection pool is sized for that, with some to spare
+        # for listings and other single requests
+        s3_config = botocore.config.Config(
+            retries={'mode': 'standard', 'max_attempts': 3},
+            max_pool_connections=self.s3_max_requests * part_concurrency + 10
+        )
+        self.s3 = boto3.resource('s3', config=s3_config)
+        self.s3_client = boto3.client('s3', config=s3_config)
+        self.gpg = gnupg.GPG()
+
+        # Local caches are shared between repository types and editions;
+        # packages are downloaded into the package cache's staging area
+        self.cache_dir = Path(
+            common_info.get('cache_dir', '~/.cache/repo_upload')
+        ).expanduser()
+        self.hash_cache = HashCache(self.cache_dir / 'hashes.db')
+        self.pkg_cache = PackageCache(
+            Path(common_info.get('package_cache_dir',
+                                 str(self.cache_dir / 'packages'))
+                 ).expanduser(),
+            common_info.getint('package_cache_size', fallback=50) * GB,
+            self.hash_cache
+        )
+        self.downloader = HttpDownloader(
+            workers=self.download_workers,
+            segments=common_info.getint('download_segments', fallback=4)
+        )
+
+        self.stats = RunStats()
+        self.stats.hook_s3(self.s3_client)
+        self.stats.hook_session(self.downloader.session, 'releases')
+
+        # Uploads share a single transfer manager so the bandwidth cap
+        # applies to the whole run rather than to each file
+        chunk_size = common_info.getint('upload_chunk_size', fallback=8) * MB
+        bandwidth = common_info.getint('upload_bandwidth', fallback=0) * MB
+        self.transfer_config = boto3.s3.transfer.TransferConfig(
+            multipart_threshold=chunk_size,
+            multipart_chunksize=chunk_size,
+            max_concurrency=part_concurrency,
+            max_bandwidth=bandwidth or None,
+        )
+        self.s3_transfer = boto3.s3.transfer.S3Transfer(
+            client=self.s3_client, config=self.transfer_config
+        )
+
+        # S3 transfers in flight are adapted to the throttling seen,
+        # up to the given maximum
+        self.s3_throttle = S3Throttle(self.s3_max_requests, self.stats)
+
+        # Directories shared by several repositories (such as the GPG
+        # keys) are only uploaded once per run
+        self.upload_lock = threading.Lock()
+        self.uploaded = set()
+
+
 class RepositoryBase(metaclass=abc.ABCMeta):
     """
     Base abstract class for various repository classes
     """
 
     @abc.abstractmethod
-    def __init__(self, edition, common_info):
+    def __init__(self, edition, common_info, shared=None):
         """
         Load in common data from JSON file and initialize various
-        common parameters
+        common parameters; shared holds the resources shared with
+        other repositories in the same run, created if not given
         """
 
         data = self.load_config('base.json')
@@ -72,23 +176,67 @@ class RepositoryBase(metaclass=abc.ABCMeta):
         self.edition = edition
         self.edition_name = f'{self.edition.capitalize()} Edition'
         self.staging = common_info.getboolean('staging')
+        self.incremental = common_info.getboolean('incremental',
+                                                  fallback=False)
+        self.publish_state = None
         self.supported_releases = \
             Releases(data['supported_releases'], self.edition)
 
         self.local_repo_root = Path.home() / Path(common_info['repo_path'])
-        self.s3 = boto3.resource('s3')
         self.s3_bucket = common_info['s3_bucket']
         self.s3_package_base = common_info['s3_base_path']
         self.s3_package_root = f's3://{self.s3_bucket}/{self.s3_package_base}'
         self.http_package_root = self.s3_package_root.replace('s3', 'http')
         self.releases_url = common_info['releases_url']
-        self.gpg = gnupg.GPG()
         self.gpg_file = Path.home() / '.ssh' / common_info['gpg_file']
         self.gpg_keys = data['gpg_keys']
-        self.pkg_dir = Path('packages')
         self.key = common_info['gpg_key']
         self.rpm_key = common_info['rpm_gpg_key']
 
+        # Headers for uploaded objects depend on what kind of file they
+        # are, with rebuilt (development) packages not cached for long;
+        # the staging patterns are expanded for each development version
+        upload_conf = self.load_config('upload.json')
+        self.upload_policies = upload_conf['policies']
+
+        if self.staging:
+            staging_policies = [
+                dict(policy, pattern=policy['pattern'].format(version=version))
+                for version, in_dev in self.supported_releases.get_releases()
+                if in_dev
+                for policy in upload_conf['staging_policies']
+            ]
+            self.upload_policies = staging_policies + self.upload_policies
+
+        # Caches, clients and statistics may be shared with the other
+        # repositories handled in the same run
+        if shared is None:
+            shared = SharedResources(common_info)
+
+        self.shared = shared
+        self.s3 = shared.s3
+        self.s3_client = shared.s3_client
+        self.gpg = shared.gpg
+        self.cache_dir = shared.cache_dir
+        self.hash_cache = shared.hash_cache
+        self.pkg_cache = shared.pkg_cache
+        self.pkg_dir = self.pkg_cache.staging_dir
+        self.download_workers = shared.download_workers
+        self.downloader = shared.downloader
+        self.stats = shared.stats
+        self.upload_workers = shared.upload_workers
+        self.s3_transfer = shared.s3_transfer
+        self.transfer_config = shared.transfer_config
+        self.s3_throttle = shared.s3_throttle
+        self.fetched_packages = None
+
+        # Packages can be uploaded as soon as they're placed into the
+        # local repositories, overlapping uploads with the build
+        self.pipelined = common_info.getboolean('pipelined_upload',
+                                                fallback=False)
+        self.pipeline = None
+        self.pipeline_lock = threading.Lock()
+
         # The following emulates the 'date' shell command
         self.curr_date = \
             datetime.now().astimezone().strftime('%a %b %d %X %Z %Y')
@@ -122,19 +270,30 @@ class RepositoryBase(metaclass=abc.ABCMeta):
                 if not result.count:
                     raise RuntimeError(f'Unable to import GPG key {key}')
 
-    @staticmethod
-    def get_md5(filename):
+    def get_md5(self, filename):
+        """
+        Generate the MD5 for a given file; served from the on-disk
+        hash cache when the file hasn't changed since it was hashed
+        """
+
+        return self.hash_cache.get_md5(filename)
+
+    def load_publish_state(self):
         """
-        Generate the MD5 for a given file
+        Load the record of the packages published into the local
+        repository; it's kept beside the repository rather than in it
+        so it never gets uploaded.  A full run rebuilds the repository
+        from scratch, so any state from earlier runs is removed
         """
 
-        hash_md5 = hashlib.md5()
+        publish_state = PublishState(
+            self.repo_dir.parent / f'.{self.repo_dir.name}-published.json'
+        )
 
-        with open(filename, 'rb') as fh:
-            for chunk in iter(lambda: fh.read(2 ** 20), b''):
-                hash_md5.update(chunk)
+        if not self.incremental:
+            publish_state.clear()
 
-        return hash_md5.hexdigest()
+        return publish_state
 
     def write_gpg_keys(self):
         """
@@ -180,27 +339,57 @@ class RepositoryBase(metaclass=abc.ABCMeta):
 
     def s3_download_file(self, pkg_name, os_version):
         """
-        Download a given package file from S3; return success or
-        failure result
+        Download a given package file from S3; return the digests of
+        the file, computed as it's written out, or None if it isn't
+        there.  Throttled requests are retried (restarting the file);
+        other failures are raised rather than being mistaken for the
+        package being missing
         """
 
         s3_path = f'{self.get_s3_path(os_version)}/{pkg_name}'
+        pkg = self.pkg_dir / pkg_name
+        part_file = f'{pkg}.s3part'
 
         print(f'    Retrieving {s3_path} from {self.s3_bucket}...')
-        bucket = self.s3.Bucket(self.s3_bucket)
+
+        def download():
+            with open(part_file, 'wb') as fh:
+                writer = HashingWriter(fh)
+                self.s3_client.download_fileobj(self.s3_bucket, s3_path,
+                                                writer)
+
+            return writer.digests()
 
         try:
-            bucket.download_file(s3_path, f'{str(self.pkg_dir)}/{pkg_name}')
-        except botocore.exceptions.ClientError:
-            print(f'    Unable to retrieve {s3_path} from {self.s3_bucket}')
-            return False
+            digests = self.s3_throttle.call(download)
+        except botocore.exceptions.ClientError as exc:
+            # Missing objects are reported as access being denied
+            # without permission to list the bucket
+            if not is_not_found(exc) and \
+                    error_code(exc) not in ('403', 'AccessDenied'):
+                raise RuntimeError(f'Unable to retrieve {s3_path} from '
+                                   f'{self.s3_bucket}: {exc}')
+
+            print(f'    {s3_path} not found in {self.s3_bucket}')
+            return None
         else:
-            return True
+            os.replace(part_file, pkg)
+        finally:
+            # Nothing is left behind by a failed download, whatever
+            # the failure
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(part_file)
+
+        self.pkg_cache.add_s3_object(digests['md5'], self.s3_bucket, s3_path)
+
+        return digests
 
     def lb_download_file(self, pkg_name, version):
         """
-        Download a given package file from a given URL; return success
-        or failure result
+        Download a given package file from a given URL; return the
+        digests of the file, or None on failure.  Partial downloads are
+        resumed, and the file only appears in the package area once
+        fully verified
         """
 
         release_url = f'{self.releases_url}/{version}'
@@ -208,17 +397,14 @@ class RepositoryBase(metaclass=abc.ABCMeta):
             release_url = f'{release_url}/ce'
 
         print(f'    Fetching {pkg_name} from {release_url}...')
-        req = requests.get(f'{release_url}/{pkg_name}', stream=True)
+        digests = self.downloader.download(f'{release_url}/{pkg_name}',
+                                           self.pkg_dir / pkg_name)
 
-        if req.status_code != 200:
+        if digests is None:
             print(f'    Unable to download file {pkg_name} '
                   f'from {release_url}')
-            return False
-
-        with open(self.pkg_dir / pkg_name, 'wb') as fh:
-            shutil.copyfileobj(req.raw, fh)
 
-        return True
+        return digests
 
     def download_file(self, pkg_name, release, os_version):
         """
@@ -227,31 +413,214 @@ class RepositoryBase(metaclass=abc.ABCMeta):
             - If not a development version, download from S3, falling
               back to local release mirror if not there
             - Otherwise attempt to download from local release mirror,
-              returning success or failure
+              returning the digests of the file or None on failure
         """
 
         version, in_dev = release
 
-        if not in_dev and self.s3_download_file(pkg_name, os_version):
-            return True
+        if not in_dev:
+            digests = self.s3_download_file(pkg_name, os_version)
+
+            if digests is not None:
+                return digests
 
         return self.lb_download_file(pkg_name, version)
 
     def fetch_package(self, pkg_name, release, os_version):
         """
-        For a given package name and release and OS versiona, acquire
+        For a given package name and release and OS version, acquire
         the package from a generated URL but only if the package is not
-        already in the local storage area
+        already in the package cache; returns the path to the cached
+        package, or None if it couldn't be acquired
         """
 
-        pkg = self.pkg_dir / pkg_name
+        pkg = self.pkg_cache.lookup(pkg_name)
 
-        if not Path(pkg).exists():
-            print(f'Attempting to fetch {pkg_name}')
-            return self.download_file(pkg_name, release, os_version)
-        else:
+        if pkg is not None:
             print(f'Already have {pkg_name} locally, skipping...')
-            return True
+            self.stats.add_file('download', 'skipped')
+            return pkg
+
+        print(f'Attempting to fetch {pkg_name}')
+        digests = self.download_file(pkg_name, release, os_version)
+
+        if digests is None:
+            return None
+
+        self.stats.add_file('download', 'transferred')
+        self.stats.add_bytes('downloaded',
+                             os.path.getsize(self.pkg_dir / pkg_name))
+
+        return self.pkg_cache.add(pkg_name, self.edition, release[0],
+                                  os_version, self.pkg_dir / pkg_name,
+                                  digests)
+
+    @abc.abstractmethod
+    def get_pkg_name(self, version, os_version):
+        """
+        Abstract method for determining the package filename for
+        a given release version and OS version
+        """
+
+        return
+
+    @abc.abstractmethod
+    def package_present(self, pkg_name, os_version):
+        """
+        Abstract method for determining if a package is in the local
+        repository for a given OS version
+        """
+
+        return
+
+    def package_matrix(self):
+        """
+        Generator method to return the package name, release and
+        OS version for each package the repositories should contain,
+        skipping development versions unless doing a staging run;
+        for incremental runs, released versions which are already
+        published (and still in the local repository) are skipped
+        as well
+        """
+
+        for release in self.supported_releases.get_releases():
+            version, in_dev = release
+
+            if not self.staging and in_dev:
+                continue
+
+            for os_version in self.os_versions:
+                pkg_name = self.get_pkg_name(version, os_version)
+
+                if (self.incremental and not in_dev and
+                        self.publish_state.is_published(version, os_version)
+                        and self.package_present(pkg_name, os_version)):
+                    continue
+
+                yield pkg_name, release, os_version
+
+    def acquire_packages(self):
+        """
+        Fetch the full package matrix up front, running several
+        transfers in parallel; the names of the packages which were
+        successfully acquired and their location in the package cache
+        are kept for the import step, missing
+        releases for a given OS version being expected
+        """
+
+        print(f'Acquiring {self.edition} packages using '
+              f'{self.download_workers} parallel transfers...')
+
+        self.fetched_packages = dict()
+
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.download_workers) as executor:
+            futures = dict()
+
+            for pkg_name, release, os_version in self.package_matrix():
+                future = executor.submit(
+                    self.fetch_package, pkg_name, release, os_version
+                )
+                futures[future] = pkg_name
+
+            for future in concurrent.futures.as_completed(futures):
+                pkg = future.result()
+
+                if pkg is not None:
+                    self.fetched_packages[futures[future]] = pkg
+
+        print(f'Acquired {len(self.fetched_packages)} of {len(futures)} '
+              f'{self.edition} packages')
+
+    def acquired_packages(self):
+        """
+        Generator method to return the package name, release and
+        OS version for each package that was successfully acquired
+        """
+
+        if self.fetched_packages is None:
+            self.acquire_packages()
+
+        for pkg_name, release, os_version in self.package_matrix():
+            if pkg_name in self.fetched_packages:
+                yield pkg_name, release, os_version
+
+    def mark_published(self, release, os_version):
+        """
+        Record the package for a release as imported into the local
+        repository for an OS version; development versions are
+        rebuilt, so are always imported again
+        """
+
+        version, in_dev = release
+
+        if not in_dev:
+            self.publish_state.mark_published(version, os_version)
+
+    def package_path(self, pkg_name):
+        """
+        Return the location of an acquired package in the package cache
+        """
+
+        return self.fetched_packages[pkg_name]
+
+    def place_package(self, pkg, dest, link=True):
+        """
+        Place a cached package (or a copy of it which may be modified,
+        if link is false) at the given location, avoiding copying
+        its content where possible
+        """
+
+        method = place_file(pkg, dest, link)
+        self.stats.add_file('place', method)
+
+        if method != 'linked':
+            self.hash_cache.record_copy(pkg, dest)
+
+        if link:
+            self.queue_upload(dest)
+
+    def pipeline_target(self):
+        """
+        Return the local directory and its relative location on S3
+        which packages are placed into, if they can be uploaded before
+        the repositories are finalized, otherwise None
+        """
+
+        return None
+
+    def queue_upload(self, local_path):
+        """
+        For pipelined runs, start uploading a file placed into the
+        local repositories straight away
+        """
+
+        if not self.pipelined:
+            return
+
+        with self.pipeline_lock:
+            if self.pipeline is None:
+                target = self.pipeline_target()
+
+                if target is None:
+                    return
+
+                self.pipeline = UploadPipeline(self, *target)
+
+        self.pipeline.submit(local_path)
+
+    def cancel_pipeline(self):
+        """
+        Cancel any uploads still queued by the pipeline, when the run
+        fails before the final upload collects them
+        """
+
+        with self.pipeline_lock:
+            pipeline, self.pipeline = self.pipeline, None
+
+        if pipeline is not None:
+            print('Cancelling pipelined uploads...')
+            pipeline.cancel()
 
     @abc.abstractmethod
     def import_packages(self):
@@ -270,60 +639,302 @@ class RepositoryBase(metaclass=abc.ABCMeta):
 
         return
 
+    def upload_headers(self, s3_path):
+        """
+        Return the caching and content headers from the first upload
+        policy matching the path of an object
+        """
+
+        for policy in self.upload_policies:
+            if fnmatch.fnmatch(s3_path, policy['pattern']):
+                return {arg: value for arg, value in policy.items()
+                        if arg != 'pattern'}
+
+        return dict()
+
+    def upload_args(self, s3_path, local_path_md5):
+        """
+        Return the arguments for uploading (or copying) an object: the
+        ACL, the MD5 kept in its metadata and the headers for its path
+        """
+
+        return dict({'ACL': 'public-read',
+                     'Metadata': {'md5': local_path_md5}},
+                    **self.upload_headers(s3_path))
+
+    def s3_update_headers(self, local_path_md5, s3_path):
+        """
+        Apply the headers for its path to an object whose content is
+        already up to date, by copying the object onto itself with
+        only its metadata replaced
+        """
+
+        print(f'  Path {s3_path} has outdated headers, updating...')
+        self.s3_throttle.call(
+            self.s3_client.copy_object,
+            Bucket=self.s3_bucket, Key=s3_path,
+            CopySource={'Bucket': self.s3_bucket, 'Key': s3_path},
+            MetadataDirective='REPLACE',
+            **self.upload_args(s3_path, local_path_md5)
+        )
+
     def s3_upload_file(self, local_path, local_path_md5, s3_path):
         """
+        Upload a single file to S3, storing its MD5 in the object's
+        metadata, with the headers for its kind of file
+        """
+
+        print(f'  Path {s3_path} is new or differs, uploading...')
+        self.stats.add_bytes('uploaded', os.path.getsize(local_path))
+        self.s3_throttle.call(
+            self.s3_transfer.upload_file,
+            local_path, self.s3_bucket, s3_path,
+            extra_args=self.upload_args(s3_path, local_path_md5)
+        )
 
+    def s3_copy_file(self, local_path, local_path_md5, s3_path):
+        """
+        Copy an object already in the bucket with the same content as
+        the local file to the given path, entirely within S3 (using
+        a multipart copy for large objects), storing the MD5 in the new
+        object's metadata; returns False if no such object is known or
+        the copy failed (say the object no longer exists)
         """
 
-        print(f'Searching {s3_path} in {self.s3_bucket}')
-        obj = self.s3.Object(self.s3_bucket, s3_path)
+        source = self.pkg_cache.lookup_s3_object(local_path_md5,
+                                                 self.s3_bucket)
+
+        if source is None or source == s3_path:
+            return False
 
-        # If the loading of the object fails, it doesn't exist
-        # and the file it's connected to needs to be uploaded;
-        # otherwise check the MD5 sum stored in S3 for the file
-        # to the one locally and only upload if it's different
-        # (or the MD5 metadata is missing on S3 for that file)
+        # The source may have been overwritten since it was recorded
+        # (say by another tool), so its content is checked first and
+        # the copy made only if it's still the object that was checked
         try:
-            obj.load()
+            head = self.s3_throttle.call(self.s3_client.head_object,
+                                         Bucket=self.s3_bucket, Key=source)
         except botocore.exceptions.ClientError:
-            print(f'  Path {s3_path} not found, uploading...')
-            obj.upload_file(
-                local_path,
-                ExtraArgs={'ACL': 'public-read',
-                           'Metadata': {'md5': local_path_md5}}
+            head = None
+
+        if head is None or head['Metadata'].get('md5') != local_path_md5:
+            print(f'  Object {source} no longer holds the content for '
+                  f'{s3_path}')
+            self.pkg_cache.remove_s3_object(local_path_md5, self.s3_bucket)
+            return False
+
+        print(f'  Path {s3_path} is new or differs, copying from '
+              f'{source}...')
+
+        try:
+            self.s3_throttle.call(
+                self.s3_client.copy,
+                {'Bucket': self.s3_bucket, 'Key': source},
+                self.s3_bucket, s3_path,
+                ExtraArgs=dict(self.upload_args(s3_path, local_path_md5),
+                               MetadataDirective='REPLACE',
+                               CopySourceIfMatch=head['ETag']),
+                Config=self.transfer_config
             )
+        except botocore.exceptions.ClientError as exc:
+            print(f'  Unable to copy {source} to {s3_path}: {exc}')
+            self.pkg_cache.remove_s3_object(local_path_md5, self.s3_bucket)
+            return False
+
+        self.stats.add_bytes('copied', os.path.getsize(local_path))
+
+        return True
+
+    def s3_sync_file(self, local_path, s3_path, inventory):
+        """
+        Worker for the upload pool: hash the local file and compare
+        it against the remote inventory, only uploading the file if
+        it's missing from S3 or differs; content already held by
+        another object in the bucket is copied from it instead, and
+        unchanged objects only have their headers brought up to date
+        """
+
+        local_path_md5 = self.get_md5(local_path)
+        headers = self.upload_headers(s3_path)
+
+        if inventory.md5(s3_path) == local_path_md5:
+            if inventory.headers(s3_path) == headers:
+                self.stats.add_file('upload', 'skipped')
+                return 'skipped'
+
+            self.s3_update_headers(local_path_md5, s3_path)
+            inventory.record(s3_path, local_path_md5, headers)
+            self.stats.add_file('upload', 'updated')
+            return 'updated'
+
+        if self.s3_copy_file(local_path, local_path_md5, s3_path):
+            self.stats.add_file('upload', 'copied')
+            outcome = 'copied'
         else:
-            print(f'  Path {s3_path} exists, checking MD5...')
+            self.s3_upload_file(local_path, local_path_md5, s3_path)
+            self.stats.add_file('upload', 'transferred')
+            outcome = 'uploaded'
 
-            if ('md5' in obj.metadata and
-                    obj.metadata['md5'] == local_path_md5):
-                print(f'        It matches, skipping...')
-            else:
-                print(f'        It does not exist or differs, '
-                      f'uploading...')
-                obj.upload_file(
-                    local_path,
-                    ExtraArgs={'ACL': 'public-read',
-                               'Metadata': {'md5': local_path_md5}}
-                )
+        inventory.record(s3_path, local_path_md5, headers)
+        self.pkg_cache.add_s3_object(local_path_md5, self.s3_bucket, s3_path)
+
+        return outcome
+
+    def load_inventory(self, rel_base_dir):
+        """
+        Build the remote inventory for a given directory on S3; the
+        MD5 index for it is kept alongside the repositories under
+        the S3 base path
+        """
+
+        return RemoteInventory(
+            self.s3_client, self.s3_bucket,
+            os.path.join(self.s3_package_base, rel_base_dir),
+            os.path.join(self.s3_package_base, '.md5-index',
+                         f'{rel_base_dir}.json')
+        ).load()
+
+    @staticmethod
+    def upload_tier(relative_path):
+        """
+        Return the upload tier for a file: 0 for packages and other
+        files, 1 for indexes and 2 for the top-level indexes
+        """
+
+        parts = relative_path.split(os.sep)
+
+        if parts[-1] in TOP_INDEX_FILES:
+            return 2
+
+        if any(part in INDEX_DIRS for part in parts[:-1]):
+            return 1
+
+        return 0
+
+    @staticmethod
+    def print_upload_summary(rel_base_dir, results):
+        """
+        Print the per-file outcome of an upload run, followed by
+        the totals for each outcome
+        """
+
+        print(f'Upload summary for {rel_base_dir}:')
+
+        for s3_path in sorted(results):
+            print(f'    {results[s3_path]:<10} {s3_path}')
+
+        totals = {}
+
+        for result in results.values():
+            status = result.split(':', 1)[0]
+            totals[status] = totals.get(status, 0) + 1
+
+        print('    ' + ', '.join(f'{count} {status}'
+                                  for status, count in sorted(totals.items())))
 
     def s3_upload(self, base_dir, rel_base_dir):
         """
         Upload a given directory tree to S3; uses additional metadata
         to maintain an MD5 for each file to prevent unnecessary uploads
         and speed up the synchronization
+
+        The destination is listed once up front and the local tree
+        compared against that inventory, so only new or changed files
+        reach the network; files are handled by a bounded pool of
+        workers so hashing and uploads overlap across files, and
+        failures are reported once every file has been tried
+
+        Files are uploaded in tiers, each only once the previous one
+        has succeeded: packages first, then the indexes listing them
+        and finally the top-level (signed) indexes, so the repository
+        on S3 never refers to files which aren't there yet.  A directory
+        already uploaded during the run (by another repository sharing
+        it) is skipped
         """
 
+        with self.shared.upload_lock:
+            if (str(base_dir), rel_base_dir) in self.shared.uploaded:
+                print(f'{base_dir} already uploaded to {rel_base_dir}')
+                return
+
+            self.shared.uploaded.add((str(base_dir), rel_base_dir))
+
+        # Files already uploaded by the pipeline are left out, though
+        # those it failed to upload are tried again
+        with self.pipeline_lock:
+            pipeline = self.pipeline
+
+            if pipeline is not None and \
+                    pipeline.matches(base_dir, rel_base_dir):
+                self.pipeline = None
+            else:
+                pipeline = None
+
+        if pipeline is not None:
+            inventory, results = pipeline.finish()
+            results = {path: result for path, result in results.items()
+                       if not result.startswith('failed')}
+        else:
+            inventory = self.load_inventory(rel_base_dir)
+            results = dict()
+
+        tiers = ([], [], [])
+
         for root, dirs, files in os.walk(base_dir):
             for filename in files:
                 local_path = os.path.join(root, filename)
-                local_path_md5 = self.get_md5(local_path)
                 relative_path = os.path.relpath(local_path, base_dir)
                 s3_path = os.path.join(
                     self.s3_package_base, rel_base_dir, relative_path
                 )
 
-                self.s3_upload_file(local_path, local_path_md5, s3_path)
+                if s3_path not in results:
+                    tiers[self.upload_tier(relative_path)].append(
+                        (local_path, s3_path)
+                    )
+
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.upload_workers) as executor:
+            for tier in tiers:
+                # Indexes must never refer to files which failed
+                if any(result.startswith('failed')
+                       for result in results.values()):
+                    for _, s3_path in tier:
+                        results[s3_path] = 'failed: not attempted'
+                    continue
+
+                futures = {
+                    executor.submit(self.s3_sync_file, local_path, s3_path,
+                                    inventory): s3_path
+                    for local_path, s3_path in tier
+                }
+
+                for future in concurrent.futures.as_completed(futures):
+                    s3_path = futures[future]
+
+                    try:
+                        results[s3_path] = future.result()
+                    except Exception as exc:
+                        results[s3_path] = f'failed: {exc}'
+
+        inventory.save()
+        self.print_upload_summary(rel_base_dir, results)
+        failed = [path for path, result in results.items()
+                  if result.startswith('failed')]
+
+        if failed:
+            raise RuntimeError(
+                f'Unable to upload {len(failed)} file(s) from {base_dir} '
+                f'to {self.s3_bucket}'
+            )
+
+    def save_publish_state(self):
+        """
+        For incremental runs, save the record of published packages
+        once the local repositories have been finalized
+        """
+
+        if self.incremental:
+            self.publish_state.save()
 
     @abc.abstractmethod
     def upload_local_repos(self):
@@ -339,12 +950,22 @@ class RepositoryBase(metaclass=abc.ABCMeta):
         Abstract method for handling the full process of creating
         and uploading the package repository; uses a context manager
         to handle the starting and stopping of the repository servers
+
+        The wall time of each phase is recorded in the run statistics
         """
 
         with self.handle_repo_server():
-            self.import_gpg_keys()
-            self.prepare_local_repos()
-            self.seed_local_repos()
-            self.import_packages()
-            self.finalize_local_repos()
-            self.upload_local_repos()
+            try:
+                for phase in [self.import_gpg_keys, self.prepare_local_repos,
+                              self.seed_local_repos, self.acquire_packages,
+                              self.import_packages,
+                              self.finalize_local_repos]:
+                    with self.stats.phase(phase.__name__):
+                        phase()
+
+                self.save_publish_state()
+
+                with self.stats.phase('upload_local_repos'):
+                    self.upload_local_repos()
+            finally:
+                self.cancel_pipeline()
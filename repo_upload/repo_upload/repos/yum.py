@@ -6,6 +6,7 @@ its API server that helps to avoid needing to call out to external
 commands for the various steps
 """
 
+import concurrent.futures
 import contextlib
 import os
 import shutil
@@ -16,6 +17,8 @@ from pkg_resources import resource_filename
 
 import pexpect
 
+from repo_upload import rpmheader
+from repo_upload.repodata import Delta, Package, RepodataGenerator
 from repo_upload.repos.base import RepositoryBase
 
 
@@ -24,18 +27,50 @@ class YumRepository(RepositoryBase):
     Manages creating and uploading APT package repositories
     """
 
-    def __init__(self, args, common_info):
+    def __init__(self, args, common_info, shared=None):
         """
         Load in Yum-specific data from JSON file and initialize various
         common parameters
         """
 
-        super().__init__(args, common_info)
+        super().__init__(args, common_info, shared)
 
         data = self.load_config('yum.json')
 
         self.os_versions = data['os_versions']
         self.repo_dir = self.local_repo_root / self.edition / 'rpm'
+        self.publish_state = self.load_publish_state()
+        self.sign_workers = common_info.getint('sign_workers', fallback=2)
+        self.sign_batch_size = \
+            common_info.getint('sign_batch_size', fallback=16)
+
+        # Repository metadata is generated natively from the package
+        # headers unless createrepo is requested
+        self.use_createrepo = \
+            common_info.get('yum_metadata', 'native') == 'createrepo'
+        self.sqlite = common_info.getboolean('yum_sqlite', fallback=True)
+        self.zchunk = common_info.getboolean('yum_zchunk', fallback=False)
+        self.repodata = RepodataGenerator(
+            self.cache_dir / 'repodata', self.read_rpm_header,
+            sqlite=self.sqlite, zchunk=self.zchunk
+        )
+
+        # Only createrepo_c can produce zchunk metadata, and which
+        # createrepo is installed can't be relied upon
+        if self.zchunk and self.use_createrepo:
+            raise RuntimeError('Zchunk metadata needs native Yum metadata '
+                               '(yum_metadata = native)')
+
+        # Deltas between consecutive releases are only listed in
+        # natively generated metadata
+        self.deltarpms = \
+            common_info.getboolean('yum_deltarpms', fallback=False)
+        self.deltarpm_workers = \
+            common_info.getint('deltarpm_workers', fallback=2)
+
+        if self.deltarpms and self.use_createrepo:
+            raise RuntimeError('Delta RPMs need native Yum metadata '
+                               '(yum_metadata = native)')
 
     def start_yumapi_server(self):
         """
@@ -126,8 +161,18 @@ class YumRepository(RepositoryBase):
             conf_dir = self.repo_dir / os_version / 'x86_64'
             os.makedirs(conf_dir, exist_ok=True)
 
+            # Native metadata is only generated once packages are
+            # imported, and repositories kept from a previous
+            # incremental run already have their metadata
+            if not self.use_createrepo:
+                continue
+
+            if (self.incremental and
+                    (conf_dir / 'repodata' / 'repomd.xml').exists()):
+                continue
+
             proc = subprocess.run(
-                ['createrepo', conf_dir],
+                ['createrepo'] + self.createrepo_options() + [conf_dir],
                 stdout=subprocess.PIPE, stderr=subprocess.PIPE
             )
 
@@ -148,101 +193,267 @@ class YumRepository(RepositoryBase):
         return (f'{self.s3_package_base}/{self.edition}/rpm/'
                 f'{os_version}/x86_64')
 
-    @staticmethod
-    def is_signed(pkg):
+    def read_rpm_header(self, pkg):
         """
-        Check to see if an RPM package is signed
+        Return the headers of an RPM package, which are cached
+        for as long as the package file is unchanged
         """
 
-        proc = subprocess.run(
-            ['rpm', '-qpi', pkg],
-            stdout=subprocess.PIPE, stderr=subprocess.PIPE
+        data = self.hash_cache.get_metadata(
+            pkg, 'rpm-header',
+            lambda filename: rpmheader.read_header(filename).to_dict()
         )
-        output = proc.stdout.decode().split('\n')
-        signed = None
 
-        for line in output:
-            if line.startswith('Signature'):
-                signed = line.split(':', 1)[1].strip()
-                break
+        return rpmheader.RpmHeader.from_dict(data)
 
-        return True if signed != '(none)' else False
+    def is_signed(self, pkg):
+        """
+        Check to see if an RPM package is signed
+        """
 
-    def sign_rpm(self, pkg_name):
+        return self.read_rpm_header(pkg).is_signed()
+
+    def sign_rpms(self, pkgs):
         """
-        Sign RPM package: uses 'rpm --resign' with a few defines
-        to accomplish this, and requires pexpect (interactive)
+        Sign a batch of RPM packages with a single 'rpm --addsign'
+        (along with a few defines); the key is expected to be held
+        by the GPG agent, though older versions of rpm still prompt
+        for a passphrase once, so pexpect answers that if needed
         """
 
         cmd = 'rpm'
-        args = ['--resign', '-D', '_signature gpg',
-                '-D', f'_gpg_name {self.rpm_key}',
-                str(self.pkg_dir / pkg_name)]
-
-        print(f'    Signing {self.pkg_dir / pkg_name}...')
-        try:
-            child = pexpect.spawn(cmd, args)
-            child.expect('Enter pass phrase: ')
+        args = ['--addsign', '-D', '_signature gpg',
+                '-D', f'_gpg_name {self.rpm_key}'] + [str(pkg) for pkg in pkgs]
+
+        print(f'    Signing {len(pkgs)} packages...')
+        child = pexpect.spawn(cmd, args, timeout=None)
+
+        if child.expect(['Enter pass phrase: ', pexpect.EOF]) == 0:
             child.sendline('')
             child.expect(pexpect.EOF)
-        except pexpect.EOF:
+
+        child.close()
+
+        if child.exitstatus:
             raise RuntimeError(
-                f'Unable to sign package {self.pkg_dir / pkg_name}: '
+                f'Unable to sign packages {", ".join(map(str, pkgs))}: '
                 f'{child.before}'
             )
 
+    def sign_packages(self, pkgs):
+        """
+        Return signed versions of the given cached packages; each
+        distinct package content is signed only once, signed copies
+        are kept in the package cache for later runs, and packages
+        still needing signing are signed in batches run in parallel
+        """
+
+        kind = f'signed-{self.rpm_key}'
+        signed = dict()
+        to_sign = list()
+        sign_dir = self.pkg_dir / 'signing'
+        os.makedirs(sign_dir, exist_ok=True)
+
+        for pkg in set(pkgs):
+            if self.is_signed(pkg):
+                signed[pkg] = pkg
+                continue
+
+            # Cached packages are stored under their SHA256
+            digest = pkg.name
+            signed_pkg = self.pkg_cache.lookup_derived(digest, kind)
+
+            if signed_pkg is not None:
+                signed[pkg] = signed_pkg
+                continue
+
+            work_file = sign_dir / f'{digest}.rpm'
+            self.place_package(pkg, work_file, link=False)
+            to_sign.append((pkg, work_file))
+
+        batches = [to_sign[idx:idx + self.sign_batch_size]
+                   for idx in range(0, len(to_sign), self.sign_batch_size)]
+
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.sign_workers) as executor:
+            futures = [
+                executor.submit(self.sign_rpms,
+                                [work_file for _, work_file in batch])
+                for batch in batches
+            ]
+
+            for future in futures:
+                future.result()
+
+        for pkg, work_file in to_sign:
+            signed[pkg] = self.pkg_cache.add_derived(pkg.name, kind,
+                                                     work_file)
+
+        return signed
+
+    def get_pkg_name(self, version, os_version):
+        """
+        Determine the RPM package filename for a given release
+        version and OS version
+        """
+
+        return (f'couchbase-server-{self.edition}-{version}-'
+                f'centos{os_version}.x86_64.rpm')
+
+    def package_present(self, pkg_name, os_version):
+        """
+        Determine if a package is in the local repository for
+        a given OS version
+        """
+
+        return (self.repo_dir / os_version / 'x86_64' / pkg_name).exists()
+
+    def pipeline_target(self):
+        """
+        Packages are placed straight into the local repositories,
+        so can be uploaded as soon as they're placed
+        """
+
+        return self.repo_dir, os.path.join(self.edition, 'rpm')
+
     def import_packages(self):
         """
         Import all available versions of the packages for each
         of the OS versions, ignoring any 'missing' releases for
-        a given OS version
+        a given OS version; unsigned packages are signed first
         """
 
-        if not self.pkg_dir.exists():
-            os.makedirs(self.pkg_dir)
-
         print(f'Importing into local {self.edition} repositories '
               f'at {self.repo_dir}')
 
-        for release in self.supported_releases.get_releases():
-            version, in_dev = release
+        packages = list(self.acquired_packages())
+        signed = self.sign_packages(
+            [self.package_path(pkg_name) for pkg_name, _, _ in packages]
+        )
 
-            # If aren't doing a staging run and we have
-            # a development version, skip it
-            if not self.staging and in_dev:
-                continue
+        for pkg_name, release, os_version in packages:
+            print(f'    Placing file {pkg_name} in RedHat repository '
+                  f'{os_version}/x86_64...')
+            pkg = signed[self.package_path(pkg_name)]
+            pkg_basepath = self.repo_dir / os_version / 'x86_64'
+            self.place_package(pkg, pkg_basepath / pkg_name)
+            self.mark_published(release, os_version)
 
-            for os_version in self.os_versions:
-                pkg_name = (f'couchbase-server-{self.edition}-{version}-'
-                            f'centos{os_version}.x86_64.rpm')
+        print(f'RedHat repositories ready for signing')
 
-                if self.fetch_package(pkg_name, release, os_version):
-                    print(
-                        f'    Copying file {pkg_name} to RedHat repository '
-                        f'{os_version}/x86_64...'
-                    )
-                    pkg_basepath = self.repo_dir / os_version / 'x86_64'
-                    shutil.copy(self.pkg_dir / pkg_name, pkg_basepath)
+    def make_deltarpm(self, old_pkg, new_pkg):
+        """
+        Return the deltarpm from one package to another along with
+        its sequence (which identifies the package it applies to);
+        both are kept in the package cache, so each delta is only
+        made once
+        """
 
-                    if not self.is_signed(pkg_basepath / pkg_name):
-                        self.sign_rpm(pkg_basepath / pkg_name)
+        old_digest = \
+            self.hash_cache.get_digests(old_pkg, ('sha256',))['sha256']
+        new_digest = \
+            self.hash_cache.get_digests(new_pkg, ('sha256',))['sha256']
+        kind = f'deltarpm-{old_digest}'
+        delta = self.pkg_cache.lookup_derived(new_digest, kind)
+        sequence = self.pkg_cache.lookup_derived(new_digest,
+                                                 f'{kind}-sequence')
+
+        if delta is None or sequence is None:
+            print(f'    Making deltarpm from {old_pkg.name} to '
+                  f'{new_pkg.name}...')
+            delta_dir = self.pkg_dir / 'deltas'
+            os.makedirs(delta_dir, exist_ok=True)
+            work_file = delta_dir / f'{old_digest}-{new_digest}.drpm'
+            sequence_file = delta_dir / f'{old_digest}-{new_digest}.seq'
 
-        print(f'RedHat repositories ready for signing')
+            proc = subprocess.run(
+                ['makedeltarpm', '-s', sequence_file, old_pkg, new_pkg,
+                 work_file],
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE
+            )
 
-    def finalize_local_repos(self):
+            if proc.returncode:
+                raise RuntimeError(
+                    f'Unable to make deltarpm from {old_pkg.name} to '
+                    f'{new_pkg.name}: {proc.stderr.decode().strip()}'
+                )
+
+            delta = self.pkg_cache.add_derived(new_digest, kind, work_file)
+            sequence = self.pkg_cache.add_derived(
+                new_digest, f'{kind}-sequence', sequence_file
+            )
+
+        with open(sequence) as fh:
+            return delta, fh.read().strip()
+
+    def update_deltas(self, os_version, conf_dir):
         """
-        Sign the local repositories in preparation for the upload to S3
+        Bring the deltarpms for a repository up to date, with a delta
+        between each pair of consecutive released versions it holds,
+        removing any deltas no longer needed; returns the deltas
         """
 
-        print(f'Signing local {self.edition} repositories at {self.repo_dir}')
+        pkgs = [conf_dir / self.get_pkg_name(version, os_version)
+                for version, in_dev in self.supported_releases.get_releases()
+                if not in_dev]
+        pkgs = [pkg for pkg in pkgs if pkg.exists()]
+        pairs = list(zip(pkgs, pkgs[1:]))
+        delta_dir = conf_dir / 'drpms'
+        os.makedirs(delta_dir, exist_ok=True)
+
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.deltarpm_workers) as executor:
+            made = list(executor.map(lambda pair: self.make_deltarpm(*pair),
+                                     pairs))
+
+        deltas = list()
+
+        for (old_pkg, new_pkg), (delta, sequence) in zip(pairs, made):
+            _, _, old_version, old_release, _ = \
+                self.read_rpm_header(old_pkg).nevra()
+            name, _, version, release, arch = \
+                self.read_rpm_header(new_pkg).nevra()
+            delta_name = (f'{name}-{old_version}-{old_release}_'
+                          f'{version}-{release}.{arch}.drpm')
+            self.place_package(delta, delta_dir / delta_name)
+
+            # Cached content is stored under its SHA256
+            deltas.append(Delta(
+                href=f'drpms/{delta_name}', path=delta_dir / delta_name,
+                sha256=delta.name, sequence=sequence, old=old_pkg,
+                new=new_pkg
+            ))
+
+        current = {delta.path.name for delta in deltas}
+
+        for delta_file in delta_dir.glob('*.drpm'):
+            if delta_file.name not in current:
+                delta_file.unlink()
+
+        return deltas
+
+    def createrepo_options(self):
+        """
+        Return the createrepo options for the additional metadata
+        """
 
-        for os_version in self.os_versions:
-            conf_dir = self.repo_dir / os_version / 'x86_64'
-            repomd_file = conf_dir / 'repodata' / 'repomd.xml'
-            signed_repomd_file = f'{repomd_file}.asc'
+        return ['--database' if self.sqlite else '--no-database']
+
+    def update_metadata(self, os_version, conf_dir):
+        """
+        Bring the metadata for a repository up to date with the
+        packages it contains
+        """
+
+        # Deltas left from a run with them enabled are no longer
+        # listed in the metadata, so mustn't be published
+        if not self.deltarpms:
+            shutil.rmtree(conf_dir / 'drpms', ignore_errors=True)
 
+        if self.use_createrepo:
             proc = subprocess.run(
-                ['createrepo', '--update', conf_dir],
+                ['createrepo', '--update'] + self.createrepo_options() +
+                [conf_dir],
                 stdout=subprocess.PIPE, stderr=subprocess.PIPE
             )
 
@@ -251,6 +462,32 @@ class YumRepository(RepositoryBase):
                     f'Unable to update RedHat repository {os_version}/x86_64'
                 )
 
+            return
+
+        packages = [
+            Package(href=pkg.name, path=pkg,
+                    sha256=self.hash_cache.get_digests(pkg, ('sha256',))
+                    ['sha256'])
+            for pkg in sorted(conf_dir.glob('*.rpm'))
+        ]
+        deltas = self.update_deltas(os_version, conf_dir) \
+            if self.deltarpms else ()
+        self.repodata.generate(conf_dir, packages, deltas)
+
+    def finalize_local_repos(self):
+        """
+        Sign the local repositories in preparation for the upload to S3
+        """
+
+        print(f'Signing local {self.edition} repositories at {self.repo_dir}')
+
+        for os_version in self.os_versions:
+            conf_dir = self.repo_dir / os_version / 'x86_64'
+            repomd_file = conf_dir / 'repodata' / 'repomd.xml'
+            signed_repomd_file = f'{repomd_file}.asc'
+
+            self.update_metadata(os_version, conf_dir)
+
             signed_data = self.gpg.sign_file(
                 open(repomd_file, 'rb'), keyid=self.rpm_key, detach=True,
                 output=signed_repomd_file
@@ -0,0 +1,268 @@
+"""
+Pure Python reader for RPM package headers
+
+Reads the lead, the signature header and the main header of an RPM
+package without reading its payload (or running the rpm command),
+providing signature information, the package's NEVRA, its digests
+and the data needed to generate repository metadata
+"""
+
+import struct
+
+
+LEAD_MAGIC = b'\xed\xab\xee\xdb'
+HEADER_MAGIC = b'\x8e\xad\xe8\x01'
+LEAD_SIZE = 96
+
+# Data types of header entries
+TYPE_NULL = 0
+TYPE_CHAR = 1
+TYPE_INT8 = 2
+TYPE_INT16 = 3
+TYPE_INT32 = 4
+TYPE_INT64 = 5
+TYPE_STRING = 6
+TYPE_BIN = 7
+TYPE_STRING_ARRAY = 8
+TYPE_I18NSTRING = 9
+
+INT_FORMATS = {
+    TYPE_CHAR: 'B', TYPE_INT8: 'B', TYPE_INT16: 'H',
+    TYPE_INT32: 'I', TYPE_INT64: 'Q',
+}
+
+# Signature header tags
+SIGTAG_SIZE = 1000
+SIGTAG_PGP = 1002
+SIGTAG_MD5 = 1004
+SIGTAG_GPG = 1005
+SIGTAG_PAYLOADSIZE = 1007
+SIGTAG_DSA = 267
+SIGTAG_RSA = 268
+SIGTAG_SHA1 = 269
+SIGTAG_LONGSIZE = 270
+SIGTAG_LONGARCHIVESIZE = 271
+SIGTAG_SHA256 = 273
+SIGNATURE_TAGS = (SIGTAG_PGP, SIGTAG_GPG, SIGTAG_DSA, SIGTAG_RSA)
+
+# Main header tags
+TAG_NAME = 1000
+TAG_VERSION = 1001
+TAG_RELEASE = 1002
+TAG_EPOCH = 1003
+TAG_SUMMARY = 1004
+TAG_DESCRIPTION = 1005
+TAG_BUILDTIME = 1006
+TAG_BUILDHOST = 1007
+TAG_SIZE = 1009
+TAG_VENDOR = 1011
+TAG_LICENSE = 1014
+TAG_PACKAGER = 1015
+TAG_GROUP = 1016
+TAG_URL = 1020
+TAG_ARCH = 1022
+TAG_OLDFILENAMES = 1027
+TAG_FILESIZES = 1028
+TAG_FILEMODES = 1030
+TAG_FILEFLAGS = 1037
+TAG_SOURCERPM = 1044
+TAG_ARCHIVESIZE = 1046
+TAG_PROVIDENAME = 1047
+TAG_REQUIREFLAGS = 1048
+TAG_REQUIRENAME = 1049
+TAG_REQUIREVERSION = 1050
+TAG_CONFLICTFLAGS = 1053
+TAG_CONFLICTNAME = 1054
+TAG_CONFLICTVERSION = 1055
+TAG_CHANGELOGTIME = 1080
+TAG_CHANGELOGNAME = 1081
+TAG_CHANGELOGTEXT = 1082
+TAG_OBSOLETENAME = 1090
+TAG_PROVIDEFLAGS = 1112
+TAG_PROVIDEVERSION = 1113
+TAG_OBSOLETEFLAGS = 1114
+TAG_OBSOLETEVERSION = 1115
+TAG_DIRINDEXES = 1116
+TAG_BASENAMES = 1117
+TAG_DIRNAMES = 1118
+TAG_LONGSIZE = 5009
+TAG_PAYLOADDIGEST = 5092
+TAG_PAYLOADDIGESTALGO = 5093
+
+# Digest algorithm identifiers (from RFC 4880) used by rpm
+DIGEST_ALGORITHMS = {1: 'md5', 2: 'sha1', 8: 'sha256', 9: 'sha384',
+                     10: 'sha512'}
+
+
+class RpmHeader:
+    """
+    The signature and main headers of an RPM package, along with
+    the byte range of the main header within the file
+    """
+
+    def __init__(self, signature, header, header_start, header_end):
+        """
+        Store the parsed headers, which map tags to their values
+        """
+
+        self.signature = signature
+        self.header = header
+        self.header_start = header_start
+        self.header_end = header_end
+
+    def get(self, tag, default=None):
+        """
+        Return the value of a main header tag, with single values
+        (such as integers, stored as lists) unpacked
+        """
+
+        value = self.header.get(tag, default)
+
+        if isinstance(value, list) and len(value) == 1 and \
+                not isinstance(value[0], str):
+            return value[0]
+
+        return value
+
+    def is_signed(self):
+        """
+        Determine if the package has a GPG/PGP signature
+        """
+
+        return any(tag in self.signature for tag in SIGNATURE_TAGS)
+
+    def nevra(self):
+        """
+        Return the name, epoch, version, release and architecture
+        """
+
+        return (self.get(TAG_NAME), self.get(TAG_EPOCH, 0),
+                self.get(TAG_VERSION), self.get(TAG_RELEASE),
+                self.get(TAG_ARCH))
+
+    def payload_digests(self):
+        """
+        Return the digests recorded in the package: the header
+        digests and MD5 from the signature header, and the payload
+        digest from the main header
+        """
+
+        digests = dict()
+
+        for tag, name in ((SIGTAG_SHA1, 'header_sha1'),
+                          (SIGTAG_SHA256, 'header_sha256'),
+                          (SIGTAG_MD5, 'header_payload_md5')):
+            if tag in self.signature:
+                digests[name] = self.signature[tag]
+
+        if TAG_PAYLOADDIGEST in self.header:
+            algo = self.get(TAG_PAYLOADDIGESTALGO, 8)
+            digests[f'payload_{DIGEST_ALGORITHMS.get(algo, algo)}'] = \
+                self.header[TAG_PAYLOADDIGEST][0]
+
+        return digests
+
+    def to_dict(self):
+        """
+        Return a JSON-serializable form of the headers
+        """
+
+        return {
+            'signature': {str(tag): val
+                          for tag, val in self.signature.items()},
+            'header': {str(tag): val for tag, val in self.header.items()},
+            'header_start': self.header_start,
+            'header_end': self.header_end,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        """
+        Recreate the headers from the form returned by to_dict
+        """
+
+        return cls(
+            {int(tag): val for tag, val in data['signature'].items()},
+            {int(tag): val for tag, val in data['header'].items()},
+            data['header_start'], data['header_end']
+        )
+
+
+def parse_entry(store, data_type, offset, count):
+    """
+    Decode the value of a single header entry from the data store;
+    binary values are returned as hex strings
+    """
+
+    if data_type in INT_FORMATS:
+        fmt = f'>{count}{INT_FORMATS[data_type]}'
+        return list(struct.unpack_from(fmt, store, offset))
+
+    if data_type == TYPE_BIN:
+        return store[offset:offset + count].hex()
+
+    if data_type in (TYPE_STRING, TYPE_STRING_ARRAY, TYPE_I18NSTRING):
+        values = list()
+
+        for _ in range(count if data_type != TYPE_STRING else 1):
+            end = store.index(b'\0', offset)
+            values.append(store[offset:end].decode('utf-8', 'replace'))
+            offset = end + 1
+
+        return values[0] if data_type == TYPE_STRING else values
+
+    return None
+
+
+def read_header_structure(fh):
+    """
+    Read a header structure from the current position in the file,
+    returning the tags and their values along with its total size
+    """
+
+    intro = fh.read(16)
+
+    if len(intro) != 16 or intro[:4] != HEADER_MAGIC:
+        raise ValueError('Bad RPM header magic')
+
+    nindex, hsize = struct.unpack('>II', intro[8:])
+    index = fh.read(16 * nindex)
+    store = fh.read(hsize)
+
+    if len(index) != 16 * nindex or len(store) != hsize:
+        raise ValueError('Truncated RPM header')
+
+    tags = dict()
+
+    for idx in range(nindex):
+        tag, data_type, offset, count = \
+            struct.unpack_from('>IIII', index, idx * 16)
+
+        # Region tags (61-63) only describe the header's own layout
+        if 61 <= tag <= 63:
+            continue
+
+        tags[tag] = parse_entry(store, data_type, offset, count)
+
+    return tags, 16 + 16 * nindex + hsize
+
+
+def read_header(filename):
+    """
+    Read the headers of an RPM package
+    """
+
+    with open(filename, 'rb') as fh:
+        lead = fh.read(LEAD_SIZE)
+
+        if len(lead) != LEAD_SIZE or lead[:4] != LEAD_MAGIC:
+            raise ValueError(f'{filename} is not an RPM package')
+
+        signature, sig_size = read_header_structure(fh)
+
+        # The signature header is padded to a multiple of 8 bytes
+        fh.read(-sig_size % 8)
+        header_start = LEAD_SIZE + sig_size + (-sig_size % 8)
+        header, size = read_header_structure(fh)
+
+    return RpmHeader(signature, header, header_start, header_start + size)
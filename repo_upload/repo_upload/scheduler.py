@@ -0,0 +1,163 @@
+"""
+Runs the updates of several repositories in a single process
+
+The phases of each repository update become stages of a dependency
+graph, run by a small scheduler which starts each stage as soon as
+the stages it depends on have completed, so independent work (such as
+downloading one repository's packages while another is published)
+runs concurrently.  The repositories share their caches, clients and
+statistics, and work common to all of them (importing the GPG keys,
+uploading the keys directory) is only done once
+"""
+
+import concurrent.futures
+import contextlib
+
+
+class Scheduler:
+    """
+    Runs named stages, each once all of its dependencies have
+    completed successfully
+    """
+
+    def __init__(self, workers, stats):
+        """
+        Set up an empty schedule, running up to workers stages at once
+        and recording the time of each in the run statistics
+        """
+
+        self.workers = workers
+        self.stats = stats
+        self.stages = dict()
+
+    def add(self, name, func, deps=()):
+        """
+        Add a stage, depending on the stages with the given names
+        """
+
+        self.stages[name] = (func, tuple(deps))
+
+        return name
+
+    def run_stage(self, name, func):
+        """
+        Run a single stage, timing it
+        """
+
+        print(f'Starting stage {name}')
+
+        with self.stats.phase(name):
+            func()
+
+        print(f'Completed stage {name}')
+
+    def run(self):
+        """
+        Run all the stages; a failed stage causes the stages depending
+        on it to be skipped, with all the failures reported together
+        once everything else has run
+        """
+
+        pending = dict(self.stages)
+        completed = set()
+        failed = dict()
+
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.workers) as executor:
+            running = dict()
+
+            while pending or running:
+                for name, (func, deps) in list(pending.items()):
+                    blocked = [dep for dep in deps if dep in failed]
+
+                    if blocked:
+                        failed[name] = f'skipped as {blocked[0]} failed'
+                        del pending[name]
+                    elif all(dep in completed for dep in deps):
+                        future = executor.submit(self.run_stage, name, func)
+                        running[future] = name
+                        del pending[name]
+
+                if not running:
+                    if pending:
+                        raise RuntimeError(
+                            f'Unable to schedule stages '
+                            f'{", ".join(sorted(pending))}: '
+                            f'missing or circular dependencies'
+                        )
+                    break
+
+                done, _ = concurrent.futures.wait(
+                    running, return_when=concurrent.futures.FIRST_COMPLETED
+                )
+
+                for future in done:
+                    name = running.pop(future)
+
+                    try:
+                        future.result()
+                        completed.add(name)
+                    except Exception as exc:
+                        print(f'Stage {name} failed: {exc}')
+                        failed[name] = exc
+
+        if failed:
+            for name, exc in sorted(failed.items()):
+                print(f'    {name}: {exc}')
+
+            raise RuntimeError(
+                f'{len(failed)} of {len(self.stages)} stages failed'
+            )
+
+
+def update_repositories(targets, workers):
+    """
+    Update several repositories, given as (name, repository) pairs,
+    concurrently; all of them must share the same resources.  The
+    repository servers are run for the whole update
+    """
+
+    first = targets[0][1]
+    scheduler = Scheduler(workers, first.stats)
+    gpg_stage = scheduler.add('import_gpg_keys', first.import_gpg_keys)
+
+    # Preparation writes files shared by both editions of a repository
+    # type (and the GPG keys shared by all), so is done once for each
+    # repository type, one type after another
+    prepared = dict()
+    prepare_deps = ()
+
+    for name, repo in targets:
+        repo_type = type(repo)
+
+        if repo_type not in prepared:
+            prepared[repo_type] = scheduler.add(
+                f'{name}.prepare_local_repos', repo.prepare_local_repos,
+                prepare_deps
+            )
+            prepare_deps = (prepared[repo_type],)
+
+    for name, repo in targets:
+        seed = scheduler.add(f'{name}.seed_local_repos',
+                             repo.seed_local_repos)
+        acquire = scheduler.add(f'{name}.acquire_packages',
+                                repo.acquire_packages)
+        imported = scheduler.add(f'{name}.import_packages',
+                                 repo.import_packages,
+                                 (gpg_stage, seed, acquire))
+        finalize = scheduler.add(f'{name}.finalize_local_repos',
+                                 repo.finalize_local_repos, (imported,))
+        saved = scheduler.add(f'{name}.save_publish_state',
+                              repo.save_publish_state, (finalize,))
+        scheduler.add(f'{name}.upload_local_repos', repo.upload_local_repos,
+                      (saved,) + tuple(prepared.values()))
+
+    with contextlib.ExitStack() as stack:
+        for _, repo in targets:
+            stack.enter_context(repo.handle_repo_server())
+
+        try:
+            scheduler.run()
+        finally:
+            for _, repo in targets:
+                repo.cancel_pipeline()
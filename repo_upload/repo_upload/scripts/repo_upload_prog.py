@@ -7,10 +7,12 @@ Currently the application supports the following types of repositories
     APT
     Yum
 
-The enterprise and community builds are always handled separately,
-along with each repository type.  For each it essentially builds a new
-local repository on the system it's being run on, then syncs the files
-to S3, allowing any new packages to now be available.
+The enterprise and community builds are handled separately, along
+with each repository type, though several of them can be handled in one
+run (e.g. '-r apt,yum -e community,enterprise'), sharing caches and
+running independent steps concurrently.  For each it essentially builds
+a new local repository on the system it's being run on, then syncs the
+files to S3, allowing any new packages to now be available.
 """
 
 import argparse
@@ -19,12 +21,39 @@ import importlib
 import logging
 import sys
 
+from repo_upload.repos.base import SharedResources
+from repo_upload.scheduler import update_repositories
+
 
 # Set up logging and handler
 logger = logging.getLogger('repo_upload')
 logger.setLevel(logging.INFO)
 
 
+def comma_list(choices):
+    """
+    Return an argument type accepting a comma-separated list
+    of the given choices
+    """
+
+    def parse(value):
+        items = [item.strip() for item in value.split(',') if item.strip()]
+
+        for item in items:
+            if item not in choices:
+                raise argparse.ArgumentTypeError(
+                    f'invalid choice: {item!r} (choose from '
+                    f'{", ".join(choices)})'
+                )
+
+        if not items:
+            raise argparse.ArgumentTypeError('no choices given')
+
+        return list(dict.fromkeys(items))
+
+    return parse
+
+
 def main():
     """
     Parse the command line arguments, handle configuration setup,
@@ -41,11 +70,17 @@ def main():
                         help='Configuration file for APT/Yum uploader',
                         default='repo_upload.ini')
     parser.add_argument('-r', '--repo-type', required=True,
-                        choices=['apt', 'yum'],
-                        help='Type of repository for upload')
+                        type=comma_list(['apt', 'yum']),
+                        help='Type of repository for upload (apt, yum '
+                             'or a comma-separated list)')
     parser.add_argument('-e', '--edition', required=True,
-                        choices=['community', 'enterprise'],
-                        help='Version of software being uploaded')
+                        type=comma_list(['community', 'enterprise']),
+                        help='Version of software being uploaded '
+                             '(community, enterprise or a comma-separated '
+                             'list)')
+    parser.add_argument('--profile', metavar='FILE',
+                        help='Write timing and transfer statistics for '
+                             'the run to FILE as JSON')
 
     args = parser.parse_args()
 
@@ -76,19 +111,38 @@ def main():
         )
         sys.exit(1)
 
-    # Import only the specific module for the necessary repository type
-    upload_module = f'repo_upload.repos.{args.repo_type}'
-    upload_class = f'{args.repo_type.capitalize()}Repository'
+    shared = SharedResources(common_info)
+    targets = list()
 
-    try:
-        mod = importlib.import_module(upload_module)
-    except ImportError as exc:
-        logger.info(exc)
-        logger.error(f'Module {upload_module} not found')
-        sys.exit(1)
+    for repo_type in args.repo_type:
+        # Import only the specific module for the necessary repository type
+        upload_module = f'repo_upload.repos.{repo_type}'
+        upload_class = f'{repo_type.capitalize()}Repository'
 
-    upload = getattr(mod, upload_class)(args.edition, common_info)
-    upload.update_repository()
+        try:
+            mod = importlib.import_module(upload_module)
+        except ImportError as exc:
+            logger.info(exc)
+            logger.error(f'Module {upload_module} not found')
+            sys.exit(1)
+
+        for edition in args.edition:
+            targets.append((
+                f'{repo_type}-{edition}',
+                getattr(mod, upload_class)(edition, common_info, shared)
+            ))
+
+    try:
+        if len(targets) == 1:
+            targets[0][1].update_repository()
+        else:
+            update_repositories(
+                targets,
+                common_info.getint('stage_workers', fallback=len(targets) * 2)
+            )
+    finally:
+        if args.profile is not None:
+            shared.stats.save(args.profile)
 
 
 if __name__ == '__main__':
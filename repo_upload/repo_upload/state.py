@@ -0,0 +1,80 @@
+"""
+Persistent record of the packages published into a local repository
+
+Used by incremental runs, where the local repositories are kept between
+runs and only releases which haven't yet been published are imported;
+the record is only a hint, as packages are imported again if they're
+missing from the local repository
+"""
+
+import contextlib
+import json
+import os
+
+
+class PublishState:
+    """
+    Tracks which (version, OS version) packages are already in
+    a local repository
+    """
+
+    def __init__(self, state_file):
+        """
+        Load the current state, if any has been saved
+        """
+
+        self.state_file = state_file
+
+        try:
+            with open(state_file) as fh:
+                published = json.load(fh)['published']
+        except FileNotFoundError:
+            published = list()
+
+        self.published = {tuple(entry) for entry in published}
+
+    def is_published(self, version, os_version):
+        """
+        Determine if the package for a given version and OS version
+        is already in the repository
+        """
+
+        return (version, os_version) in self.published
+
+    def mark_published(self, version, os_version):
+        """
+        Record the package for a given version and OS version as
+        being in the repository
+        """
+
+        self.published.add((version, os_version))
+
+    def forget(self, os_version):
+        """
+        Drop the record of the packages for a given OS version, such
+        as when its repository has to be created again
+        """
+
+        self.published = {(version, published_os)
+                          for version, published_os in self.published
+                          if published_os != os_version}
+
+    def clear(self):
+        """
+        Drop the whole record, removing any saved state
+        """
+
+        self.published = set()
+
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self.state_file)
+
+    def save(self):
+        """
+        Atomically write out the current state
+        """
+
+        with open(f'{self.state_file}.tmp', 'w') as fh:
+            json.dump({'published': sorted(self.published)}, fh, indent=2)
+
+        os.replace(f'{self.state_file}.tmp', self.state_file)
@@ -0,0 +1,131 @@
+"""
+Timing and throughput instrumentation for repository runs
+
+Records the wall time of each phase of a run, the bytes downloaded and
+uploaded, the number of files transferred or skipped and the number of
+requests made to each endpoint, all of which can be written out as JSON
+"""
+
+import collections
+import contextlib
+import json
+import threading
+import time
+
+
+class RunStats:
+    """
+    Thread-safe collection of the statistics for a run
+    """
+
+    def __init__(self):
+        """
+        Start with empty statistics
+        """
+
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.phases = collections.OrderedDict()
+        self.bytes = collections.Counter()
+        self.files = collections.Counter()
+        self.requests = collections.Counter()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """
+        Context manager timing a phase of the run; the time is recorded
+        even if the phase fails
+        """
+
+        start = time.perf_counter()
+
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.phases[name] = \
+                    self.phases.get(name, 0) + time.perf_counter() - start
+
+    def add_bytes(self, direction, count):
+        """
+        Record bytes transferred in the given direction
+        """
+
+        with self.lock:
+            self.bytes[direction] += count
+
+    def add_file(self, kind, outcome):
+        """
+        Record the outcome for a file of a transfer of a given kind
+        """
+
+        with self.lock:
+            self.files[f'{kind}.{outcome}'] += 1
+
+    def add_request(self, endpoint, count=1):
+        """
+        Record requests made to a given endpoint
+        """
+
+        with self.lock:
+            self.requests[endpoint] += count
+
+    def hook_s3(self, client):
+        """
+        Count every request made through a boto3 S3 client, by operation
+        """
+
+        def count_request(model, **_kwargs):
+            self.add_request(f's3.{model.name}')
+
+        client.meta.events.register('before-call.s3', count_request)
+
+    def hook_session(self, session, endpoint):
+        """
+        Count every response received through a requests session
+        """
+
+        def count_response(response, *_args, **_kwargs):
+            self.add_request(endpoint)
+
+            return response
+
+        session.hooks['response'].append(count_response)
+
+    def as_dict(self):
+        """
+        Return the statistics, along with the throughput of the phases
+        which transfer packages; when several repositories are handled,
+        the time of the phase for each of them is added together
+        """
+
+        with self.lock:
+            phases = dict(self.phases)
+            throughput = dict()
+
+            for direction, phase in (('downloaded', 'acquire_packages'),
+                                     ('uploaded', 'upload_local_repos')):
+                elapsed = sum(
+                    elapsed for name, elapsed in phases.items()
+                    if name == phase or name.endswith(f'.{phase}')
+                )
+
+                if elapsed:
+                    throughput[direction] = self.bytes[direction] / elapsed
+
+            return {
+                'wall_time': time.time() - self.start,
+                'phases': phases,
+                'bytes': dict(self.bytes),
+                'throughput': throughput,
+                'files': dict(self.files),
+                'requests': dict(self.requests),
+            }
+
+    def save(self, filename):
+        """
+        Write the statistics out as JSON
+        """
+
+        with open(filename, 'w') as fh:
+            json.dump(self.as_dict(), fh, indent=2, sort_keys=True)
@@ -0,0 +1,196 @@
+"""
+Adaptive concurrency and retries for S3 requests
+
+S3 answers too high a request rate with SlowDown (503) errors rather
+than failing outright, so transfers are run through a limiter on the
+number of them in flight, adapted AIMD-style: the limit grows by one
+after a full window of successful transfers, and is halved when S3
+throttles (at most once per backoff period, as the transfers in flight
+at the time will likely be throttled too).  The limit counts transfers
+(or single requests) rather than HTTP requests, as a multipart transfer
+sends up to the transfer manager's concurrency of parts at once within
+its slot.  Throttled transfers are retried after a randomly jittered
+exponential backoff, while missing objects are reported as such rather
+than retried
+"""
+
+import contextlib
+import random
+import threading
+import time
+
+import botocore.exceptions
+
+
+THROTTLE_CODES = {
+    'SlowDown', 'Throttling', 'ThrottlingException', 'RequestLimitExceeded',
+    'RequestThrottled', 'ServiceUnavailable', 'RequestTimeout',
+    'InternalError', '500', '503',
+}
+NOT_FOUND_CODES = {'404', 'NoSuchKey', 'NotFound'}
+
+
+def error_chain(exc):
+    """
+    Generator returning an exception and the exceptions it was raised
+    from or while handling; the transfer manager wraps client errors
+    (such as in S3UploadFailedError), hiding their error codes
+    """
+
+    seen = set()
+
+    while exc is not None and id(exc) not in seen:
+        seen.add(id(exc))
+        yield exc
+        exc = exc.__cause__ or exc.__context__
+
+
+def error_code(exc):
+    """
+    Return the error code of a boto3 client error, or of the client
+    error wrapped by another exception, or None for any other exception
+    """
+
+    for error in error_chain(exc):
+        if isinstance(error, botocore.exceptions.ClientError):
+            return error.response.get('Error', {}).get('Code')
+
+    return None
+
+
+def is_not_found(exc):
+    """
+    Determine if an error means the object doesn't exist
+    """
+
+    return error_code(exc) in NOT_FOUND_CODES
+
+
+def is_throttled(exc):
+    """
+    Determine if an error means S3 is throttling requests (or is
+    briefly unavailable), so the request should be retried later
+    """
+
+    if any(isinstance(error, (botocore.exceptions.ConnectionError,
+                              botocore.exceptions.ReadTimeoutError))
+           for error in error_chain(exc)):
+        return True
+
+    return error_code(exc) in THROTTLE_CODES
+
+
+class AdaptiveLimiter:
+    """
+    Limits the number of transfers in flight, with the limit adapted
+    to the throttling observed
+    """
+
+    def __init__(self, maximum, minimum=1):
+        """
+        Start with the maximum limit, backing off from it as needed
+        """
+
+        self.maximum = maximum
+        self.minimum = minimum
+        self.limit = maximum
+        self.in_flight = 0
+        self.successes = 0
+        self.last_decrease = 0
+        self.condition = threading.Condition()
+
+    @contextlib.contextmanager
+    def slot(self):
+        """
+        Context manager holding one of the slots for the duration
+        of a transfer
+        """
+
+        with self.condition:
+            while self.in_flight >= self.limit:
+                self.condition.wait()
+
+            self.in_flight += 1
+
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.in_flight -= 1
+                self.condition.notify()
+
+    def succeeded(self):
+        """
+        Additively increase the limit after a window's worth of
+        successful transfers
+        """
+
+        with self.condition:
+            self.successes += 1
+
+            if self.successes >= self.limit and self.limit < self.maximum:
+                self.limit += 1
+                self.successes = 0
+                self.condition.notify()
+
+    def throttled(self, cooldown):
+        """
+        Multiplicatively decrease the limit, unless it was already
+        decreased within the cooldown period; returns the new limit
+        """
+
+        with self.condition:
+            now = time.monotonic()
+
+            if now - self.last_decrease >= cooldown:
+                self.limit = max(self.minimum, self.limit // 2)
+                self.successes = 0
+                self.last_decrease = now
+
+            return self.limit
+
+
+class S3Throttle:
+    """
+    Runs S3 transfers through an adaptive limiter, retrying throttled
+    transfers with jittered exponential backoff
+    """
+
+    def __init__(self, maximum, stats, max_attempts=8, base_delay=.5,
+                 max_delay=30):
+        """
+        Allow up to maximum transfers in flight
+        """
+
+        self.limiter = AdaptiveLimiter(maximum)
+        self.stats = stats
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def call(self, func, *args, **kwargs):
+        """
+        Make a request, retrying it while it's throttled; any other
+        error (or throttling beyond the last attempt) is raised
+        """
+
+        for attempt in range(self.max_attempts):
+            try:
+                with self.limiter.slot():
+                    result = func(*args, **kwargs)
+            except Exception as exc:
+                if not is_throttled(exc) or \
+                        attempt == self.max_attempts - 1:
+                    raise
+
+                delay = random.uniform(
+                    0, min(self.max_delay, self.base_delay * 2 ** attempt)
+                )
+                limit = self.limiter.throttled(self.base_delay)
+                self.stats.add_request('s3.throttled')
+                print(f'  S3 request throttled ({error_code(exc) or exc}), '
+                      f'retrying in {delay:.1f}s with {limit} in flight')
+                time.sleep(delay)
+            else:
+                self.limiter.succeeded()
+                return result
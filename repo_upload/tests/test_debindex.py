@@ -0,0 +1,231 @@
+"""
+Tests for the Debian package reader and native APT index builder,
+using packages built from scratch so dpkg isn't needed
+"""
+
+import gzip
+import hashlib
+import io
+import shutil
+import subprocess
+import tarfile
+
+from collections import OrderedDict
+
+import pytest
+
+from repo_upload import debindex
+from repo_upload.hashcache import HashCache
+
+
+needs_zstd = pytest.mark.skipif(shutil.which('zstd') is None,
+                                reason='zstd tool not installed')
+
+CONTROL = '''Package: couchbase-server
+Version: 7.6.0-1234
+Architecture: amd64
+Section: database
+Description: Couchbase Server
+ Multi-line description
+ .
+ continued
+'''
+
+
+def make_tar(files, compression):
+    """
+    Return a tar archive of the given files (mapping paths to their
+    content, None for directories), compressed as given
+    """
+
+    buf = io.BytesIO()
+    mode = 'w' if compression in ('', 'zst') else f'w:{compression}'
+
+    with tarfile.open(fileobj=buf, mode=mode) as tar:
+        for path, content in files.items():
+            info = tarfile.TarInfo(path)
+
+            if content is None:
+                info.type = tarfile.DIRTYPE
+                tar.addfile(info)
+            else:
+                info.size = len(content)
+                tar.addfile(info, io.BytesIO(content))
+
+    data = buf.getvalue()
+
+    if compression == 'zst':
+        data = subprocess.run(['zstd', '-c', '-q'], input=data, check=True,
+                              stdout=subprocess.PIPE).stdout
+
+    return data
+
+
+def build_deb(filename, files, compression='gz', control=CONTROL):
+    """
+    Write out a Debian package installing the given files, with its
+    control and data archives compressed as given
+    """
+
+    suffix = f'.{compression}' if compression else ''
+    members = [
+        ('debian-binary', b'2.0\n'),
+        (f'control.tar{suffix}',
+         make_tar({'./': None, './control': control.encode()}, compression)),
+        (f'data.tar{suffix}', make_tar(files, compression)),
+    ]
+
+    with open(filename, 'wb') as fh:
+        fh.write(debindex.AR_MAGIC)
+
+        for name, data in members:
+            fh.write(f'{name + "/":<16}{0:<12}{0:<6}{0:<6}{"100644":<8}'
+                     f'{len(data):<10}`\n'.encode())
+            fh.write(data + b'\n' * (len(data) % 2))
+
+
+DATA_FILES = OrderedDict([
+    ('./', None),
+    ('./opt/', None),
+    ('./opt/couchbase/bin/couchbase-server', b'#!/bin/sh\n'),
+    ('./opt/couchbase/VERSION.txt', b'7.6.0-1234'),
+])
+
+
+class FakeGPG:
+    """
+    Stands in for python-gnupg, writing placeholder signatures
+    """
+
+    def sign_file(self, fh, keyid, detach, clearsign, output):
+        data = fh.read()
+
+        with open(output, 'wb') as out:
+            out.write(b'SIGNED\n' + (b'' if detach else data))
+
+        return type('Signed', (), {'status': 'signature created'})
+
+
+@pytest.mark.parametrize('compression', [
+    '', 'gz', 'xz', pytest.param('zst', marks=needs_zstd),
+])
+def test_read_package(tmp_path, compression):
+    filename = tmp_path / 'pkg.deb'
+    build_deb(filename, DATA_FILES, compression)
+
+    control = debindex.read_control(filename)
+
+    assert control['Package'] == 'couchbase-server'
+    assert control['Description'] == \
+        'Couchbase Server\n Multi-line description\n .\n continued'
+    assert debindex.read_contents(filename) == [
+        'opt/couchbase/VERSION.txt', 'opt/couchbase/bin/couchbase-server',
+    ]
+
+
+def test_not_a_package(tmp_path):
+    filename = tmp_path / 'bogus.deb'
+    filename.write_bytes(b'PK\x03\x04' + b'\0' * 100)
+
+    with pytest.raises(ValueError):
+        debindex.read_control(filename)
+
+
+def test_missing_member(tmp_path):
+    filename = tmp_path / 'empty.deb'
+    filename.write_bytes(debindex.AR_MAGIC)
+
+    with pytest.raises(ValueError):
+        debindex.read_contents(filename)
+
+
+def test_stanza_round_trip():
+    fields = debindex.parse_control(CONTROL)
+    fields['SHA256'] = '\n abc 10 main/Packages\n def 20 main/Packages.gz'
+
+    assert debindex.parse_control(debindex.format_stanza(fields)) == fields
+    assert debindex.format_stanza(fields).startswith(CONTROL)
+    assert 'SHA256:\n abc 10' in debindex.format_stanza(fields)
+
+
+@pytest.fixture
+def builder(tmp_path):
+    """
+    An index builder for a repository holding a single package
+    """
+
+    pkg_dir = tmp_path / 'repo' / 'pool' / 'focal' / 'main' / 'c'
+    pkg_dir.mkdir(parents=True)
+    build_deb(pkg_dir / 'couchbase-server_7.6.0-1234_amd64.deb', DATA_FILES)
+
+    return debindex.DebIndexBuilder(
+        tmp_path / 'repo', HashCache(tmp_path / 'cache' / 'hashes.db'),
+        FakeGPG(), 'KEY'
+    )
+
+
+def release_entries(release_file):
+    """
+    Return the checksums listed in a Release file, for each field
+    """
+
+    release = debindex.parse_control(release_file.read_text())
+
+    return {
+        field: {line.split()[2]: line.split()[0]
+                for line in release[field].splitlines() if line.strip()}
+        for field, _ in debindex.RELEASE_CHECKSUMS
+    }
+
+
+def test_build(builder):
+    dist_dir = builder.repo_dir / 'dists' / 'focal'
+
+    assert builder.build('focal', {'Origin': 'Couchbase'})
+
+    entries = release_entries(dist_dir / 'Release')
+
+    for field, algorithm in debindex.RELEASE_CHECKSUMS:
+        assert 'focal/main/binary-amd64/Packages.xz' in entries[field]
+
+        for relative_path, digest in entries[field].items():
+            index_file = dist_dir / relative_path
+            data = index_file.read_bytes()
+
+            assert hashlib.new(algorithm, data).hexdigest() == digest
+            assert (index_file.parent / 'by-hash' / field / digest) \
+                .read_bytes() == data
+
+    contents = gzip.decompress(
+        (dist_dir / 'focal' / 'main' / 'Contents-amd64.gz').read_bytes()
+    ).decode()
+
+    assert 'opt/couchbase/VERSION.txt' in contents
+    assert contents.splitlines()[0].split() == \
+        ['opt/couchbase/VERSION.txt', 'database/couchbase-server']
+    assert (dist_dir / 'InRelease').exists()
+
+    # Nothing changed, so the signed indexes are kept
+    assert not builder.build('focal', {'Origin': 'Couchbase'})
+
+
+def test_add_indexes(builder):
+    dist_dir = builder.repo_dir / 'dists' / 'focal'
+    builder.build('focal', {'Origin': 'Couchbase'})
+
+    extra = OrderedDict([('focal/main/binary-amd64/Packages.xz', b'new')])
+    builder.add_indexes(dist_dir, extra)
+    builder.add_indexes(dist_dir, extra)
+
+    release = (dist_dir / 'Release').read_text()
+    entries = release_entries(dist_dir / 'Release')
+
+    for field, algorithm in debindex.RELEASE_CHECKSUMS:
+        digest = hashlib.new(algorithm, b'new').hexdigest()
+
+        assert entries[field]['focal/main/binary-amd64/Packages.xz'] == digest
+        assert (dist_dir / 'focal' / 'main' / 'binary-amd64' / 'by-hash' /
+                field / digest).read_bytes() == b'new'
+
+    assert release.count('focal/main/binary-amd64/Packages.xz') == \
+        len(debindex.RELEASE_CHECKSUMS)
@@ -0,0 +1,162 @@
+"""
+Tests for the pure Python RPM header reader, using packages built
+from scratch so the rpm tools aren't needed
+"""
+
+import json
+import struct
+
+import pytest
+
+from repo_upload import rpmheader
+
+
+def build_header(entries):
+    """
+    Return a header structure holding the given (tag, type, value)
+    entries, laid out as rpm does
+    """
+
+    index = b''
+    store = b''
+
+    for tag, data_type, value in entries:
+        if data_type == rpmheader.TYPE_STRING:
+            data, count = value.encode() + b'\0', 1
+        elif data_type in (rpmheader.TYPE_STRING_ARRAY,
+                           rpmheader.TYPE_I18NSTRING):
+            data = b''.join(item.encode() + b'\0' for item in value)
+            count = len(value)
+        elif data_type == rpmheader.TYPE_BIN:
+            data, count = value, len(value)
+        else:
+            fmt = rpmheader.INT_FORMATS[data_type]
+            store += b'\0' * (-len(store) % struct.calcsize(fmt))
+            data = struct.pack(f'>{len(value)}{fmt}', *value)
+            count = len(value)
+
+        index += struct.pack('>IIII', tag, data_type, len(store), count)
+        store += data
+
+    return (rpmheader.HEADER_MAGIC + b'\0' * 4 +
+            struct.pack('>II', len(entries), len(store)) + index + store)
+
+
+def build_rpm(filename, signature, header, payload=b'PAYLOAD'):
+    """
+    Write out a package with the given signature and main header
+    entries, returning the byte range of its main header
+    """
+
+    sig = build_header(signature)
+    sig += b'\0' * (-len(sig) % 8)
+    main = build_header(header)
+    lead = rpmheader.LEAD_MAGIC + b'\0' * (rpmheader.LEAD_SIZE - 4)
+
+    with open(filename, 'wb') as fh:
+        fh.write(lead + sig + main + payload)
+
+    header_start = len(lead) + len(sig)
+
+    return header_start, header_start + len(main)
+
+
+SIGNATURE = [
+    (rpmheader.SIGTAG_SHA1, rpmheader.TYPE_STRING, 'abc123'),
+    (rpmheader.SIGTAG_SIZE, rpmheader.TYPE_INT32, [1234]),
+    (rpmheader.SIGTAG_MD5, rpmheader.TYPE_BIN, b'\x01\x02\x03'),
+]
+
+HEADER = [
+    (63, rpmheader.TYPE_BIN, b'\0' * 16),
+    (rpmheader.TAG_NAME, rpmheader.TYPE_STRING, 'couchbase-server'),
+    (rpmheader.TAG_VERSION, rpmheader.TYPE_STRING, '7.6.0'),
+    (rpmheader.TAG_RELEASE, rpmheader.TYPE_STRING, '1234'),
+    (rpmheader.TAG_ARCH, rpmheader.TYPE_STRING, 'x86_64'),
+    (rpmheader.TAG_SUMMARY, rpmheader.TYPE_I18NSTRING, ['Server']),
+    (rpmheader.TAG_FILEMODES, rpmheader.TYPE_INT16, [0o100644, 0o40755]),
+    (rpmheader.TAG_BASENAMES, rpmheader.TYPE_STRING_ARRAY, ['a', 'b']),
+    (rpmheader.TAG_LONGSIZE, rpmheader.TYPE_INT64, [2 ** 40]),
+    (rpmheader.TAG_PAYLOADDIGEST, rpmheader.TYPE_STRING_ARRAY, ['ff00']),
+    (rpmheader.TAG_PAYLOADDIGESTALGO, rpmheader.TYPE_INT32, [8]),
+]
+
+
+@pytest.fixture
+def package(tmp_path):
+    """
+    An unsigned package, along with the byte range of its main header
+    """
+
+    filename = tmp_path / 'unsigned.rpm'
+    header_range = build_rpm(filename, SIGNATURE, HEADER)
+
+    return filename, header_range
+
+
+def test_read_header(package):
+    filename, (header_start, header_end) = package
+    rpm = rpmheader.read_header(filename)
+
+    assert rpm.nevra() == ('couchbase-server', 0, '7.6.0', '1234', 'x86_64')
+    assert rpm.get(rpmheader.TAG_SUMMARY) == ['Server']
+    assert rpm.get(rpmheader.TAG_FILEMODES) == [0o100644, 0o40755]
+    assert rpm.get(rpmheader.TAG_BASENAMES) == ['a', 'b']
+    assert rpm.get(rpmheader.TAG_LONGSIZE) == 2 ** 40
+    assert rpm.get(rpmheader.TAG_GROUP, 'Unspecified') == 'Unspecified'
+    assert (rpm.header_start, rpm.header_end) == (header_start, header_end)
+    assert not rpm.is_signed()
+
+
+def test_region_tags_skipped(package):
+    rpm = rpmheader.read_header(package[0])
+
+    assert 63 not in rpm.header
+
+
+def test_signed_package(tmp_path):
+    filename = tmp_path / 'signed.rpm'
+    build_rpm(filename, SIGNATURE + [
+        (rpmheader.SIGTAG_RSA, rpmheader.TYPE_BIN, b'\x89\x01'),
+    ], HEADER)
+
+    assert rpmheader.read_header(filename).is_signed()
+
+
+def test_payload_digests(package):
+    rpm = rpmheader.read_header(package[0])
+
+    assert rpm.payload_digests() == {
+        'header_sha1': 'abc123',
+        'header_payload_md5': '010203',
+        'payload_sha256': 'ff00',
+    }
+
+
+def test_round_trip(package):
+    rpm = rpmheader.read_header(package[0])
+    copy = rpmheader.RpmHeader.from_dict(json.loads(json.dumps(rpm.to_dict())))
+
+    assert copy.signature == rpm.signature
+    assert copy.header == rpm.header
+    assert (copy.header_start, copy.header_end) == \
+        (rpm.header_start, rpm.header_end)
+    assert copy.nevra() == rpm.nevra()
+    assert copy.payload_digests() == rpm.payload_digests()
+
+
+def test_not_an_rpm(tmp_path):
+    filename = tmp_path / 'bogus.rpm'
+    filename.write_bytes(b'\0' * 200)
+
+    with pytest.raises(ValueError):
+        rpmheader.read_header(filename)
+
+
+def test_truncated_header(package, tmp_path):
+    filename, (_, header_end) = package
+    truncated = tmp_path / 'truncated.rpm'
+    truncated.write_bytes(filename.read_bytes()[:header_end - 4])
+
+    with pytest.raises(ValueError):
+        rpmheader.read_header(truncated)
@@ -0,0 +1,191 @@
+"""
+Tests for the adaptive S3 concurrency limiter and throttling retries
+"""
+
+import threading
+import time
+
+import boto3.exceptions
+import botocore.exceptions
+import pytest
+
+from repo_upload import throttle
+from repo_upload.stats import RunStats
+
+
+def client_error(code, operation='PutObject'):
+    """
+    Return a client error as raised by boto3 for the given error code
+    """
+
+    return botocore.exceptions.ClientError(
+        {'Error': {'Code': code, 'Message': code}}, operation
+    )
+
+
+def upload_failure(code):
+    """
+    Return the error raised by the transfer manager when an upload
+    fails with the given error code, wrapping the client error
+    """
+
+    try:
+        try:
+            raise client_error(code)
+        except botocore.exceptions.ClientError as exc:
+            raise boto3.exceptions.S3UploadFailedError(
+                f'Failed to upload: {exc}'
+            )
+    except boto3.exceptions.S3UploadFailedError as exc:
+        return exc
+
+
+@pytest.mark.parametrize('exc, expected', [
+    (client_error('SlowDown'), True),
+    (client_error('503'), True),
+    (client_error('AccessDenied'), False),
+    (client_error('NoSuchKey', 'GetObject'), False),
+    (upload_failure('SlowDown'), True),
+    (upload_failure('AccessDenied'), False),
+    (botocore.exceptions.EndpointConnectionError(endpoint_url='x'), True),
+    (botocore.exceptions.ReadTimeoutError(endpoint_url='x'), True),
+    (ValueError('SlowDown'), False),
+])
+def test_is_throttled(exc, expected):
+    assert throttle.is_throttled(exc) is expected
+
+
+def test_is_not_found():
+    assert throttle.is_not_found(client_error('404', 'HeadObject'))
+    assert throttle.is_not_found(client_error('NoSuchKey', 'GetObject'))
+    assert not throttle.is_not_found(client_error('SlowDown'))
+
+
+def test_error_code_wrapped():
+    assert throttle.error_code(upload_failure('SlowDown')) == 'SlowDown'
+    assert throttle.error_code(RuntimeError()) is None
+
+
+def test_error_chain_cycle():
+    first = RuntimeError('first')
+    second = RuntimeError('second')
+    first.__context__ = second
+    second.__context__ = first
+
+    assert list(throttle.error_chain(first)) == [first, second]
+
+
+def test_limiter_decrease():
+    limiter = throttle.AdaptiveLimiter(16, minimum=2)
+
+    assert limiter.throttled(cooldown=0) == 8
+    assert limiter.throttled(cooldown=0) == 4
+    assert limiter.throttled(cooldown=0) == 2
+    assert limiter.throttled(cooldown=0) == 2
+
+
+def test_limiter_cooldown():
+    limiter = throttle.AdaptiveLimiter(16)
+
+    assert limiter.throttled(cooldown=60) == 8
+    # Transfers in flight when throttling started fail together
+    assert limiter.throttled(cooldown=60) == 8
+
+
+def test_limiter_increase():
+    limiter = throttle.AdaptiveLimiter(4)
+    limiter.throttled(cooldown=0)
+
+    assert limiter.limit == 2
+
+    limiter.succeeded()
+    assert limiter.limit == 2
+    limiter.succeeded()
+    assert limiter.limit == 3
+
+    for _ in range(10):
+        limiter.succeeded()
+
+    assert limiter.limit == 4
+
+
+def test_limiter_slots():
+    limiter = throttle.AdaptiveLimiter(2)
+    release = threading.Event()
+    peak = list()
+
+    def transfer():
+        with limiter.slot():
+            peak.append(limiter.in_flight)
+            release.wait()
+
+    threads = [threading.Thread(target=transfer) for _ in range(4)]
+
+    for thread in threads:
+        thread.start()
+
+    time.sleep(.1)
+    assert limiter.in_flight == 2
+
+    release.set()
+
+    for thread in threads:
+        thread.join()
+
+    assert max(peak) == 2
+    assert limiter.in_flight == 0
+
+
+class FlakyRequest:
+    """
+    A request failing with the given errors before succeeding
+    """
+
+    def __init__(self, *errors):
+        self.errors = list(errors)
+        self.calls = 0
+
+    def __call__(self, value):
+        self.calls += 1
+
+        if self.errors:
+            raise self.errors.pop(0)
+
+        return value
+
+
+@pytest.fixture
+def s3_throttle():
+    """
+    A throttle which retries without waiting
+    """
+
+    return throttle.S3Throttle(8, RunStats(), max_attempts=3, base_delay=0)
+
+
+def test_throttle_retries(s3_throttle):
+    request = FlakyRequest(upload_failure('SlowDown'), client_error('503'))
+
+    assert s3_throttle.call(request, 'done') == 'done'
+    assert request.calls == 3
+    assert s3_throttle.stats.requests['s3.throttled'] == 2
+    assert s3_throttle.limiter.limit == 2
+
+
+def test_throttle_gives_up(s3_throttle):
+    request = FlakyRequest(*(client_error('SlowDown') for _ in range(3)))
+
+    with pytest.raises(botocore.exceptions.ClientError):
+        s3_throttle.call(request, 'done')
+
+    assert request.calls == 3
+
+
+def test_throttle_other_errors(s3_throttle):
+    request = FlakyRequest(upload_failure('AccessDenied'))
+
+    with pytest.raises(boto3.exceptions.S3UploadFailedError):
+        s3_throttle.call(request, 'done')
+
+    assert request.calls == 1
+    assert s3_throttle.limiter.limit == 8